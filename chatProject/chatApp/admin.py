@@ -1,5 +1,23 @@
 from django.contrib import admin
+from chatApp.models import IPBlacklist
+from chatApp.middleware.ip_blacklist import publish_blacklist_change
 # from chatApp.models import Room, Message
 #
 # admin.site.register(Room)
-# admin.site.register(Message)
\ No newline at end of file
+# admin.site.register(Message)
+
+
+@admin.register(IPBlacklist)
+class IPBlacklistAdmin(admin.ModelAdmin):
+    list_display = ("ip", "path", "reason", "is_active", "created_at")
+    list_filter = ("is_active",)
+    search_fields = ("ip",)
+    actions = ["unblock"]
+
+    @admin.action(description="解封所选 IP")
+    def unblock(self, request, queryset):
+        # queryset.update 不触发 post_save，这里手动广播
+        ips = list(queryset.filter(is_active=True).values_list("ip", flat=True))
+        queryset.update(is_active=False)
+        for ip in ips:
+            publish_blacklist_change(ip, False)
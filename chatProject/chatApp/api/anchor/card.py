@@ -1,16 +1,62 @@
 from rest_framework.decorators import api_view
 from django.http import JsonResponse
 from django.conf import settings
-from pymongo import MongoClient
+from django.db import transaction
 from chatApp.models import CharacterCard, Anchor, RoomImageBinding
+from chatApp.api.common.connections import mongo_db
+from chatApp.api.common.moderation import submit_moderation
 import json
 import hashlib
 import os
 import re
 
 # 初始化 MongoDB 连接
-client = MongoClient(settings.MONGO_URI)
-db = client.chat_db
+db = mongo_db
+
+# 送审的角色卡字段
+CARD_REVIEW_FIELDS = ("name", "description", "personality", "scenario", "first_mes", "mes_example")
+
+
+def card_review_text(character_json):
+    data = character_json.get('data') or {}
+    return "\n".join(str(data.get(field)) for field in CARD_REVIEW_FIELDS if data.get(field))
+
+
+def submit_card_review(card_id, review_text):
+    """
+    提交角色卡审核，提交失败（如 Redis 不可用）时只记录日志：卡片保持 pending，
+    同一张卡再次上传时会重新提交（见 import_card 的重复上传分支），也可以用 resubmit_card_reviews 命令批量重新提交
+    CARD_REVIEW_FIELDS 全部为空的卡片没有可送审的文本，直接通过：审核只检查文本，不检查图片（与引入审核前一致）
+    """
+    if not review_text:
+        on_card_reviewed(card_id, {"is_nsfw": False, "reason": "没有需要审核的文本"})
+        return True
+    try:
+        submit_moderation("character_card", card_id, review_text)
+        return True
+    except Exception as e:
+        print(f"[MODERATION] 角色卡 {card_id} 提交审核失败，保持待审核: {e}")
+        return False
+
+
+def on_card_reviewed(card_id, result):
+    """
+    审核队列回调：更新角色卡审核状态
+    - 重试用完仍是调用异常（result["error"]，模型服务不可用）：保持 pending，只记录原因，
+      服务恢复后用 resubmit_card_reviews 命令重新提交，不会因为一次故障把卡片永久判为不通过
+    - 只有明确判定 is_nsfw 为 False 才通过；模型输出无法解析（is_nsfw 为 None）按不通过处理（fail-closed）
+    save 触发 post_save 信号，清理绑定房间的图片缓存并刷新信息流卡片
+    """
+    card = CharacterCard.objects.filter(id=card_id).first()
+    if not card:
+        return
+    if result.get("error"):
+        card.review_reason = f"审核服务异常，待重新审核：{result.get('reason') or ''}"[:255]
+        card.save(update_fields=["review_reason"])
+        return
+    card.review_status = 'approved' if result.get("is_nsfw") is False else 'rejected'
+    card.review_reason = (result.get("reason") or "")[:255]
+    card.save(update_fields=["review_status", "review_reason"])
 
 
 @api_view(['POST'])
@@ -44,11 +90,15 @@ def import_card(request):
         # 检查是否重复上传
         if CharacterCard.objects.filter(image_name=filename, username=username).exists():
             existing_card = CharacterCard.objects.get(image_name=filename, username=username)
+            if existing_card.review_status == 'pending':
+                # 之前提交审核失败（或任务丢失）的卡片一直停在 pending，重新上传时再提交一次
+                submit_card_review(existing_card.id, card_review_text(json.loads(existing_card.character_data)))
             return JsonResponse({
                 'status': 'success',
                 'message': '卡不可重复上传',
                 'data': {
                     'id': existing_card.id,
+                    'review_status': existing_card.review_status,
                     'image_path': existing_card.image_path.url,
                     'full_path': request.build_absolute_uri(existing_card.image_path.url)
                 }
@@ -70,7 +120,8 @@ def import_card(request):
             character_data=json.dumps(character_json, ensure_ascii=False),
             create_date=create_date,
             language="cn" if re.search(r'[\u4e00-\u9fff]', character_name) else "en",
-            tags=tags
+            tags=tags,
+            review_status='pending'
         )
 
         # 保存图片文件
@@ -84,12 +135,18 @@ def import_card(request):
         character_card.image_path.name = sub_path
         character_card.save()
 
+        # 内容审核异步执行，审核通过前不展示图片
+        card_id = character_card.id
+        review_text = card_review_text(character_json)
+        transaction.on_commit(lambda: submit_card_review(card_id, review_text))
+
 
         return JsonResponse({
             'status': 'success',
             'message': '上传成功，已标记为不可见',
             'data': {
                 'id': character_card.id,
+                'review_status': character_card.review_status,
                 'image_path': character_card.image_path.url,
                 'full_path': request.build_absolute_uri(character_card.image_path.url)
             }
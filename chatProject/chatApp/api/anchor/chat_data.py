@@ -3,22 +3,25 @@ from channels.layers import get_channel_layer
 from rest_framework.decorators import api_view
 from rest_framework.response import Response
 from django.conf import settings
-from pymongo import MongoClient
 import json
 import hashlib
 from chatApp.models import RoomImageBinding,RoomInfo, CharacterCard
-from django_redis import get_redis_connection  # 获取 Redis 连接
+from chatApp.api.common.common import update_last_ai_reply, invalidate_room_images, normalize_send_date, \
+    allocate_floor
+from chatApp.api.common.tag_index import reindex_room_tags
+from chatApp.api.common.feed import refresh_feed_cards
+from chatApp.api.common.messages import insert_message
+from chatApp.api.common.connections import mongo_db, lazy_redis
 from django.views.decorators.csrf import csrf_exempt
 from django.utils import timezone
 # 建立 MongoDB 连接
-client = MongoClient(settings.MONGO_URI)
-db = client[settings.MONGO_DB_NAME]
+db = mongo_db
 
 # # 获取 Channel Layer
 # channel_layer = get_channel_layer()
 
 # 创建 Redis 连接
-redis_client = get_redis_connection('default')  # 使用 django-redis 配置
+redis_client = lazy_redis('default')  # 使用 django-redis 配置
 
 # # 异步发送 WebSocket 消息
 # async def send_to_websocket(room_id, send_data):
@@ -90,12 +93,10 @@ def chat_data(request):
         room_name = f"{uid}_{character_name}_{character_date}"
 
         # MongoDB 插入数据（带楼层）
-        collection = db[room_id]
+        # ✅ 每条消息都是一层楼（原子计数器分配，不再 count_documents）
+        floor_count = allocate_floor(db, room_id)
 
-        # ✅ 每条消息都是一层楼
-        floor_count = collection.count_documents({}) + 1
-
-        collection.insert_one({
+        insert_message(room_id, {
             "username": username,
             "uid": uid,
             "character_name": character_name,
@@ -105,8 +106,13 @@ def chat_data(request):
             "data_type": data_type,
             "data": data,
             "mes_html": mes_html,
+            "send_date_iso": normalize_send_date(data.get("send_date")),  # 写入时统一时间格式
             "floor": floor_count  # ✅ 新增楼层字段
         })
+
+        # AI 回复时同步更新房间最后回复时间（首页排序使用）
+        if data_type == "ai":
+            update_last_ai_reply(room_id, data.get("send_date"))
         # # 准备转发数据
         # send_data = {
         #     'uid': uid,
@@ -163,11 +169,15 @@ def chat_data(request):
 
             if binding_qs.exists():
                 # 获取旧绑定的房间 ID
-                old_room_ids = binding_qs.values_list('room_id', flat=True)
+                old_room_ids = list(binding_qs.values_list('room_id', flat=True))
                 # 把旧房间在 RoomInfo 设置为不展示
                 RoomInfo.objects.filter(room_id__in=old_room_ids).update(is_show=1)
                 # 覆盖绑定
                 binding_qs.update(room_id=room_id, updated_at=timezone.now())
+                # update 不触发信号，手动清理新旧房间的图片缓存
+                invalidate_room_images([(uid, rid) for rid in old_room_ids + [room_id]])
+                reindex_room_tags(old_room_ids + [room_id])
+                refresh_feed_cards(old_room_ids + [room_id])
             else:
                 # 新增绑定
                 RoomImageBinding.objects.create(
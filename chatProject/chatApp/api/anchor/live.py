@@ -1,20 +1,18 @@
 from rest_framework.decorators import api_view
 from rest_framework.response import Response
-from django_redis import get_redis_connection  # 使用 django-redis 连接 Redis
 from django.conf import settings
-from pymongo import MongoClient
 from chatApp.models import RoomInfo, Anchor
+from chatApp.api.common.connections import mongo_db, lazy_redis
 from django.http import JsonResponse
 import json
 from django.utils import timezone
 from django.views.decorators.csrf import csrf_exempt
 # 初始化 MongoDB 连接
-client = MongoClient(settings.MONGO_URI)
-db = client.chat_db  # 连接到 chat_db 数据库
+db = mongo_db  # 连接到 chat_db 数据库
 
 # 获取 Redis 连接
-redis_client = get_redis_connection('default')  # 使用 django-redis 配置
-redis_chat_limit_client = get_redis_connection('chat-limit')  # 使用 django-redis 配置
+redis_client = lazy_redis('default')  # 使用 django-redis 配置
+redis_chat_limit_client = lazy_redis('chat-limit')  # 使用 django-redis 配置
 @api_view(['POST'])
 def add_room_info(request):
     """
@@ -1,26 +1,93 @@
+from itertools import islice
+
+from asgiref.sync import sync_to_async
 from rest_framework.decorators import api_view
 from rest_framework.response import Response
-from pymongo import MongoClient
 from django.conf import settings
+from django.http import StreamingHttpResponse
+import json
 import traceback
-from datetime import timezone                  # ← 正确导入 UTC
-from dateutil import parser                    # ← 万能时间解析
+from chatApp.api.common.common import normalize_send_date
+from chatApp.api.common.messages import find_messages
+
+MAX_LIMIT = 500  # 传 limit 时单次最多返回的楼层数
+STREAM_BATCH_SIZE = 200  # 不传 limit 时每次从游标读取、输出的条数
+
+# 只取接口需要的字段
+CHAT_PROJECTION = {
+    "_id": 0,
+    "floor": 1,
+    "data_type": 1,
+    "data.name": 1,
+    "data.is_user": 1,
+    "data.send_date": 1,
+    "data.mes": 1,
+    "mes_html": 1,
+    "send_date_iso": 1,
+}
+
+
+def _format_chat_record(item):
+    data = item.get("data", {})
+
+    # send_date_iso 在写入时已生成，旧数据没有该字段时再现场解析
+    send_date = item.get("send_date_iso") or normalize_send_date(data.get("send_date"))
+
+    return {
+        "floor": item.get("floor", 0),
+        "data_type": item.get("data_type"),
+        "data": {
+            "name": data.get("name"),
+            "is_user": data.get("is_user"),
+            "send_date": send_date,
+            "mes": data.get("mes")
+        },
+        "mes_html": item.get("mes_html", "")
+    }
+
+
+def _read_batch(cursor, size):
+    return [_format_chat_record(item) for item in islice(cursor, size)]
 
 
-# 统一初始化 MongoDB 连接
-client = MongoClient(settings.MONGO_URI)
-db = client[settings.MONGO_DB_NAME]
+def _dumps(value):
+    # 与 DRF JSONRenderer 的输出格式一致
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":"))
+
+
+async def _stream_chat_records(cursor, first_batch):
+    """
+    不传 limit 时的全量响应，格式与分页响应相同（next_floor 为 null）
+    按批从游标读取、逐批输出，不在内存中拼出整个列表；游标读取放到线程中执行，不阻塞事件循环
+    """
+    yield '{"code":0,"message":"success","data":['
+    batch, separator = first_batch, ""
+    try:
+        while batch:
+            yield separator + ",".join(_dumps(record) for record in batch)
+            separator = ","
+            batch = await sync_to_async(_read_batch, thread_sensitive=False)(cursor, STREAM_BATCH_SIZE)
+    except Exception:
+        # 响应头已经发出，只能中断输出：客户端拿到不完整的 JSON，按失败处理后重新拉取
+        print(traceback.format_exc())
+        return
+    finally:
+        cursor.close()
+    yield '],"next_floor":null}'
 
 
 @api_view(['GET'])
 def get_room_chat(request):
     """
     获取指定房间的聊天记录（支持增量拉取）
-    GET /api/chat/get_room_chat?room_id=<room_id>&last_floor=<last_floor>
+    GET /api/chat/get_room_chat?room_id=<room_id>&last_floor=<last_floor>&limit=<limit>
 
     参数：
     - room_id: 房间ID，必填
     - last_floor: 上次拉取的最后一楼（默认0，表示全量）
+    - limit: 本次最多返回的楼层数（可选，最大 500），取满时返回 next_floor，下一页把它作为 last_floor
+      不传 limit 时与原来一样返回 last_floor 之后的全部楼层，超过 STREAM_BATCH_SIZE 条时流式输出
+    只读接口不建索引（不存在的 room_id 不会建出空集合），索引在写入时或由 ensure_chat_indexes 命令创建
     """
     room_id = request.GET.get("room_id")
     if not room_id:
@@ -28,45 +95,34 @@ def get_room_chat(request):
 
     try:
         last_floor = int(request.GET.get("last_floor", 0))
+        limit = int(request.GET.get("limit", 0))
     except ValueError:
-        return Response({"code": 1, "message": "Invalid last_floor parameter"}, status=400)
+        return Response({"code": 1, "message": "Invalid last_floor or limit parameter"}, status=400)
+    query = {"floor": {"$gt": last_floor}}
 
+    if limit <= 0:
+        try:
+            # 第一批在 try 内读取：MongoDB 不可用时返回 500，而不是开始输出后才中断
+            cursor = find_messages(room_id, query, CHAT_PROJECTION, sort=[("floor", 1)]).batch_size(STREAM_BATCH_SIZE)
+            first_batch = _read_batch(cursor, STREAM_BATCH_SIZE)
+        except Exception as e:
+            print(traceback.format_exc())
+            return Response({"code": 2, "message": str(e)}, status=500)
+        if len(first_batch) < STREAM_BATCH_SIZE:
+            cursor.close()
+            return Response({"code": 0, "message": "success", "data": first_batch, "next_floor": None}, status=200)
+        return StreamingHttpResponse(_stream_chat_records(cursor, first_batch), content_type="application/json")
+
+    limit = min(limit, MAX_LIMIT)
     try:
-        collection = db[room_id]
-        chat_records = list(collection.find({}).sort("floor", 1))
-
-        result = []
-        for item in chat_records:
-            floor = item.get("floor", 0)
-            if floor <= last_floor:
-                continue
-
-            data = item.get("data", {})
-
-            send_date_str = data.get("send_date")
-            send_date = parser.parse(send_date_str).astimezone(timezone.utc).isoformat(timespec='seconds') + 'Z' \
-                if send_date_str else None
-
-            filtered_data = {
-                "name": data.get("name"),
-                "is_user": data.get("is_user"),
-                "send_date": send_date,
-                "mes": data.get("mes")
-            }
-
-            result.append({
-                "floor": floor,
-                "data_type": item.get("data_type"),
-                "data": filtered_data,
-                "mes_html": item.get("mes_html", "")
-            })
-
-        return Response({
-            "code": 0,
-            "message": "success",
-            "data": result
-        }, status=200)
+        # floor 索引上的范围查询，只读取 last_floor 之后的楼层；在 try 内读完，MongoDB 出错时返回 500 而不是半截 JSON
+        cursor = find_messages(room_id, query, CHAT_PROJECTION, sort=[("floor", 1)], limit=limit)
+        result = [_format_chat_record(item) for item in cursor]
+
+        # 取满时返回下一页的 last_floor
+        next_floor = result[-1]["floor"] if len(result) == limit else None
+        return Response({"code": 0, "message": "success", "data": result, "next_floor": next_floor}, status=200)
 
     except Exception as e:
         print(traceback.format_exc())
-        return Response({"code": 2, "message": str(e)}, status=500)
\ No newline at end of file
+        return Response({"code": 2, "message": str(e)}, status=500)
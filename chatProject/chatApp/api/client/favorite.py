@@ -4,7 +4,7 @@ from rest_framework.decorators import api_view, permission_classes
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 from chatApp.models import CharacterCard, Favorite, RoomInfo
-from chatApp.api.common.common import build_full_image_url
+from chatApp.api.common.common import build_full_image_urls
 from rest_framework.pagination import PageNumberPagination
 
 class ChatHistoryPagination(PageNumberPagination):
@@ -28,36 +28,38 @@ def favorite_list(request):
     paginator = ChatHistoryPagination()
     result_page = paginator.paginate_queryset(favorites, request)
 
+    # RoomInfo 一条 IN 查询取出，房间不存在的跳过
+    rooms_by_id = {}
+    for room in RoomInfo.objects.filter(room_id__in={fav.room_id for fav in result_page}).order_by('id'):
+        rooms_by_id.setdefault(room.room_id, room)
+    rows = [(fav, rooms_by_id[fav.room_id]) for fav in result_page if fav.room_id in rooms_by_id]
+
+    # 批量获取房间的图片信息
+    image_infos = build_full_image_urls(request, [(room_info.uid, room_info.room_id) for _, room_info in rows])
+
     data = []
-    for fav in result_page:
-        try:
-            # 获取 RoomInfo 信息
-            room_info = RoomInfo.objects.get(room_id=fav.room_id)
-
-            image_info = build_full_image_url(request, uid=room_info.uid, room_id=room_info.room_id)
-            # 构建返回数据
-            data.append({
-                "room_id": room_info.room_id,
-                "room_name": room_info.room_name,
-                "uid": room_info.uid,
-                "username": room_info.user_name,
-                "character_name": room_info.character_name,
-                "character_date": room_info.character_date,
-                "image_name": image_info['image_name'],
-                "image_path": image_info['image_path'],
-                "tags": image_info['tags'],
-                "language": image_info['language'],
-                "room_info": {
-                    "title": room_info.title or "",
-                    "describe": room_info.describe or "",
-                    "coin_num": room_info.coin_num if room_info.coin_num is not None else 0,
-                    "room_type": room_info.room_type or 0,
-                },
-                "last_ai_reply_timestamp": room_info.last_ai_reply_timestamp,
-                "collected_at": fav.created_at,
-            })
-        except (RoomInfo.DoesNotExist):
-            continue
+    for (fav, room_info), image_info in zip(rows, image_infos):
+        # 构建返回数据
+        data.append({
+            "room_id": room_info.room_id,
+            "room_name": room_info.room_name,
+            "uid": room_info.uid,
+            "username": room_info.user_name,
+            "character_name": room_info.character_name,
+            "character_date": room_info.character_date,
+            "image_name": image_info['image_name'],
+            "image_path": image_info['image_path'],
+            "tags": image_info['tags'],
+            "language": image_info['language'],
+            "room_info": {
+                "title": room_info.title or "",
+                "describe": room_info.describe or "",
+                "coin_num": room_info.coin_num if room_info.coin_num is not None else 0,
+                "room_type": room_info.room_type or 0,
+            },
+            "last_ai_reply_timestamp": room_info.last_ai_reply_timestamp,
+            "collected_at": fav.created_at,
+        })
 
     # 返回分页后的响应
     return Response({
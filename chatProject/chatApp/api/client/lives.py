@@ -1,7 +1,5 @@
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.response import Response
-from django_redis import get_redis_connection
-from pymongo import MongoClient
 from django.conf import settings
 import json
 from django.shortcuts import redirect, render
@@ -17,62 +15,36 @@ from django.contrib.auth import get_user
 from django.http import JsonResponse
 from chatApp.consumers import ChatConsumer
 from django.utils.dateparse import parse_datetime
-from chatApp.api.common.common import  build_full_image_url, IDCursorPagination
+from chatApp.api.common.common import  build_full_image_url, build_full_image_urls, IDCursorPagination
 from chatApp.api.common.payment import process_diamond_payment
+from chatApp.api.common.tag_index import filter_rooms_by_tags
+from chatApp.api.common.connections import lazy_redis, get_redis
+from chatApp.api.common.messages import find_one_message
 from rest_framework.pagination import CursorPagination
 from rest_framework.decorators import permission_classes
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.pagination import PageNumberPagination
 
 # 获取 Redis 连接
-redis_client = get_redis_connection('default')
+redis_client = lazy_redis('default')
 
-# 初始化 MongoDB 连接
-client = MongoClient(settings.MONGO_URI)
-db = client[settings.MONGO_DB_NAME]
-
-
-def parse_send_date(send_date_str):
-    """
-    将 MongoDB 中的 send_date 字符串解析为 datetime 对象
-    例如 "September 12, 2025 10:30pm" 或 "2025-09-12 22:30:00"
-    """
-    if not send_date_str:
-        return None
-    try:
-        return datetime.strptime(send_date_str, "%B %d, %Y %I:%M%p")
-    except ValueError:
-        try:
-            return datetime.strptime(send_date_str, "%Y-%m-%d %H:%M:%S")
-        except ValueError:
-            return None
 
 @api_view(['GET'])
 def get_all_lives(request):
     """
     获取正在直播的直播间列表，支持 tags 搜索 + CursorPagination
     GET /api/live/get_all_lives?tags=萝莉&cursor=xxx
+    多个标签用逗号分隔（取交集）：?tags=萝莉,cn
     """
     raw_tag = request.GET.get("tags", "").strip()
-    search_tag = raw_tag.lower() if raw_tag else None  # 统一转小写用于匹配
 
-    # 1. 查询公开房间
+    # 1. 查询公开房间，标签搜索通过倒排索引在分页前完成过滤
     room_infos = RoomInfo.objects.filter(is_show=0, file_branch='main')
+    if raw_tag:
+        room_infos = filter_rooms_by_tags(room_infos, raw_tag)
 
-    # 2. 更新每个 room 的 last_ai_reply_timestamp（你原来的逻辑保留）
-    for room in room_infos:
-        collection = db[room.room_id]
-        last_ai_doc = collection.find_one(
-            {"data_type": "ai"},
-            sort=[("data.send_date", -1)]
-        )
-        if last_ai_doc and "data" in last_ai_doc:
-            send_date_str = last_ai_doc["data"].get("send_date")
-            dt = parse_send_date(send_date_str)
-            if dt:
-                timestamp = dt.timestamp()
-                if room.last_ai_reply_timestamp != timestamp:
-                    RoomInfo.objects.filter(pk=room.pk).update(last_ai_reply_timestamp=timestamp)
+    # 2. last_ai_reply_timestamp 由聊天写入接口（chat_data / fork_chat）实时维护，
+    #    并由 refresh_last_ai_reply 命令定期批量校准，这里不再逐个房间查询 MongoDB
 
     # 3. 分页（你原来的分页方式完全保留）
     paginator = IDCursorPagination()
@@ -81,13 +53,13 @@ def get_all_lives(request):
 
     # 4. 构建返回数据（超级简洁！所有复杂逻辑都在 build_full_image_url 里）
     lives_info = []
-    for room in paginated_rooms:
-        image_info = build_full_image_url(
-            request, room.uid, room.room_id, search_tag
-        )
+    image_infos = build_full_image_urls(
+        request, [(room.uid, room.room_id) for room in paginated_rooms]
+    )
+    for room, image_info in zip(paginated_rooms, image_infos):
 
-        # 判断是否被过滤：超级容易！
-        if not image_info["image_name"]:  # 没名字 = 被过滤了
+        # 没有绑定角色卡的房间不展示
+        if not image_info["image_name"]:
             continue
 
         lives_info.append({
@@ -198,7 +170,7 @@ def get_live_info(request):
         subscription_info = {"subscription_status": False, "amount": 0}
 
         if is_authenticated:
-            redis_client_subscribe = get_redis_connection('subscribe')
+            redis_client_subscribe = get_redis('subscribe')
             subscription_key = f"subscription:{user.id}:{room_info.uid}"
             subscription_data = redis_client_subscribe.get(subscription_key)
             if subscription_data:
@@ -300,8 +272,7 @@ def get_user_chat_history(request):
 
     try:
         # 获取房间数据
-        collection = db[room_id]
-        room_data = collection.find_one({"room_id": room_id})
+        room_data = find_one_message(room_id)
 
         if not room_data:
             return Response({"code": 1, "message": "Room not found in database."}, status=404)
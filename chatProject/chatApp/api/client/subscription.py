@@ -1,4 +1,4 @@
-from django_redis import get_redis_connection
+from chatApp.api.common.connections import get_redis
 from django.http import JsonResponse
 from django.db import transaction
 from django.utils import timezone
@@ -62,7 +62,7 @@ def subscribe_to_anchor(request):
 #         crypto_amount = amount / Decimal('5')
 
         # Redis key
-        redis_client = get_redis_connection('subscribe')
+        redis_client = get_redis('subscribe')
         redis_key = f"subscription:{user.id}:{anchor.uid}"
         if redis_client.get(redis_key):
             return JsonResponse({
@@ -141,7 +141,7 @@ def get_subscriptions(request):
         redis_key_prefix = f"subscription:{user_id}:"
 
         # 获取该用户所有订阅的 Redis key
-        redis_client = get_redis_connection('subscribe')  # 使用 'subscribe' 配置连接到 Redis
+        redis_client = get_redis('subscribe')  # 使用 'subscribe' 配置连接到 Redis
         subscription_keys = redis_client.keys(f"{redis_key_prefix}*")  # 获取以 user_id 为前缀的所有订阅 key
 
         if not subscription_keys:
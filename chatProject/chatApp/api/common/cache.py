@@ -0,0 +1,189 @@
+"""
+防缓存击穿的缓存工具
+- 单飞（single-flight）：Redis SET NX 锁（值为随机 token，只删除自己持有的锁），同一时间只有一个 worker 重新计算
+- stale-while-revalidate：过了新鲜期的值继续保留 stale_ttl 秒，重新计算期间其他请求直接返回旧值
+- 概率提前过期（XFetch）：越接近过期、计算越慢，越可能提前由某个请求重新计算，避免同一时刻集中过期
+- 负缓存：计算结果为 None 时缓存 negative_ttl 秒，避免不存在的数据反复穿透到数据库
+- Redis 不可用时退化为直接计算，不影响接口返回
+
+用法：
+    value = cached_call("tag_vocab", load_vocab, ttl=300)
+
+    @api_view(['GET'])
+    @cached_view(ttl=30)
+    def some_expensive_view(request): ...
+"""
+
+import functools
+import json
+import math
+import random
+import secrets
+import time
+from urllib.parse import urlencode
+
+from redis.exceptions import RedisError
+from rest_framework.response import Response
+
+from chatApp.api.common.connections import get_redis
+
+CACHE_PREFIX = "swr"
+
+# 值等于自己的 token 才删除：计算超过 lock_timeout 时锁可能已过期并被其他 worker 抢到，不能删掉别人的锁
+RELEASE_LOCK_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+def _lock_key(key):
+    return f"{CACHE_PREFIX}:lock:{key}"
+
+
+def single_flight(key, compute, is_done, lock_timeout=30, wait=5, alias="default"):
+    """
+    同一个 key 只允许一个 worker 执行 compute
+    - 抢到锁：执行 compute 并返回 (True, 结果)
+    - 没抢到：每 50ms 检查一次 is_done()，完成后返回 (False, None)；等待超时也返回 (False, None)
+    """
+    redis_client = get_redis(alias)
+    lock_key = _lock_key(key)
+    token = secrets.token_hex(16)
+    if redis_client.set(lock_key, token, nx=True, ex=lock_timeout):
+        try:
+            return True, compute()
+        finally:
+            try:
+                redis_client.register_script(RELEASE_LOCK_LUA)(keys=[lock_key], args=[token])
+            except RedisError as e:
+                # 释放失败时锁在 lock_timeout 后自动过期
+                print(f"[CACHE] 释放 {key} 的锁失败: {e}")
+
+    deadline = time.monotonic() + wait
+    while time.monotonic() < deadline:
+        time.sleep(0.05)
+        if is_done():
+            break
+    return False, None
+
+
+def _should_refresh(envelope, beta):
+    """XFetch：now - delta * beta * ln(rand) >= 新鲜期截止时间"""
+    delta = envelope.get("d", 0)
+    return time.time() - delta * beta * math.log(random.random() or 1e-12) >= envelope["e"]
+
+
+def cached_call(key, compute, ttl, stale_ttl=None, negative_ttl=30, beta=1.0, lock_timeout=30, wait=5,
+                alias="default"):
+    """
+    读取缓存，缺失或需要刷新时单飞重算
+    compute 返回值需可 JSON 序列化；返回 None 视为“不存在”并做负缓存
+    """
+    stale_ttl = ttl if stale_ttl is None else stale_ttl
+    redis_client = get_redis(alias)
+    cache_key = f"{CACHE_PREFIX}:{key}"
+
+    def load():
+        raw = redis_client.get(cache_key)
+        return json.loads(raw) if raw else None
+
+    def store():
+        started = time.time()
+        value = compute()
+        delta = time.time() - started
+        fresh = negative_ttl if value is None else ttl
+        envelope = {"v": value, "d": delta, "e": time.time() + fresh}
+        # 负缓存不保留旧值
+        expire = fresh if value is None else fresh + stale_ttl
+        try:
+            redis_client.set(cache_key, json.dumps(envelope, ensure_ascii=False, default=str),
+                             ex=max(1, int(expire)))
+        except RedisError as e:
+            # 写缓存失败不影响本次返回
+            print(f"[CACHE] 写入 {key} 失败: {e}")
+        return value
+
+    try:
+        envelope = load()
+    except Exception as e:
+        print(f"[CACHE] 读取 {key} 失败，直接计算: {e}")
+        return compute()
+
+    if envelope is not None and not _should_refresh(envelope, beta):
+        return envelope["v"]
+
+    try:
+        acquired, value = single_flight(
+            key, store, lambda: envelope is None and load() is not None,
+            lock_timeout=lock_timeout, wait=0 if envelope is not None else wait, alias=alias
+        )
+    except Exception as e:
+        if envelope is not None:
+            # 刷新失败时继续返回旧值
+            print(f"[CACHE] 刷新 {key} 失败，返回旧值: {e}")
+            return envelope["v"]
+        if not isinstance(e, RedisError):
+            raise
+        # 冷启动时加锁失败（Redis 不可用）：直接计算
+        print(f"[CACHE] {key} 加锁失败，直接计算: {e}")
+        return compute()
+
+    if acquired:
+        return value
+    if envelope is not None:
+        # 其他 worker 正在刷新，先返回旧值
+        return envelope["v"]
+    # 冷启动：等到了其他 worker 的结果就用，否则自己计算（不写缓存）
+    try:
+        envelope = load()
+    except RedisError:
+        envelope = None
+    return envelope["v"] if envelope is not None else compute()
+
+
+def invalidate(key, alias="default"):
+    """删除 cached_call 缓存的值（数据变更后调用），下次读取重新计算"""
+    get_redis(alias).delete(f"{CACHE_PREFIX}:{key}")
+
+
+def _default_view_key(request, vary_on_user):
+    params = urlencode(sorted(request.GET.items()))
+    key = f"view:{request.path}?{params}"
+    if vary_on_user:
+        user = getattr(request, "user", None)
+        key += f":u{user.id if user is not None and user.is_authenticated else 0}"
+    return key
+
+
+class _Uncacheable(Exception):
+    def __init__(self, response):
+        super().__init__(response.status_code)
+        self.response = response
+
+
+def cached_view(ttl, stale_ttl=None, key_func=None, vary_on_user=False, **options):
+    """
+    DRF 视图缓存装饰器（放在 @api_view 下面），只缓存 200 响应的 data
+    key_func(request) 可自定义缓存 key，默认按路径 + 查询参数（vary_on_user 时再加用户）
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(request, *args, **kwargs):
+            key = key_func(request) if key_func else _default_view_key(request, vary_on_user)
+
+            def compute():
+                response = view(request, *args, **kwargs)
+                if response.status_code != 200 or not hasattr(response, "data"):
+                    # 非 200 不缓存，原样返回
+                    raise _Uncacheable(response)
+                return response.data
+
+            try:
+                data = cached_call(key, compute, ttl, stale_ttl=stale_ttl, **options)
+            except _Uncacheable as e:
+                return e.response
+            return Response(data)
+        return wrapper
+    return decorator
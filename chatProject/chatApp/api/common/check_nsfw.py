@@ -1,73 +1,294 @@
-from google import genai
+"""
+NSFW 检测（两级，只有拿不准的文本才调用 Gemini）
+1. 本地预筛：文本归一化（NFKC、小写、去掉空白和标点）后用关键词自动机扫描一遍
+   - 命中 NSFW_BLOCK_KEYWORDS：直接判定 NSFW
+   - 命中 NSFW_REVIEW_KEYWORDS：交给 Gemini 判断
+   - 都没命中：直接放行（未配置任何关键词时不放行，全部交给 Gemini，与原来一致）
+2. 结果缓存：Gemini 的判定按归一化文本的 sha1 缓存在 Redis（NSFW_CACHE_TTL），调用异常、解析失败的结果不缓存
+check_nsfw_batch 批量检测：相同文本只调用一次，同时进行的 Gemini 调用不超过 NSFW_LLM_CONCURRENCY（进程内）
+各阶段命中次数见 nsfw_stats() / api/ops/nsfw_stats/
+"""
+
+import hashlib
 import json
 import os
-from dotenv import load_dotenv
 import re
+import threading
+import unicodedata
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from dotenv import load_dotenv
+from google import genai
+from rest_framework.decorators import api_view, permission_classes
+from rest_framework.permissions import IsAdminUser
+from rest_framework.response import Response
+
+from chatApp.api.common.connections import get_redis
+from chatApp.api.common.keywords import KeywordMatcher
 
 load_dotenv()
 API_KEY = os.getenv("GEMINI_API_KEY")
 
-# 新版 SDK 客户端
-client = genai.Client(api_key=API_KEY)
+NSFW_MODEL = "gemini-2.5-flash"
+# 修改提示词或模型时加 1，旧的缓存结果不再使用
+NSFW_PROMPT_VERSION = 1
+NSFW_CACHE_PREFIX = "nsfw"
+NSFW_CACHE_TTL = getattr(settings, "NSFW_CACHE_TTL", 30 * 24 * 3600)
+NSFW_LLM_CONCURRENCY = getattr(settings, "NSFW_LLM_CONCURRENCY", 4)
 
-def is_nsfw(text: str) -> dict:
-    """
-    使用 Gemini API 判断文本是否包含 NSFW 内容（成人、暴力、敏感等）。
-    若 Gemini 因安全策略拒绝生成内容或返回异常，则自动判定为 NSFW。
-    """
-    if not text:
-        print("⚠️ [NSFW检测] 文本为空，跳过检测。")
-        return {"is_nsfw": None, "score": None, "reason": "文本为空"}
+_client = None
+_client_lock = threading.Lock()
+_llm_slots = threading.BoundedSemaphore(NSFW_LLM_CONCURRENCY)
+
+
+def _get_client():
+    """新版 SDK 客户端，第一次调用时创建（导入模块时不要求配置 GEMINI_API_KEY）"""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = genai.Client(api_key=API_KEY)
+    return _client
+
+
+class NSFWMetrics:
+    COUNTERS = ("checked", "empty", "prefilter_flagged", "prefilter_passed", "cache_hits", "cache_misses",
+                "deduplicated", "llm_calls", "llm_errors")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = dict.fromkeys(self.COUNTERS, 0)
+
+    def incr(self, name, count=1):
+        if count:
+            with self._lock:
+                self.counters[name] += count
+
+    def stats(self):
+        with self._lock:
+            c = dict(self.counters)
+
+        def rate(hits, total):
+            return round(hits / total, 4) if total else None
+
+        prefiltered = c["prefilter_flagged"] + c["prefilter_passed"]
+        return {
+            **c,
+            "prefilter_rate": rate(prefiltered, c["checked"] - c["empty"]),
+            "cache_hit_rate": rate(c["cache_hits"], c["cache_hits"] + c["cache_misses"]),
+            "llm_rate": rate(c["llm_calls"], c["checked"] - c["empty"]),
+        }
+
+
+metrics = NSFWMetrics()
+
+
+# ---------- 第一级：本地预筛 ----------
+_STRIP_FOR_SCAN = re.compile(r"[\W_]+")
+
+
+def normalize_text(text):
+    """缓存用的归一化：NFKC、小写、连续空白合并"""
+    return " ".join(unicodedata.normalize("NFKC", text).casefold().split())
+
+
+def _scan_form(text):
+    """关键词扫描用：再去掉空白和标点，避免用空格、符号隔开关键词绕过"""
+    return _STRIP_FOR_SCAN.sub("", text)
+
+
+class _Lexicon:
+    def __init__(self, block_keywords, review_keywords):
+        self.words = []
+        self.blocking = []
+        for blocking, keywords in ((True, block_keywords), (False, review_keywords)):
+            for word in keywords or []:
+                word = _scan_form(normalize_text(word))
+                if word:
+                    self.words.append(word)
+                    self.blocking.append(blocking)
+        self.matcher = KeywordMatcher(self.words)
+
+    def classify(self, normalized):
+        """返回 (判定结果, 需要模型判断)"""
+        if not self.words:
+            return None, True
+        found = self.matcher.search(_scan_form(normalized))
+        blocked = sorted(self.words[i] for i in found if self.blocking[i])
+        if blocked:
+            return {"is_nsfw": True, "score": 1.0, "reason": f"命中屏蔽词：{'、'.join(blocked[:5])}",
+                    "source": "prefilter"}, False
+        if found:
+            return None, True
+        return {"is_nsfw": False, "score": 0.0, "reason": "本地预筛未命中敏感词", "source": "prefilter"}, False
+
+
+_lexicon = None
+_lexicon_lock = threading.Lock()
+
+
+def _get_lexicon():
+    global _lexicon
+    if _lexicon is None:
+        with _lexicon_lock:
+            if _lexicon is None:
+                _lexicon = _Lexicon(getattr(settings, "NSFW_BLOCK_KEYWORDS", []),
+                                    getattr(settings, "NSFW_REVIEW_KEYWORDS", []))
+    return _lexicon
+
+
+# ---------- 第二级：结果缓存 ----------
+def _cache_key(normalized):
+    digest = hashlib.sha1(normalized.encode("utf-8")).hexdigest()
+    return f"{NSFW_CACHE_PREFIX}:v{NSFW_PROMPT_VERSION}:{digest}"
 
-    print("🟢 [NSFW检测] 开始检测文本内容（长度:", len(text), "字符）")
 
+def _cache_get_many(keys):
     try:
-        prompt = (
-            "请判断以下文本是否包含 **严格禁止的内容**："
-            "黄色内容（性描写、性暗示、性器官、性交、口交、调教中的性行为等）"
-            "或政治敏感内容。"
-            "对于暴力、D/s（支配与调教）、羞辱、心理操控、身材/外貌描写等内容可以放行。"
-            f"\n文本：{text}\n"
-            "返回 JSON 格式：{{\"is_nsfw\":true/false,\"score\":0~1,\"reason\":\"…\"}}"
-        )
-
-        # 调用 Gemini
-        print("📡 [NSFW检测] 调用 Gemini API 中 ...")
-        response = client.models.generate_content(
-            model="gemini-2.5-flash",
-            contents=prompt
-        )
-
-        # 兼容不同字段
-        ai_text = getattr(response, "text", None) or getattr(response, "content", None)
-
-        # ✅ 如果 Gemini 拒绝生成内容，则保守判定为 NSFW
-        if not ai_text or not isinstance(ai_text, str) or ai_text.strip() == "":
-            print("🚫 [NSFW检测] Gemini 拒绝返回结果（可能触发安全过滤） → 判定为 NSFW。")
-            return {
-                "is_nsfw": True,
-                "score": 1.0,
-                "reason": "Gemini 拒绝返回结果，可能因文本包含成人/敏感内容，保守判定为 NSFW"
-            }
-
-        print("✅ [NSFW检测] Gemini 返回内容，开始解析结果。")
-
-        # 去除 ```json 包裹
-        ai_text_clean = re.sub(r"```json|```", "", ai_text).strip()
-
-        try:
-            result = json.loads(ai_text_clean)
-            print("🧩 [NSFW检测] JSON 解析成功 →", result)
-        except Exception:
-            print("⚠️ [NSFW检测] JSON 解析失败，原文输出：", ai_text_clean[:200], "...")
-            result = {"is_nsfw": None, "score": None, "reason": ai_text_clean}
-
-        return result
+        values = get_redis().mget(keys)
+    except Exception as e:
+        print(f"[NSFW] 读取缓存失败: {e}")
+        return {}
+    return {key: json.loads(value) for key, value in zip(keys, values) if value}
+
+
+def _cache_set(key, result):
+    try:
+        get_redis().set(key, json.dumps(result, ensure_ascii=False), ex=NSFW_CACHE_TTL)
+    except Exception as e:
+        print(f"[NSFW] 写入缓存失败: {e}")
 
+
+# ---------- Gemini ----------
+def _ask_gemini(text):
+    """
+    调用 Gemini 判断，返回 (结果, 是否可以缓存)
+    Gemini 拒绝生成内容或调用异常时保守判定为 NSFW
+    """
+    prompt = (
+        "请判断以下文本是否包含 **严格禁止的内容**："
+        "黄色内容（性描写、性暗示、性器官、性交、口交、调教中的性行为等）"
+        "或政治敏感内容。"
+        "对于暴力、D/s（支配与调教）、羞辱、心理操控、身材/外貌描写等内容可以放行。"
+        f"\n文本：{text}\n"
+        "返回 JSON 格式：{{\"is_nsfw\":true/false,\"score\":0~1,\"reason\":\"…\"}}"
+    )
+    metrics.incr("llm_calls")
+    try:
+        with _llm_slots:
+            response = _get_client().models.generate_content(model=NSFW_MODEL, contents=prompt)
     except Exception as e:
+        metrics.incr("llm_errors")
         print("💥 [NSFW检测] 调用异常 → 保守判定为 NSFW。错误：", e)
         return {
             "is_nsfw": True,
             "score": 1.0,
-            "reason": f"调用异常或安全过滤，保守判定为 NSFW: {e}"
-        }
+            "reason": f"调用异常或安全过滤，保守判定为 NSFW: {e}",
+            "source": "llm",
+            "error": True,
+        }, False
+
+    # 兼容不同字段
+    ai_text = getattr(response, "text", None) or getattr(response, "content", None)
+
+    # 如果 Gemini 拒绝生成内容，则保守判定为 NSFW
+    if not ai_text or not isinstance(ai_text, str) or ai_text.strip() == "":
+        return {
+            "is_nsfw": True,
+            "score": 1.0,
+            "reason": "Gemini 拒绝返回结果，可能因文本包含成人/敏感内容，保守判定为 NSFW",
+            "source": "llm",
+        }, True
+
+    # 去除 ```json 包裹
+    ai_text_clean = re.sub(r"```json|```", "", ai_text).strip()
+    try:
+        result = json.loads(ai_text_clean)
+    except Exception:
+        print("⚠️ [NSFW检测] JSON 解析失败，原文输出：", ai_text_clean[:200], "...")
+        return {"is_nsfw": None, "score": None, "reason": ai_text_clean, "source": "llm"}, False
+    if not isinstance(result, dict):
+        return {"is_nsfw": None, "score": None, "reason": ai_text_clean, "source": "llm"}, False
+    result["source"] = "llm"
+    return result, result.get("is_nsfw") is not None
+
+
+def check_nsfw_batch(texts):
+    """
+    批量检测，返回与 texts 同序的结果列表
+    结果格式：{"is_nsfw": bool/None, "score": 0~1/None, "reason": str, "source": prefilter/cache/llm}
+    调用 Gemini 出现异常时另有 "error": True（审核队列据此重试）
+    """
+    results = [None] * len(texts)
+    lexicon = _get_lexicon()
+    pending = {}  # 缓存 key -> (原文, [下标])
+
+    metrics.incr("checked", len(texts))
+    for index, text in enumerate(texts):
+        if not text:
+            metrics.incr("empty")
+            results[index] = {"is_nsfw": None, "score": None, "reason": "文本为空", "source": "prefilter"}
+            continue
+        normalized = normalize_text(text)
+        result, ambiguous = lexicon.classify(normalized)
+        if not ambiguous:
+            metrics.incr("prefilter_flagged" if result["is_nsfw"] else "prefilter_passed")
+            results[index] = result
+            continue
+        key = _cache_key(normalized)
+        if key in pending:
+            metrics.incr("deduplicated")
+            pending[key][1].append(index)
+        else:
+            pending[key] = (text, [index])
+
+    if not pending:
+        return results
+
+    cached = _cache_get_many(list(pending))
+    metrics.incr("cache_hits", len(cached))
+    metrics.incr("cache_misses", len(pending) - len(cached))
+    misses = []
+    for key, (text, indexes) in pending.items():
+        if key in cached:
+            for index in indexes:
+                results[index] = dict(cached[key], source="cache")
+        else:
+            misses.append((key, text, indexes))
+
+    def run(item):
+        key, text, indexes = item
+        result, cacheable = _ask_gemini(text)
+        if cacheable:
+            _cache_set(key, result)
+        for index in indexes:
+            results[index] = dict(result)
+
+    if len(misses) == 1:
+        run(misses[0])
+    elif misses:
+        with ThreadPoolExecutor(max_workers=min(NSFW_LLM_CONCURRENCY, len(misses))) as pool:
+            list(pool.map(run, misses))
+    return results
+
+
+def is_nsfw(text: str) -> dict:
+    """
+    判断文本是否包含 NSFW 内容（成人、政治敏感等），先本地预筛和查缓存，拿不准的才调用 Gemini。
+    若 Gemini 因安全策略拒绝生成内容或返回异常，则判定为 NSFW。
+    """
+    return check_nsfw_batch([text])[0]
+
+
+def nsfw_stats():
+    return dict(metrics.stats(), pid=os.getpid())
+
+
+@api_view(["GET"])
+@permission_classes([IsAdminUser])
+def nsfw_stats_view(request):
+    """
+    查看处理本次请求的 worker 的 NSFW 检测各阶段命中情况（仅管理员）
+    """
+    return Response({"success": True, "data": nsfw_stats()})
@@ -4,9 +4,15 @@ from django.utils import timezone
 import hashlib
 from urllib.parse import quote,unquote_plus
 import redis
-from django_redis import get_redis_connection
+from chatApp.api.common.connections import lazy_redis
 import random
-from chatApp.models import CharacterCard,RoomImageBinding
+from chatApp.models import CharacterCard,RoomImageBinding,RoomInfo
+from django.db.models.signals import post_save, post_delete
+import json
+from datetime import datetime, timezone as dt_timezone
+from dateutil import parser as date_parser
+from pymongo import ReturnDocument
+from pymongo.errors import OperationFailure
 from base64 import b64encode
 from urllib import parse
 from urllib.parse import urlparse
@@ -16,50 +22,161 @@ from rest_framework.pagination import CursorPagination
 from rest_framework.utils.urls import replace_query_param
 import re
 # 建立 Redis 连接
-redis_client = get_redis_connection('default')
+redis_client = lazy_redis('default')
 
 
-def build_full_image_url(request, uid, room_id, search_tag=None):
+ROOM_IMAGE_CACHE_TTL = 600  # 房间图片/标签信息跨请求缓存时间（秒）
+DEFAULT_IMAGES = ["headimage/default_image1.png", "headimage/default_image2.png"]
+
+
+def normalize_tag(s: str) -> str:
+    """
+    去掉特殊字符，保留中文、英文、数字
+    并将英文转小写
+    """
+    if not s:
+        return ""
+    # URL 解码
+    s = unquote_plus(s)
+    # 去掉非中文、英文、数字字符
+    s = re.sub(r'[^a-zA-Z0-9\u4e00-\u9fa5]', '', s)
+    return s.lower()
+
+
+def _room_image_cache_key(uid, room_id):
+    return f"room_image:{uid}:{room_id}"
+
+
+def _load_room_images(pairs):
+    """
+    批量查询房间绑定的角色卡：RoomImageBinding、CharacterCard 各一条 IN 查询
+    返回 {(uid, room_id): 角色卡信息}，没有绑定的为 {}
+    """
+    room_ids = {room_id for _, room_id in pairs}
+    bindings = {}
+    for row in RoomImageBinding.objects.filter(room_id__in=room_ids).order_by('id')\
+            .values('uid', 'room_id', 'image_id'):
+        # 与原来 .first() 保持一致：同一 (uid, room_id) 取最早的绑定
+        bindings.setdefault((str(row['uid']), row['room_id']), row['image_id'])
+
+    image_ids = {image_id for image_id in bindings.values() if image_id}
+    # 审核中、未通过的角色卡不展示
+    cards = {
+        card['id']: card
+        for card in CharacterCard.objects.filter(id__in=image_ids, review_status='approved')
+        .values('id', 'image_name', 'image_path', 'tags', 'language')
+    }
+
+    result = {}
+    for pair in pairs:
+        card = cards.get(bindings.get(pair))
+        result[pair] = {
+            "image_name": card['image_name'],
+            "image_path": card['image_path'],
+            "tags": card['tags'] or "",
+            "language": card['language'],
+        } if card else {}
+    return result
+
+
+def resolve_room_images(request, pairs):
+    """
+    批量获取房间的角色卡信息
+    查找顺序：本次请求缓存 → Redis 跨请求缓存 → MySQL（两条 IN 查询）
+    """
+    pairs = [(str(uid), room_id) for uid, room_id in pairs]
+
+    request_cache = None
+    if request is not None:
+        request_cache = getattr(request, "_room_image_cache", None)
+        if request_cache is None:
+            request_cache = {}
+            request._room_image_cache = request_cache
+    else:
+        request_cache = {}
+
+    missing = list(dict.fromkeys(pair for pair in pairs if pair not in request_cache))
+    if missing:
+        try:
+            cached = redis_client.mget([_room_image_cache_key(*pair) for pair in missing])
+        except Exception:
+            cached = [None] * len(missing)
+
+        db_pairs = []
+        for pair, value in zip(missing, cached):
+            if value is None:
+                db_pairs.append(pair)
+            else:
+                request_cache[pair] = json.loads(value)
+
+        if db_pairs:
+            loaded = _load_room_images(db_pairs)
+            request_cache.update(loaded)
+            try:
+                pipe = redis_client.pipeline(transaction=False)
+                for pair, info in loaded.items():
+                    pipe.set(_room_image_cache_key(*pair), json.dumps(info, ensure_ascii=False),
+                             ex=ROOM_IMAGE_CACHE_TTL)
+                pipe.execute()
+            except Exception:
+                # 缓存失败不影响主流程
+                pass
+
+    return [request_cache[pair] for pair in pairs]
+
+
+def invalidate_room_images(pairs):
+    """角色卡或绑定变更时删除对应的跨请求缓存"""
+    keys = [_room_image_cache_key(str(uid), room_id) for uid, room_id in pairs if room_id]
+    if not keys:
+        return
+    try:
+        redis_client.delete(*keys)
+    except Exception:
+        pass
+
+
+def _on_binding_changed(sender, instance, **kwargs):
+    invalidate_room_images([(instance.uid, instance.room_id)])
+
+
+def _on_card_changed(sender, instance, **kwargs):
+    bindings = RoomImageBinding.objects.filter(image_id=instance.id).values_list('uid', 'room_id')
+    invalidate_room_images(list(bindings))
+
+
+post_save.connect(_on_binding_changed, sender=RoomImageBinding, dispatch_uid="room_image_binding_saved")
+post_delete.connect(_on_binding_changed, sender=RoomImageBinding, dispatch_uid="room_image_binding_deleted")
+post_save.connect(_on_card_changed, sender=CharacterCard, dispatch_uid="room_image_card_saved")
+post_delete.connect(_on_card_changed, sender=CharacterCard, dispatch_uid="room_image_card_deleted")
+
+
+def default_image_for(key):
+    """按 key（如 room_id）固定选一张默认图，同一个房间每次结果相同"""
+    digest = hashlib.sha1(str(key).encode('utf-8')).digest()
+    return DEFAULT_IMAGES[int.from_bytes(digest[:4], 'big') % len(DEFAULT_IMAGES)]
+
+
+def _build_image_info(card, search_tag=None, default_key=None):
     """
     返回值永远是 dict
     - 匹配用字符串（中文、英文大小写忽略，去掉特殊字符，保留中文）
     - 返回给前端保留原始标签数组
+    - 没有角色卡时用默认图：传了 default_key 按它固定选择（需要持久化的结果用），否则随机
     """
-
-    def normalize_tag(s: str) -> str:
-        """
-        去掉特殊字符，保留中文、英文、数字
-        并将英文转小写
-        """
-        if not s:
-            return ""
-        # URL 解码
-        s = unquote_plus(s)
-        # 去掉非中文、英文、数字字符
-        s = re.sub(r'[^a-zA-Z0-9\u4e00-\u9fa5]', '', s)
-        return s.lower()
-
-    default_images = ["headimage/default_image1.png", "headimage/default_image2.png"]
     site_domain = getattr(settings, "SITE_DOMAIN", "")
 
-    # 查绑定
-    binding = RoomImageBinding.objects.filter(uid=uid, room_id=room_id).first()
-
     image_name = ""
     tags_str = ""
     language = "en"
-    default_path = random.choice(default_images)
+    default_path = default_image_for(default_key) if default_key is not None else random.choice(DEFAULT_IMAGES)
     image_path = f"{site_domain}/media/{quote(default_path, safe='/')}"
 
-    if binding and binding.image_id:
-        card = CharacterCard.objects.filter(id=binding.image_id)\
-            .values('image_name', 'image_path', 'tags', 'language')\
-            .first()
-        if card:
-            image_name = card['image_name']
-            tags_str = card['tags'] or ""  # 原始标签字符串
-            language = card['language']
-            image_path = f"{site_domain}/media/{quote(card['image_path'], safe='/')}"
+    if card:
+        image_name = card['image_name']
+        tags_str = card['tags']  # 原始标签字符串
+        language = card['language']
+        image_path = f"{site_domain}/media/{quote(card['image_path'], safe='/')}"
 
     # 构造前端返回数组
     tags_list = [t.strip() for t in tags_str.split(",") if t.strip()]
@@ -86,7 +203,7 @@ def build_full_image_url(request, uid, room_id, search_tag=None):
 
     # 不匹配 → 返回空图
     if not match:
-        empty_path = f"{site_domain}/media/{quote(random.choice(default_images), safe='/')}"
+        empty_path = f"{site_domain}/media/{quote(random.choice(DEFAULT_IMAGES), safe='/')}"
         empty_info = {
             "image_name": "",
             "image_path": empty_path,
@@ -97,6 +214,142 @@ def build_full_image_url(request, uid, room_id, search_tag=None):
 
     return full_info
 
+
+def build_full_image_urls(request, pairs, search_tag=None):
+    """
+    批量版 build_full_image_url，列表接口使用
+    pairs: [(uid, room_id), ...]，返回与 pairs 顺序一致的 dict 列表
+    """
+    cards = resolve_room_images(request, pairs)
+    return [_build_image_info(card, search_tag) for card in cards]
+
+
+def build_full_image_url(request, uid, room_id, search_tag=None):
+    """
+    单个房间的图片/标签信息，返回结构见 _build_image_info
+    """
+    return build_full_image_urls(request, [(uid, room_id)], search_tag)[0]
+
+def parse_send_date(send_date_str):
+    """
+    将 MongoDB 中的 send_date 字符串解析为 datetime 对象
+    例如 "September 12, 2025 10:30pm" 或 "2025-09-12 22:30:00"
+    """
+    if not send_date_str:
+        return None
+    try:
+        return datetime.strptime(send_date_str, "%B %d, %Y %I:%M%p")
+    except ValueError:
+        try:
+            return datetime.strptime(send_date_str, "%Y-%m-%d %H:%M:%S")
+        except ValueError:
+            return None
+
+
+def normalize_send_date(send_date_str):
+    """
+    写入 MongoDB 时预先把 send_date 转成接口返回的 UTC ISO 字符串（send_date_iso），
+    读取聊天记录时不用再逐条解析
+    """
+    if not send_date_str:
+        return None
+    try:
+        return date_parser.parse(send_date_str).astimezone(dt_timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+    except (ValueError, OverflowError):
+        return None
+
+
+def parse_send_date_iso(send_date_iso):
+    """
+    解析 normalize_send_date 生成的 send_date_iso，返回带 UTC 时区的 datetime
+    兼容早期写入的 "2025-09-12T22:30:00+00:00Z"
+    """
+    if not send_date_iso:
+        return None
+    if send_date_iso.endswith('Z'):
+        send_date_iso = send_date_iso[:-1]
+        if not send_date_iso.endswith('+00:00'):
+            send_date_iso += '+00:00'
+    try:
+        return datetime.fromisoformat(send_date_iso)
+    except ValueError:
+        return None
+
+
+# 已经确认建过索引的房间集合（每个进程只执行一次 create_index）
+_indexed_collections = set()
+
+
+def ensure_room_indexes(collection):
+    """
+    房间聊天集合按 floor 建唯一索引：
+    - 支持 floor > last_floor 的增量查询
+    - 兜底保证同一房间不会出现重复楼层
+    """
+    if collection.name in _indexed_collections:
+        return
+    try:
+        collection.create_index("floor", unique=True)
+    except OperationFailure as e:
+        # 历史数据已有重复楼层时无法建唯一索引，退化为普通索引
+        print(f"[MONGO] {collection.name} 创建 floor 唯一索引失败: {e}")
+        collection.create_index("floor", name="floor_non_unique")
+    _indexed_collections.add(collection.name)
+
+
+FLOOR_COUNTER_COLLECTION = "room_floor_counters"
+
+
+def allocate_floors(db, room_id, count=1):
+    """
+    原子分配楼层号：每个房间一个计数文档，$inc 一次完成，O(1) 且并发不会重复
+    返回分配到的第一个楼层号（连续 count 个）
+    """
+    counters = db[FLOOR_COUNTER_COLLECTION]
+    doc = counters.find_one_and_update(
+        {"_id": room_id},
+        {"$inc": {"seq": count}},
+        return_document=ReturnDocument.AFTER
+    )
+    if doc is None:
+        # 计数器不存在：用房间已有的最大楼层初始化（$max 幂等，并发初始化也安全）
+        from chatApp.api.common.messages import last_floor
+        seed_floor_counter(db, room_id, last_floor(room_id))
+        doc = counters.find_one_and_update(
+            {"_id": room_id},
+            {"$inc": {"seq": count}},
+            return_document=ReturnDocument.AFTER
+        )
+    return doc["seq"] - count + 1
+
+
+def allocate_floor(db, room_id):
+    return allocate_floors(db, room_id, 1)
+
+
+def seed_floor_counter(db, room_id, floor):
+    """把房间计数器推进到至少 floor（用于新建 / 复制房间）"""
+    db[FLOOR_COUNTER_COLLECTION].update_one(
+        {"_id": room_id},
+        {"$max": {"seq": floor}},
+        upsert=True
+    )
+
+
+def update_last_ai_reply(room_id, send_date_str):
+    """
+    写入 AI 消息时同步更新房间的 last_ai_reply_timestamp
+    只会往后推进，单条带索引的 UPDATE
+    """
+    dt = parse_send_date(send_date_str)
+    if not dt:
+        return
+    timestamp = dt.timestamp()
+    RoomInfo.objects.filter(
+        room_id=room_id, last_ai_reply_timestamp__lt=timestamp
+    ).update(last_ai_reply_timestamp=timestamp)
+
+
 def generate_new_room_id(user_id: str, character_name: str) -> str:
     """
     生成分支的 room_id，按 sha1 前16位
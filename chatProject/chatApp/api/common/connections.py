@@ -0,0 +1,202 @@
+"""
+MongoDB / Redis 连接注册表
+- 每个进程首次使用时才创建连接（导入模块不会建立连接）
+- 记录创建时的 pid，gunicorn/uwsgi 预 fork 后子进程会重新创建自己的客户端，不复用父进程的 socket
+- 连接池大小、超时从 settings 读取，连接池使用情况通过 connection_stats() 查看
+
+用法：
+    from chatApp.api.common.connections import mongo_db, get_redis
+    mongo_db[room_id].find_one(...)
+    get_redis("default").get(key)
+"""
+
+import os
+import threading
+
+import redis.asyncio as aioredis
+from django.conf import settings
+from django_redis import get_redis_connection
+from pymongo import MongoClient, monitoring
+from rest_framework.decorators import api_view, permission_classes
+from rest_framework.permissions import IsAdminUser
+from rest_framework.response import Response
+
+_lock = threading.Lock()
+_mongo_client = None
+_mongo_pid = None
+_async_redis = {}  # alias -> (pid, client)
+
+
+class MongoPoolMetrics(monitoring.ConnectionPoolListener):
+    """统计当前进程 Mongo 连接池的使用情况"""
+
+    def __init__(self):
+        self.created = 0
+        self.closed = 0
+        self.checked_out = 0
+        self.checkout_failed = 0
+        self._lock = threading.Lock()
+
+    def _incr(self, name, delta=1):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + delta)
+
+    def connection_created(self, event):
+        self._incr("created")
+
+    def connection_closed(self, event):
+        self._incr("closed")
+
+    def connection_checked_out(self, event):
+        self._incr("checked_out")
+
+    def connection_checked_in(self, event):
+        self._incr("checked_out", -1)
+
+    def connection_check_out_failed(self, event):
+        self._incr("checkout_failed")
+
+    # 以下事件不需要统计
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def stats(self):
+        return {
+            "open": self.created - self.closed,
+            "in_use": self.checked_out,
+            "checkout_failed": self.checkout_failed,
+        }
+
+
+mongo_metrics = MongoPoolMetrics()
+
+
+# ---------- MongoDB ----------
+def get_mongo_client():
+    global _mongo_client, _mongo_pid, mongo_metrics
+    pid = os.getpid()
+    if _mongo_client is None or _mongo_pid != pid:
+        with _lock:
+            if _mongo_client is None or _mongo_pid != pid:
+                # fork 后父进程的客户端不能继续使用，直接丢弃（不 close，避免影响父进程的 socket）
+                mongo_metrics = MongoPoolMetrics()
+                _mongo_client = MongoClient(
+                    settings.MONGO_URI,
+                    maxPoolSize=getattr(settings, "MONGO_MAX_POOL_SIZE", 100),
+                    minPoolSize=getattr(settings, "MONGO_MIN_POOL_SIZE", 0),
+                    maxIdleTimeMS=getattr(settings, "MONGO_MAX_IDLE_TIME_MS", 60000),
+                    connectTimeoutMS=getattr(settings, "MONGO_CONNECT_TIMEOUT_MS", 5000),
+                    socketTimeoutMS=getattr(settings, "MONGO_SOCKET_TIMEOUT_MS", 30000),
+                    serverSelectionTimeoutMS=getattr(settings, "MONGO_SERVER_SELECTION_TIMEOUT_MS", 5000),
+                    waitQueueTimeoutMS=getattr(settings, "MONGO_WAIT_QUEUE_TIMEOUT_MS", 5000),
+                    event_listeners=[mongo_metrics],
+                    connect=False,
+                )
+                _mongo_pid = pid
+    return _mongo_client
+
+
+def get_mongo_db():
+    return get_mongo_client()[settings.MONGO_DB_NAME]
+
+
+class _LazyMongoDatabase:
+    """
+    模块级的 db 代理，兼容原来 db[room_id] / db.xxx 的写法，实际访问时才取当前进程的客户端
+    """
+
+    def __getitem__(self, name):
+        return get_mongo_db()[name]
+
+    def __getattr__(self, name):
+        return getattr(get_mongo_db(), name)
+
+
+mongo_db = _LazyMongoDatabase()
+
+
+# ---------- Redis ----------
+def get_redis(alias="default"):
+    """
+    django-redis 连接（同步）
+    连接池由 django-redis 按进程维护，redis-py 在 fork 后会自动重建连接池
+    """
+    return get_redis_connection(alias)
+
+
+class _LazyRedis:
+    """模块级的 redis_client 代理，导入时不读取缓存配置、不建立连接"""
+
+    def __init__(self, alias):
+        self._alias = alias
+
+    def __getattr__(self, name):
+        return getattr(get_redis(self._alias), name)
+
+
+def lazy_redis(alias="default"):
+    return _LazyRedis(alias)
+
+
+def get_async_redis(alias="default"):
+    """
+    redis.asyncio 客户端，与 django-redis 的同名 alias 使用同一个库
+    每个进程一个客户端（自带连接池），首次使用时创建
+    连接数用满时排队等待空闲连接，而不是直接抛 MaxConnectionsError（连接风暴时会用满）
+    """
+    pid = os.getpid()
+    item = _async_redis.get(alias)
+    if item is None or item[0] != pid:
+        options = settings.CACHES[alias].get("OPTIONS", {}).get("CONNECTION_POOL_KWARGS", {})
+        pool = aioredis.BlockingConnectionPool.from_url(settings.CACHES[alias]["LOCATION"], **options)
+        client = aioredis.Redis(connection_pool=pool)
+        item = _async_redis[alias] = (pid, client)
+    return item[1]
+
+
+# ---------- 监控 ----------
+def _redis_pool_stats(alias):
+    pool = get_redis(alias).connection_pool
+    created = getattr(pool, "_created_connections", 0)
+    available = len(getattr(pool, "_available_connections", []))
+    return {
+        "max": pool.max_connections,
+        "created": created,
+        "in_use": created - available,
+        "available": available,
+    }
+
+
+def connection_stats():
+    """当前进程的连接池使用情况"""
+    stats = {"pid": os.getpid(), "mongo": mongo_metrics.stats() if _mongo_pid == os.getpid() else None, "redis": {}}
+    for alias in settings.CACHES:
+        try:
+            stats["redis"][alias] = _redis_pool_stats(alias)
+        except Exception as e:
+            stats["redis"][alias] = {"error": str(e)}
+    return stats
+
+
+@api_view(["GET"])
+@permission_classes([IsAdminUser])
+def connection_stats_view(request):
+    """
+    查看处理本次请求的 worker 的连接池使用情况（仅管理员）
+    """
+    return Response({"success": True, "data": connection_stats()})
@@ -0,0 +1,334 @@
+"""
+首页信息流物化投影（FeedCard）
+- 每个公开的分支房间（is_show=0, file_branch="branch"）且已有用户消息时对应一张卡片
+- 卡片在写入时生成：房间创建/公开、fork 复制完成、第一条用户消息写入、房主资料或绑定图片变更
+- 信息流请求只按 room_created_at 倒序读取 feed_card 表，不再逐个房间查 Mongo / 用户 / 图片
+
+Redis 分页缓存（卡片变更时逐条更新，不再整体重建）：
+- feed:all / feed:user:{uid}：有序集合，成员 room_id，分数为房间创建时间戳
+- feed:item:{room_id}：预先序列化好的卡片 JSON
+- 翻页：ZREVRANK 定位游标 → ZREVRANGE 取一页 room_id → MGET 取卡片
+- Redis 不可用时查 feed_card 表，按 (room_created_at, id) 键集分页，创建时间相同的房间不会被跳过
+- 游标可以向后（更早的卡片）或向前（previous，更新的卡片）翻页
+"""
+
+import json
+from datetime import datetime
+
+from django.db import transaction
+from django.db.models import Q
+from django.db.models.signals import post_save, post_delete
+from pytz import UTC
+
+from chatApp.models import RoomInfo, ChatUser, CharacterCard, RoomImageBinding, FeedCard
+from chatApp.api.common.common import _load_room_images, _build_image_info
+from chatApp.api.common.messages import first_message_per_room
+from chatApp.api.common.connections import get_redis
+from chatApp.api.common.cache import single_flight
+
+
+def safe_parse_json(data_raw):
+    if isinstance(data_raw, str):
+        if not data_raw.strip():
+            return {}
+        try:
+            return json.loads(data_raw)
+        except json.JSONDecodeError:
+            return {}
+    return data_raw
+
+
+def is_feed_room(room):
+    return room.is_show == 0 and room.file_branch == "branch"
+
+
+def _format_first_message(first_user_doc):
+    data_dict = safe_parse_json(first_user_doc.get("data", {}))
+
+    send_date_str = data_dict.get("send_date")
+    iso_send_date = ""
+    if send_date_str:
+        try:
+            dt_obj = datetime.strptime(send_date_str, "%B %d, %Y %I:%M%p").astimezone(UTC)
+            iso_send_date = dt_obj.isoformat(timespec='seconds') + 'Z'
+        except Exception:
+            iso_send_date = ""
+
+    return {
+        "name": data_dict.get("name"),
+        "is_user": data_dict.get("is_user", 0),
+        "send_date": iso_send_date,
+        "mes": data_dict.get("mes"),
+    }
+
+
+def _user_info(room, user_obj):
+    if user_obj is None:
+        return {
+            "username": room.user_name or "",
+            "nickname": "",
+            "avatar": ""
+        }
+    return {
+        "username": user_obj.username,
+        "nickname": getattr(user_obj, "nickname", "") or "",
+        "avatar": getattr(user_obj, "avatar", "") or ""
+    }
+
+
+def _load_users(uids):
+    ids = {int(uid) for uid in uids if str(uid).isdigit()}
+    return {str(user.id): user for user in ChatUser.objects.filter(id__in=ids)}
+
+
+def refresh_feed_cards(room_ids):
+    """
+    重建指定房间的信息流卡片；不满足条件（未公开、非分支、没有用户消息、已删除）的房间删除卡片
+    """
+    room_ids = {str(room_id) for room_id in room_ids if room_id}
+    if not room_ids:
+        return
+
+    rooms = [room for room in RoomInfo.objects.filter(room_id__in=room_ids) if is_feed_room(room)]
+    first_user_docs = first_message_per_room([room.room_id for room in rooms], {"data.is_user": True})
+    rooms = [room for room in rooms if room.room_id in first_user_docs]
+
+    users = _load_users(room.uid for room in rooms)
+    images = _load_room_images([(str(room.uid), room.room_id) for room in rooms])
+
+    cards = []
+    for room in rooms:
+        first_user_doc = first_user_docs[room.room_id]
+        # 卡片会持久化，没有角色卡时的默认图按 room_id 固定选择，不能在生成时随机
+        image_info = _build_image_info(images.get((str(room.uid), room.room_id)), default_key=room.room_id)
+        cards.append(FeedCard(
+            room_id=room.room_id,
+            uid=room.uid,
+            room_created_at=room.created_at,
+            card={
+                "user": _user_info(room, users.get(str(room.uid))),
+                "card": {
+                    "room_id": room.room_id,
+                    "character_name": room.character_name,
+                    "image": image_info['image_path'],
+                    "title": room.title,
+                    "describe": room.describe,
+                    "file_branch": room.file_branch,
+                    "first_user_message": _format_first_message(first_user_doc),
+                    "data_type": first_user_doc.get("data_type"),
+                    "mes_html": first_user_doc.get("mes_html", ""),
+                }
+            }
+        ))
+
+    removed = list(FeedCard.objects.filter(room_id__in=room_ids).values_list("room_id", "uid"))
+    with transaction.atomic():
+        FeedCard.objects.filter(room_id__in=room_ids).delete()
+        FeedCard.objects.bulk_create(cards)
+    _sync_feed_cache(removed, cards)
+
+
+FEED_ALL_KEY = "feed:all"
+FEED_READY_KEY = "feed:ready"
+FEED_REBUILD_KEY = "feed:rebuild"
+
+
+def _feed_user_key(uid):
+    return f"feed:user:{uid}"
+
+
+def _feed_item_key(room_id):
+    return f"feed:item:{room_id}"
+
+
+def _dump_card(card):
+    return json.dumps(card, ensure_ascii=False, default=str)
+
+
+def _sync_feed_cache(removed, cards):
+    """
+    逐条更新 Redis：removed 为 [(room_id, uid)]，cards 为新写入的 FeedCard
+    """
+    try:
+        pipe = get_redis("default").pipeline(transaction=False)
+        for room_id, uid in removed:
+            pipe.zrem(FEED_ALL_KEY, room_id)
+            pipe.zrem(_feed_user_key(uid), room_id)
+            pipe.delete(_feed_item_key(room_id))
+        for feed_card in cards:
+            score = feed_card.room_created_at.timestamp()
+            pipe.set(_feed_item_key(feed_card.room_id), _dump_card(feed_card.card))
+            pipe.zadd(FEED_ALL_KEY, {feed_card.room_id: score})
+            pipe.zadd(_feed_user_key(feed_card.uid), {feed_card.room_id: score})
+        pipe.execute()
+    except Exception as e:
+        # Redis 写入失败时删除就绪标记，下次读取会从 feed_card 表重建
+        print(f"[FEED] 更新信息流缓存失败: {e}")
+        try:
+            get_redis("default").delete(FEED_READY_KEY)
+        except Exception:
+            pass
+
+
+def _rebuild_feed_cache():
+    redis_client = get_redis("default")
+    keys = [FEED_ALL_KEY] + list(redis_client.scan_iter(match=_feed_user_key("*"), count=1000))
+    redis_client.delete(*keys)
+
+    pipe = redis_client.pipeline(transaction=False)
+    rows = FeedCard.objects.values_list("room_id", "uid", "room_created_at", "card")
+    for i, (room_id, uid, room_created_at, card) in enumerate(rows.iterator(chunk_size=1000), 1):
+        score = room_created_at.timestamp()
+        pipe.set(_feed_item_key(room_id), _dump_card(card))
+        pipe.zadd(FEED_ALL_KEY, {room_id: score})
+        pipe.zadd(_feed_user_key(uid), {room_id: score})
+        if i % 1000 == 0:
+            pipe.execute()
+    pipe.set(FEED_READY_KEY, 1)
+    pipe.execute()
+
+
+def rebuild_feed_cache(wait=3):
+    """
+    从 feed_card 表全量重建 Redis 分页缓存（Redis 被清空或首次上线时）
+    并发请求只有一个 worker 重建，其他请求最多等待 wait 秒
+    返回 False 表示重建尚未完成
+    """
+    redis_client = get_redis("default")
+    single_flight(FEED_REBUILD_KEY, _rebuild_feed_cache, lambda: redis_client.exists(FEED_READY_KEY),
+                  lock_timeout=300, wait=wait)
+    return bool(redis_client.exists(FEED_READY_KEY))
+
+
+def _read_page_from_redis(key, cursor, size, reverse):
+    redis_client = get_redis("default")
+    if not redis_client.exists(FEED_READY_KEY) and not rebuild_feed_cache():
+        return None
+
+    rank = redis_client.zrevrank(key, cursor[1]) if cursor else -1
+    if reverse:
+        # 向前翻页：游标之前（更新）的 size 条，多取一条判断是否还有上一页
+        if rank is None:
+            members = redis_client.zrangebyscore(key, f"({cursor[0]}", "+inf", start=0, num=size + 1,
+                                                 withscores=True)[::-1]
+        else:
+            members = redis_client.zrevrange(key, max(0, rank - size - 1), rank - 1, withscores=True) \
+                if rank > 0 else []
+    elif rank is None:
+        # 游标对应的房间已被移除，按分数继续
+        members = redis_client.zrevrangebyscore(key, f"({cursor[0]}", "-inf", start=0, num=size + 1,
+                                                withscores=True)
+    else:
+        # 多取一条用于判断是否还有下一页
+        members = redis_client.zrevrange(key, rank + 1, rank + 1 + size, withscores=True)
+
+    members = [(score, room_id.decode()) for room_id, score in members]
+    items = redis_client.mget([_feed_item_key(room_id) for _, room_id in members]) if members else []
+    fragments = [item.decode() if item is not None else None for item in items]
+    return members, fragments
+
+
+def _read_page_from_db(uid, cursor, size, reverse):
+    cards = FeedCard.objects.all()
+    if uid is not None:
+        cards = cards.filter(uid=str(uid))
+    if cursor:
+        # 游标只带 (分数, room_id)：用 room_id 取出游标卡片精确的 (room_created_at, id) 作为键集
+        anchor = FeedCard.objects.filter(room_id=cursor[1]).values_list("room_created_at", "id").first()
+        if anchor is None:
+            created_at = datetime.fromtimestamp(cursor[0], tz=UTC)
+            after = Q(room_created_at__gt=created_at) if reverse else Q(room_created_at__lt=created_at)
+        elif reverse:
+            after = Q(room_created_at__gt=anchor[0]) | Q(room_created_at=anchor[0], id__gt=anchor[1])
+        else:
+            after = Q(room_created_at__lt=anchor[0]) | Q(room_created_at=anchor[0], id__lt=anchor[1])
+        cards = cards.filter(after)
+    ordering = ("room_created_at", "id") if reverse else ("-room_created_at", "-id")
+    rows = list(cards.order_by(*ordering).values_list("room_created_at", "room_id", "card")[:size + 1])
+    if reverse:
+        # 按页面顺序（新 → 旧）返回，多出的一条在最前面
+        rows.reverse()
+    members = [(created_at.timestamp(), room_id) for created_at, room_id, _ in rows]
+    return members, [_dump_card(card) for _, _, card in rows]
+
+
+def read_feed_page(uid, cursor, size, reverse=False):
+    """
+    读取一页信息流，uid 为 None 表示全量信息流
+    cursor: (分数, room_id)，None 表示第一页
+        reverse=False：cursor 之后（更早）的一页；reverse=True：cursor 之前（更新）的一页
+    返回 (卡片 JSON 片段列表, 下一页游标, 上一页游标)，上一页游标用 reverse=True 读取
+    """
+    key = FEED_ALL_KEY if uid is None else _feed_user_key(uid)
+    page = None
+    try:
+        page = _read_page_from_redis(key, cursor, size, reverse)
+    except Exception as e:
+        print(f"[FEED] 读取信息流缓存失败，改为查询数据库: {e}")
+    if page is None:
+        page = _read_page_from_db(uid, cursor, size, reverse)
+    members, fragments = page
+
+    # 多取的一条用于判断另一侧是否还有数据
+    has_more = len(members) > size
+    if has_more:
+        if reverse:
+            members, fragments = members[1:], fragments[1:]
+        else:
+            members, fragments = members[:size], fragments[:size]
+    if not members:
+        return [], None, None
+    if reverse:
+        next_cursor, previous_cursor = members[-1], members[0] if has_more else None
+    else:
+        next_cursor, previous_cursor = members[-1] if has_more else None, members[0] if cursor else None
+    return [fragment for fragment in fragments if fragment is not None], next_cursor, previous_cursor
+
+
+def note_user_message(room_id):
+    """
+    写入用户消息后调用：只有房间还没有卡片时才需要生成（第一条用户消息）
+    """
+    if not FeedCard.objects.filter(room_id=room_id).exists():
+        refresh_feed_cards([room_id])
+
+
+# ---------- 房间 / 房主 / 图片变更时维护卡片 ----------
+def _on_room_saved(sender, instance, **kwargs):
+    refresh_feed_cards([instance.room_id])
+
+
+def _on_room_deleted(sender, instance, **kwargs):
+    refresh_feed_cards([instance.room_id])
+
+
+def _on_user_saved(sender, instance, **kwargs):
+    # 登录等操作也会保存用户，只在资料真正变化时更新卡片
+    cards = list(FeedCard.objects.filter(uid=str(instance.pk)))
+    changed = []
+    for feed_card in cards:
+        user_info = _user_info(None, instance)
+        if feed_card.card.get("user") != user_info:
+            feed_card.card["user"] = user_info
+            changed.append(feed_card)
+    if changed:
+        FeedCard.objects.bulk_update(changed, ["card"])
+        _sync_feed_cache([], changed)
+
+
+def _on_binding_changed(sender, instance, **kwargs):
+    refresh_feed_cards([instance.room_id])
+
+
+def _on_card_changed(sender, instance, **kwargs):
+    room_ids = RoomImageBinding.objects.filter(image_id=instance.id).values_list("room_id", flat=True)
+    refresh_feed_cards(list(room_ids))
+
+
+post_save.connect(_on_room_saved, sender=RoomInfo, dispatch_uid="feed_card_room_saved")
+post_delete.connect(_on_room_deleted, sender=RoomInfo, dispatch_uid="feed_card_room_deleted")
+post_save.connect(_on_user_saved, sender=ChatUser, dispatch_uid="feed_card_user_saved")
+post_save.connect(_on_binding_changed, sender=RoomImageBinding, dispatch_uid="feed_card_binding_saved")
+post_delete.connect(_on_binding_changed, sender=RoomImageBinding, dispatch_uid="feed_card_binding_deleted")
+post_save.connect(_on_card_changed, sender=CharacterCard, dispatch_uid="feed_card_card_saved")
+post_delete.connect(_on_card_changed, sender=CharacterCard, dispatch_uid="feed_card_card_deleted")
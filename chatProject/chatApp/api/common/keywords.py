@@ -0,0 +1,51 @@
+"""
+多关键词匹配：Aho-Corasick 自动机，扫描一遍文本找出所有出现过的关键词
+（世界书条目激活、NSFW 本地预筛共用）
+"""
+
+from collections import deque
+
+
+class KeywordMatcher:
+    """Aho-Corasick 自动机：扫描一遍文本，返回出现过的关键词下标"""
+
+    def __init__(self, words):
+        self.goto = [{}]
+        self.fail = [0]
+        self.out = [()]
+        for index, word in enumerate(words):
+            node = 0
+            for ch in word:
+                nxt = self.goto[node].get(ch)
+                if nxt is None:
+                    nxt = len(self.goto)
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.out.append(())
+                    self.goto[node][ch] = nxt
+                node = nxt
+            self.out[node] += (index,)
+
+        # 按层构建失败指针，并把失败指针上的输出合并进来
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, nxt in self.goto[node].items():
+                queue.append(nxt)
+                f = self.fail[node]
+                while f and ch not in self.goto[f]:
+                    f = self.fail[f]
+                self.fail[nxt] = self.goto[f].get(ch, 0)
+                self.out[nxt] += self.out[self.fail[nxt]]
+
+    def search(self, text):
+        goto, fail, out = self.goto, self.fail, self.out
+        found = set()
+        node = 0
+        for ch in text:
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            if out[node]:
+                found.update(out[node])
+        return found
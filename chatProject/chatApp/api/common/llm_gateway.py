@@ -0,0 +1,418 @@
+"""
+进程内的大模型调用网关（OpenAI 兼容接口）
+- 每个进程一个后台事件循环线程 + 一个 AsyncOpenAI 客户端，HTTP 连接池（装了 h2 时走 HTTP/2）在请求之间复用
+- 并发控制：全局同时进行的请求数 LLM_MAX_CONCURRENCY，单个用户 LLM_MAX_PER_USER
+- 排队：超过并发上限的请求排队，按用户轮转唤醒（一个用户连发多条不会占满所有名额）
+    排队人数超过 LLM_MAX_QUEUE、预计等待时间超过截止时间、或等到截止时间仍未轮到时直接拒绝（LLMGatewayBusy）
+- 重试：连接失败、超时、429、5xx 按指数退避重试；流式请求只在收到第一个 token 之前重试
+- 监控：排队人数、进行中的请求数、排队耗时 / 首 token 耗时 / 总耗时分位数，见 llm_stats()
+
+用法（Django 同步视图）：
+    text = get_gateway().complete(user_id, model=..., messages=...)
+    for text in get_gateway().stream(user_id, model=..., messages=...):
+        ...
+用法（Django 异步视图，ASGI 下等待期间不占用线程）：
+    text = await get_gateway().acomplete(user_id, model=..., messages=...)
+    async for text in get_gateway().astream(user_id, model=..., messages=...):
+        ...
+"""
+
+import asyncio
+import os
+import queue
+import random
+import threading
+import time
+from collections import OrderedDict, deque
+
+import httpx
+import openai
+from django.conf import settings
+from openai import AsyncOpenAI
+from rest_framework.decorators import api_view, permission_classes
+from rest_framework.permissions import IsAdminUser
+from rest_framework.response import Response
+
+try:
+    import h2  # noqa: F401  httpx 的 HTTP/2 支持依赖 h2
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+# 可以安全重试的错误（请求还没有产生任何输出）
+RETRYABLE_ERRORS = (openai.APIConnectionError, openai.RateLimitError, openai.InternalServerError)
+
+_lock = threading.Lock()
+_gateway = None
+
+
+class LLMGatewayBusy(Exception):
+    """排队已满或在截止时间前没有轮到"""
+
+
+class _Admission:
+    """
+    并发名额分配（只在网关事件循环线程中使用，不需要加锁）
+    waiters: user -> 等待中的 future 队列，OrderedDict 的顺序就是轮转顺序
+    """
+
+    def __init__(self, max_concurrency, max_per_user, max_queue):
+        self.max_concurrency = max_concurrency
+        self.max_per_user = max_per_user
+        self.max_queue = max_queue
+        self.in_flight = 0
+        self.per_user = {}
+        self.waiters = OrderedDict()
+        self.queued = 0
+
+    def _can_run(self, user):
+        return self.in_flight < self.max_concurrency and self.per_user.get(user, 0) < self.max_per_user
+
+    def _take(self, user):
+        self.in_flight += 1
+        self.per_user[user] = self.per_user.get(user, 0) + 1
+
+    def release(self, user):
+        self.in_flight -= 1
+        count = self.per_user.get(user, 0) - 1
+        if count > 0:
+            self.per_user[user] = count
+        else:
+            self.per_user.pop(user, None)
+        self._dispatch()
+
+    def _dispatch(self):
+        """有空闲名额时按用户轮转唤醒等待者，名额在唤醒前就已占用"""
+        while self.in_flight < self.max_concurrency and self.waiters:
+            for user in list(self.waiters):
+                if self.per_user.get(user, 0) < self.max_per_user:
+                    waiters = self.waiters[user]
+                    future = waiters.popleft()
+                    self.queued -= 1
+                    if waiters:
+                        self.waiters.move_to_end(user)
+                    else:
+                        del self.waiters[user]
+                    self._take(user)
+                    future.set_result(None)
+                    break
+            else:
+                return
+
+    def _remove(self, user, future):
+        waiters = self.waiters.get(user)
+        if waiters and future in waiters:
+            waiters.remove(future)
+            self.queued -= 1
+            if not waiters:
+                del self.waiters[user]
+
+    async def acquire(self, user, deadline):
+        if self._can_run(user):
+            self._take(user)
+            return
+        if self.queued >= self.max_queue:
+            raise LLMGatewayBusy("排队请求过多")
+
+        future = asyncio.get_running_loop().create_future()
+        self.waiters.setdefault(user, deque()).append(future)
+        self.queued += 1
+        try:
+            await asyncio.wait([future], timeout=max(0.0, deadline - time.monotonic()))
+        except asyncio.CancelledError:
+            if future.done():
+                # 刚分到名额就被取消，归还名额
+                self.release(user)
+            else:
+                self._remove(user, future)
+            raise
+        if not future.done():
+            self._remove(user, future)
+            raise LLMGatewayBusy("排队超时")
+
+
+class _Window:
+    """最近 N 次耗时（秒）"""
+
+    def __init__(self, size=1000):
+        self.values = deque(maxlen=size)
+
+    def add(self, value):
+        self.values.append(value)
+
+    def mean(self):
+        return sum(self.values) / len(self.values) if self.values else 0.0
+
+    def summary(self):
+        values = sorted(self.values)
+        if not values:
+            return {"count": 0}
+
+        def pct(p):
+            return round(values[min(len(values) - 1, int(len(values) * p))] * 1000, 1)
+
+        return {"count": len(values), "avg_ms": round(self.mean() * 1000, 1), "p50_ms": pct(0.5),
+                "p95_ms": pct(0.95), "max_ms": round(values[-1] * 1000, 1)}
+
+
+class LLMMetrics:
+    COUNTERS = ("requests", "completed", "failed", "rejected", "retries", "cancelled")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = dict.fromkeys(self.COUNTERS, 0)
+        self.queue_wait = _Window()
+        self.first_token = _Window()
+        self.latency = _Window()
+
+    def incr(self, name):
+        with self._lock:
+            self.counters[name] += 1
+
+    def observe(self, window, seconds):
+        with self._lock:
+            getattr(self, window).add(seconds)
+
+    def mean_latency(self):
+        with self._lock:
+            return self.latency.mean()
+
+    def stats(self):
+        with self._lock:
+            return {
+                **self.counters,
+                "queue_wait": self.queue_wait.summary(),
+                "first_token": self.first_token.summary(),
+                "latency": self.latency.summary(),
+            }
+
+
+class LLMGateway:
+    def __init__(self):
+        self.max_concurrency = getattr(settings, "LLM_MAX_CONCURRENCY", 32)
+        self.queue_timeout = getattr(settings, "LLM_QUEUE_TIMEOUT", 30)
+        self.max_retries = getattr(settings, "LLM_MAX_RETRIES", 2)
+        self.retry_base_delay = getattr(settings, "LLM_RETRY_BASE_DELAY", 0.5)
+        self.retry_max_delay = getattr(settings, "LLM_RETRY_MAX_DELAY", 8)
+        self.admission = _Admission(self.max_concurrency, getattr(settings, "LLM_MAX_PER_USER", 2),
+                                    getattr(settings, "LLM_MAX_QUEUE", 200))
+        self.metrics = LLMMetrics()
+
+        self.loop = asyncio.new_event_loop()
+        self.client = None
+        self.thread = threading.Thread(target=self._run_loop, name="llm-gateway", daemon=True)
+        self.thread.start()
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def _get_client(self):
+        # 在事件循环线程中创建，连接池绑定在这个循环上
+        if self.client is None:
+            http_client = httpx.AsyncClient(
+                http2=HTTP2_AVAILABLE,
+                limits=httpx.Limits(max_connections=self.max_concurrency,
+                                    max_keepalive_connections=self.max_concurrency,
+                                    keepalive_expiry=getattr(settings, "LLM_KEEPALIVE_EXPIRY", 60)),
+                timeout=httpx.Timeout(getattr(settings, "LLM_REQUEST_TIMEOUT", 600),
+                                      connect=getattr(settings, "LLM_CONNECT_TIMEOUT", 10)),
+            )
+            self.client = AsyncOpenAI(api_key=settings.LLM_API_KEY, base_url=settings.LLM_BASE_URL,
+                                      max_retries=0, http_client=http_client)
+        return self.client
+
+    # ---------- 事件循环线程内 ----------
+    async def _admit(self, user, deadline):
+        self.metrics.incr("requests")
+        queued_at = time.monotonic()
+        if self.admission.queued:
+            # 按平均耗时估算排队时间，明显等不到就不排了
+            estimated = (self.admission.queued + 1) / self.max_concurrency * self.metrics.mean_latency()
+            if queued_at + estimated > deadline:
+                self.metrics.incr("rejected")
+                raise LLMGatewayBusy("预计排队时间超过截止时间")
+        try:
+            await self.admission.acquire(user, deadline)
+        except LLMGatewayBusy:
+            self.metrics.incr("rejected")
+            raise
+        self.metrics.observe("queue_wait", time.monotonic() - queued_at)
+
+    async def _create(self, kwargs, stream):
+        attempt = 0
+        while True:
+            try:
+                return await self._get_client().chat.completions.create(**kwargs, stream=stream)
+            except RETRYABLE_ERRORS as e:
+                if attempt >= self.max_retries:
+                    raise
+                delay = min(self.retry_max_delay, self.retry_base_delay * 2 ** attempt) * random.uniform(0.5, 1)
+                attempt += 1
+                self.metrics.incr("retries")
+                print(f"[LLM] 调用失败，{delay:.1f}s 后第 {attempt} 次重试: {e}")
+                await asyncio.sleep(delay)
+
+    async def _complete(self, user, kwargs, deadline):
+        await self._admit(user, deadline)
+        started = time.monotonic()
+        try:
+            response = await self._create(kwargs, stream=False)
+        except asyncio.CancelledError:
+            self.metrics.incr("cancelled")
+            raise
+        except Exception:
+            self.metrics.incr("failed")
+            raise
+        finally:
+            self.admission.release(user)
+        self.metrics.incr("completed")
+        self.metrics.observe("latency", time.monotonic() - started)
+        return response.choices[0].message.content
+
+    async def _stream(self, user, kwargs, deadline, put):
+        """put(("delta", 文本) / ("end", None) / ("error", 异常)) 把结果交给调用方"""
+        try:
+            await self._admit(user, deadline)
+        except Exception as e:
+            put(("error", e))
+            return
+
+        started = time.monotonic()
+        first = True
+        try:
+            response = await self._create(kwargs, stream=True)
+            try:
+                async for chunk in response:
+                    if not chunk.choices:
+                        continue
+                    text = chunk.choices[0].delta.content
+                    if text:
+                        if first:
+                            self.metrics.observe("first_token", time.monotonic() - started)
+                            first = False
+                        put(("delta", text))
+            finally:
+                # 正常结束或被取消都关闭上游连接
+                await response.close()
+            self.metrics.incr("completed")
+            self.metrics.observe("latency", time.monotonic() - started)
+            put(("end", None))
+        except asyncio.CancelledError:
+            self.metrics.incr("cancelled")
+            raise
+        except Exception as e:
+            self.metrics.incr("failed")
+            put(("error", e))
+        finally:
+            self.admission.release(user)
+
+    # ---------- 同步接口（Django 视图线程调用） ----------
+    def _deadline(self, queue_timeout):
+        return time.monotonic() + (self.queue_timeout if queue_timeout is None else queue_timeout)
+
+    def complete(self, user, queue_timeout=None, **kwargs):
+        """非流式调用，返回回复文本；排队失败抛出 LLMGatewayBusy"""
+        future = asyncio.run_coroutine_threadsafe(
+            self._complete(user, kwargs, self._deadline(queue_timeout)), self.loop)
+        try:
+            return future.result()
+        except BaseException:
+            future.cancel()
+            raise
+
+    def stream(self, user, queue_timeout=None, **kwargs):
+        """
+        流式调用，逐段返回文本；调用方提前关闭生成器（客户端断开）时取消上游请求
+        """
+        out = queue.Queue()
+        future = asyncio.run_coroutine_threadsafe(
+            self._stream(user, kwargs, self._deadline(queue_timeout), out.put), self.loop)
+        try:
+            while True:
+                kind, value = out.get()
+                if kind == "delta":
+                    yield value
+                elif kind == "end":
+                    return
+                else:
+                    raise value
+        finally:
+            if not future.done():
+                future.cancel()
+
+    # ---------- 异步接口（Django 异步视图调用） ----------
+    async def acomplete(self, user, queue_timeout=None, **kwargs):
+        """非流式调用的异步版本，在调用方的事件循环中等待；调用方被取消时取消上游请求"""
+        future = asyncio.run_coroutine_threadsafe(
+            self._complete(user, kwargs, self._deadline(queue_timeout)), self.loop)
+        try:
+            return await asyncio.wrap_future(future)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+
+    async def astream(self, user, queue_timeout=None, **kwargs):
+        """
+        流式调用的异步版本（async for），在调用方的事件循环中等待网关线程推送的文本
+        调用方被取消（ASGI 下客户端断开时 Django 取消响应任务）或提前关闭生成器时取消上游请求
+        """
+        loop = asyncio.get_running_loop()
+        out = asyncio.Queue()
+
+        def put(item):
+            if not loop.is_closed():
+                loop.call_soon_threadsafe(out.put_nowait, item)
+
+        future = asyncio.run_coroutine_threadsafe(
+            self._stream(user, kwargs, self._deadline(queue_timeout), put), self.loop)
+        try:
+            while True:
+                kind, value = await out.get()
+                if kind == "delta":
+                    yield value
+                elif kind == "end":
+                    return
+                else:
+                    raise value
+        finally:
+            if not future.done():
+                future.cancel()
+
+    def stats(self):
+        admission = self.admission
+        return {
+            "http2": HTTP2_AVAILABLE,
+            "in_flight": admission.in_flight,
+            "queued": admission.queued,
+            "queued_users": len(admission.waiters),
+            "max_concurrency": admission.max_concurrency,
+            "max_per_user": admission.max_per_user,
+            **self.metrics.stats(),
+        }
+
+
+def get_gateway():
+    """每个进程一个网关（fork 后子进程重新创建，不复用父进程的事件循环线程）"""
+    global _gateway
+    pid = os.getpid()
+    if _gateway is None or _gateway[0] != pid:
+        with _lock:
+            if _gateway is None or _gateway[0] != pid:
+                _gateway = (pid, LLMGateway())
+    return _gateway[1]
+
+
+def llm_stats():
+    if _gateway is None or _gateway[0] != os.getpid():
+        return None
+    return dict(_gateway[1].stats(), pid=os.getpid())
+
+
+@api_view(["GET"])
+@permission_classes([IsAdminUser])
+def llm_stats_view(request):
+    """
+    查看处理本次请求的 worker 的大模型网关排队和耗时情况（仅管理员）
+    """
+    return Response({"success": True, "data": llm_stats()})
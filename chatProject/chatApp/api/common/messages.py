@@ -0,0 +1,229 @@
+"""
+聊天消息存储（仓库层）
+所有读写聊天记录的地方都通过这里访问 MongoDB，不再直接 db[room_id]
+
+两种存储模式（settings.CHAT_STORAGE_MODE）：
+- per_room（默认）：每个房间一个集合，集合名就是 room_id（原有方式）
+- consolidated：所有消息放在同一个 messages 集合
+    索引 (room_id, floor) 唯一、(room_id, data_type, send_ts)
+    集合数量固定，跨房间查询（例如所有房间最后一条 AI 消息）一次聚合完成
+
+每条消息写入时记录 token_count（data.mes 的估算 token 数，见 tokens.py），拼接上下文时不再重复计算
+
+切换步骤：
+    1. python manage.py migrate_chat_messages          # 复制历史数据（可中断、可重复执行）
+    2. 设置 CHAT_STORAGE_MODE = "consolidated" 并重启
+    3. 再执行一次 migrate_chat_messages，补齐切换期间写入旧集合的消息
+"""
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from pymongo import UpdateOne
+from pymongo.errors import OperationFailure
+
+from chatApp.api.common.common import parse_send_date, parse_send_date_iso, ensure_room_indexes, seed_floor_counter
+from chatApp.api.common.connections import mongo_db
+from chatApp.api.common.tokens import TOKEN_ESTIMATOR_VERSION, message_tokens
+
+MESSAGES_COLLECTION = "messages"
+
+_messages_indexed = False
+
+
+def is_consolidated():
+    return getattr(settings, "CHAT_STORAGE_MODE", "per_room") == "consolidated"
+
+
+def _scope(room_id):
+    """返回 (集合, 房间过滤条件)"""
+    room_id = str(room_id)
+    if is_consolidated():
+        return mongo_db[MESSAGES_COLLECTION], {"room_id": room_id}
+    return mongo_db[room_id], {}
+
+
+def ensure_messages_indexes():
+    """
+    messages 集合的复合索引（每个进程只执行一次 create_index）
+    copy_history 的 $merge 按 (room_id, floor) 匹配，必须有唯一索引：
+    建不出来（已有重复楼层、残留同键的非唯一索引）时抛 ImproperlyConfigured，不以 consolidated 模式继续读写
+    """
+    global _messages_indexed
+    if _messages_indexed:
+        return
+    collection = mongo_db[MESSAGES_COLLECTION]
+    try:
+        collection.create_index([("room_id", 1), ("floor", 1)], unique=True, name="room_floor")
+    except OperationFailure as e:
+        raise ImproperlyConfigured(
+            f"messages 集合无法创建 (room_id, floor) 唯一索引，consolidated 模式不可用: {e}；"
+            "请先清理重复楼层（或删除同键的非唯一索引）后执行 python manage.py ensure_chat_indexes"
+        ) from e
+    collection.create_index([("room_id", 1), ("data_type", 1), ("send_ts", 1)], name="room_type_send_ts")
+    _messages_indexed = True
+
+
+def ensure_indexes(room_id):
+    if is_consolidated():
+        ensure_messages_indexes()
+    else:
+        ensure_room_indexes(mongo_db[str(room_id)])
+
+
+def send_timestamp(doc):
+    """消息发送时间的时间戳（send_ts），优先用写入时生成的 send_date_iso"""
+    dt = parse_send_date_iso(doc.get("send_date_iso")) or parse_send_date((doc.get("data") or {}).get("send_date"))
+    return dt.timestamp() if dt else None
+
+
+def _token_fields(doc):
+    return {
+        "token_count": message_tokens((doc.get("data") or {}).get("mes")),
+        "token_count_v": TOKEN_ESTIMATOR_VERSION,
+    }
+
+
+# ---------- 写 ----------
+def insert_message(room_id, doc):
+    collection, _ = _scope(room_id)
+    ensure_indexes(room_id)
+    doc = dict(doc, room_id=str(room_id))
+    if "send_ts" not in doc:
+        doc["send_ts"] = send_timestamp(doc)
+    if "token_count" not in doc:
+        doc.update(_token_fields(doc))
+    return collection.insert_one(doc)
+
+
+def copy_history(origin_room_id, new_room_id, floor, overrides):
+    """
+    服务端复制聊天记录：聚合管道 $match floor<=N → $merge 到新房间
+    数据不经过应用服务器，不占用 Django 进程内存
+    按楼层匹配（目标集合有 floor / (room_id, floor) 唯一索引），已存在的楼层保留：中断后重新执行是幂等的
+    """
+    new_room_id = str(new_room_id)
+    overrides = dict(overrides, room_id=new_room_id)
+    collection, base = _scope(origin_room_id)
+    ensure_indexes(new_room_id)
+
+    if is_consolidated():
+        merge = {"into": MESSAGES_COLLECTION, "on": ["room_id", "floor"]}
+    else:
+        merge = {"into": new_room_id, "on": "floor"}
+    merge.update({"whenMatched": "keepExisting", "whenNotMatched": "insert"})
+
+    collection.aggregate([
+        {"$match": {**base, "floor": {"$lte": floor}}},
+        {"$unset": "_id"},
+        # $literal 防止用户名等以 $ 开头时被当成字段路径
+        {"$set": {key: {"$literal": value} for key, value in overrides.items()}},
+        {"$merge": merge},
+    ], allowDiskUse=True)
+
+    # 新房间的楼层计数器从复制过来的最后一楼开始
+    seed_floor_counter(mongo_db, new_room_id, floor)
+
+
+def bulk_update_messages(room_id, ops):
+    """批量更新一个房间的消息（UpdateOne 等，按 _id 定位），无序执行，返回 BulkWriteResult"""
+    if not ops:
+        return None
+    collection, _ = _scope(room_id)
+    return collection.bulk_write(ops, ordered=False)
+
+
+# ---------- 读 ----------
+def find_messages(room_id, query=None, projection=None, sort=None, limit=0):
+    """返回游标，query 中不需要带 room_id"""
+    collection, base = _scope(room_id)
+    cursor = collection.find({**base, **(query or {})}, projection)
+    if sort:
+        cursor = cursor.sort(sort)
+    if limit:
+        cursor = cursor.limit(limit)
+    return cursor
+
+
+def find_one_message(room_id, query=None, projection=None, sort=None):
+    collection, base = _scope(room_id)
+    return collection.find_one({**base, **(query or {})}, projection, sort=sort)
+
+
+def latest_messages(room_id, count, query=None, projection=None):
+    """最新的 count 条消息，按楼层从旧到新返回"""
+    records = list(find_messages(room_id, query, projection, sort=[("floor", -1)], limit=count))
+    records.reverse()
+    return records
+
+
+HISTORY_PROJECTION = {"floor": 1, "data.is_user": 1, "data.mes": 1, "token_count": 1, "token_count_v": 1}
+
+
+def history_within_budget(room_id, budget, max_messages=200):
+    """
+    从最新一条往前取消息，直到 token 预算用完（最新一条无论多长都会返回）
+    没有 token_count 的旧消息现场估算并写回，下次直接使用
+    返回 (按楼层从旧到新的消息, 已用 token 数)
+    """
+    collection, _ = _scope(room_id)
+    cursor = find_messages(room_id, projection=HISTORY_PROJECTION, sort=[("floor", -1)],
+                           limit=max_messages).batch_size(50)
+    records, used, backfill = [], 0, []
+    try:
+        for doc in cursor:
+            if doc.get("token_count_v") == TOKEN_ESTIMATOR_VERSION:
+                tokens = doc["token_count"]
+            else:
+                fields = _token_fields(doc)
+                tokens = fields["token_count"]
+                backfill.append(UpdateOne({"_id": doc["_id"]}, {"$set": fields}))
+            if records and used + tokens > budget:
+                break
+            records.append(doc)
+            used += tokens
+    finally:
+        cursor.close()
+
+    if backfill:
+        try:
+            collection.bulk_write(backfill, ordered=False)
+        except Exception as e:
+            print(f"[MONGO] 回写 token_count 失败 {room_id}: {e}")
+
+    records.reverse()
+    return records, used
+
+
+def last_floor(room_id):
+    doc = find_one_message(room_id, projection={"floor": 1}, sort=[("floor", -1)])
+    return (doc or {}).get("floor", 0)
+
+
+def first_message_per_room(room_ids, query=None, projection=None, latest=False):
+    """
+    每个房间按楼层取第一条（latest=True 取最后一条）符合条件的消息
+    返回 {room_id: doc}；consolidated 模式下一次聚合完成
+    """
+    room_ids = [str(room_id) for room_id in room_ids]
+    if not room_ids:
+        return {}
+    direction = -1 if latest else 1
+
+    if not is_consolidated():
+        result = {}
+        for room_id in room_ids:
+            doc = find_one_message(room_id, query, projection, sort=[("floor", direction)])
+            if doc:
+                result[room_id] = doc
+        return result
+
+    pipeline = [
+        {"$match": {"room_id": {"$in": room_ids}, **(query or {})}},
+        {"$sort": {"room_id": 1, "floor": direction}},
+        {"$group": {"_id": "$room_id", "doc": {"$first": "$$ROOT"}}},
+        {"$replaceRoot": {"newRoot": "$doc"}},
+    ]
+    if projection:
+        pipeline.append({"$project": dict(projection, room_id=1)})
+    docs = mongo_db[MESSAGES_COLLECTION].aggregate(pipeline, allowDiskUse=True)
+    return {doc["room_id"]: doc for doc in docs}
@@ -0,0 +1,368 @@
+"""
+内容审核队列：NSFW 检测放到后台执行，请求线程只提交任务，不再等待模型返回
+- submit_moderation(kind, target_id, text)：提交任务后立即返回，审核结果交给 kind 对应的回调
+  回调签名 callback(target_id, result)，result 为 check_nsfw 的检测结果
+- 后端（settings.MODERATION_BACKEND）：
+  redis：Redis Streams + 消费组，由 python manage.py moderation_worker 消费；
+         worker 中途退出时未确认的任务超过 MODERATION_CLAIM_IDLE 秒后由其他 worker 认领
+  local：进程内队列 + 后台线程（开发、测试用，进程退出时未处理的任务丢失）
+- 模型调用异常、结果无法解析、回调出错时延迟重新入队（MODERATION_RETRY_DELAY 秒起按次数翻倍），最多 MODERATION_MAX_ATTEMPTS 次
+  延迟中的任务放在 Redis 有序集合（local 后端为进程内的堆），到期后由 worker 读取时移回队列
+- 积压情况见 moderation_stats() / api/ops/moderation_stats/（队列长度、未确认数、lag、最早积压任务的等待秒数）
+"""
+
+import heapq
+import json
+import os
+import queue
+import socket
+import threading
+import time
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils.module_loading import import_string
+from redis.exceptions import ResponseError
+from rest_framework.decorators import api_view, permission_classes
+from rest_framework.permissions import IsAdminUser
+from rest_framework.response import Response
+
+from chatApp.api.common.check_nsfw import check_nsfw_batch
+from chatApp.api.common.connections import get_redis
+
+MODERATION_STREAM = "moderation:jobs"
+MODERATION_DELAYED = "moderation:delayed"
+MODERATION_GROUP = "moderation"
+MODERATION_BACKEND = getattr(settings, "MODERATION_BACKEND", "redis")
+MODERATION_STREAM_MAXLEN = getattr(settings, "MODERATION_STREAM_MAXLEN", 100000)
+MODERATION_MAX_ATTEMPTS = getattr(settings, "MODERATION_MAX_ATTEMPTS", 3)
+MODERATION_CLAIM_IDLE = getattr(settings, "MODERATION_CLAIM_IDLE", 300)
+MODERATION_BATCH_SIZE = getattr(settings, "MODERATION_BATCH_SIZE", 16)
+MODERATION_RETRY_DELAY = getattr(settings, "MODERATION_RETRY_DELAY", 30)
+
+# 把到期的延迟任务移回 stream：ZREM 成功的才 XADD，多个 worker 同时执行也不会重复入队
+# 集合成员是任务的 JSON，带随机 nonce 避免相同任务被合并，移回时去掉
+PROMOTE_DELAYED_LUA = """
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, tonumber(ARGV[2]))
+local moved = 0
+for _, member in ipairs(due) do
+    if redis.call('ZREM', KEYS[1], member) == 1 then
+        local job = cjson.decode(member)
+        local fields = {}
+        for key, value in pairs(job) do
+            if key ~= 'nonce' then
+                table.insert(fields, key)
+                table.insert(fields, value)
+            end
+        end
+        redis.call('XADD', KEYS[2], 'MAXLEN', '~', ARGV[3], '*', unpack(fields))
+        moved = moved + 1
+    end
+end
+return moved
+"""
+
+# kind -> 回调（可以是 import 路径，第一次使用时导入，worker 进程不需要预先导入各业务模块）
+_handlers = {
+    "character_card": "chatApp.api.anchor.card.on_card_reviewed",
+}
+
+
+def register_moderation_handler(kind, callback):
+    _handlers[kind] = callback
+
+
+def _get_handler(kind):
+    handler = _handlers.get(kind)
+    if isinstance(handler, str):
+        handler = _handlers[kind] = import_string(handler)
+    return handler
+
+
+def _decode(value):
+    return value.decode("utf-8") if isinstance(value, bytes) else value
+
+
+def retry_delay(attempts):
+    """第 attempts 次失败后的重试延迟：MODERATION_RETRY_DELAY、2 倍、4 倍……"""
+    return MODERATION_RETRY_DELAY * 2 ** (attempts - 1)
+
+
+class RedisStreamBackend:
+    """Redis Streams + 消费组，所有 worker 共享一个队列"""
+
+    name = "redis"
+
+    def __init__(self, stream=MODERATION_STREAM, group=MODERATION_GROUP, alias="default", delayed=MODERATION_DELAYED):
+        self.stream = stream
+        self.group = group
+        self.delayed = delayed
+        self.alias = alias
+        self._group_ready = False
+
+    def _redis(self):
+        return get_redis(self.alias)
+
+    def _ensure_group(self):
+        if self._group_ready:
+            return
+        try:
+            self._redis().xgroup_create(self.stream, self.group, id="0", mkstream=True)
+        except ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+        self._group_ready = True
+
+    def submit(self, job, delay=0):
+        """delay > 0 时先放进延迟集合，到期后才进入 stream（返回 None）"""
+        if delay > 0:
+            member = json.dumps({**job, "nonce": os.urandom(8).hex()}, sort_keys=True)
+            self._redis().zadd(self.delayed, {member: time.time() + delay})
+            return None
+        return _decode(self._redis().xadd(self.stream, job, maxlen=MODERATION_STREAM_MAXLEN, approximate=True))
+
+    def promote_delayed(self, count):
+        redis_client = self._redis()
+        return redis_client.register_script(PROMOTE_DELAYED_LUA)(
+            keys=[self.delayed, self.stream], args=[time.time(), count, MODERATION_STREAM_MAXLEN]
+        )
+
+    def read(self, consumer, count, block):
+        """
+        返回 [(任务 id, 任务)]：先把到期的延迟任务移回 stream，再认领超时未确认的任务，没有再读新任务（最多阻塞 block 秒）
+        """
+        self._ensure_group()
+        self.promote_delayed(count)
+        redis_client = self._redis()
+        claimed = redis_client.xautoclaim(self.stream, self.group, consumer,
+                                          min_idle_time=int(MODERATION_CLAIM_IDLE * 1000), count=count)
+        messages = [item for item in claimed[1] if item[1]]
+        if not messages:
+            response = redis_client.xreadgroup(self.group, consumer, {self.stream: ">"}, count=count,
+                                               block=int(block * 1000))
+            messages = response[0][1] if response else []
+        return [(_decode(msg_id), {_decode(k): _decode(v) for k, v in fields.items()})
+                for msg_id, fields in messages]
+
+    def ack(self, ids):
+        if ids:
+            redis_client = self._redis()
+            redis_client.xack(self.stream, self.group, *ids)
+            redis_client.xdel(self.stream, *ids)
+
+    def stats(self):
+        self._ensure_group()
+        redis_client = self._redis()
+        now_ms = time.time() * 1000
+        group = next((g for g in redis_client.xinfo_groups(self.stream) if _decode(g["name"]) == self.group), {})
+        pending = redis_client.xpending(self.stream, self.group)
+        # 还没有分配给任何 worker 的第一条任务
+        last_delivered = _decode(group.get("last-delivered-id")) or "0-0"
+        waiting = redis_client.xrange(self.stream, min=f"({last_delivered}", count=1)
+
+        def age(msg_id):
+            return round((now_ms - int(_decode(msg_id).split("-")[0])) / 1000, 1) if msg_id else 0
+
+        return {
+            "length": redis_client.xlen(self.stream),
+            "delayed": redis_client.zcard(self.delayed),
+            "lag": group.get("lag"),
+            "pending": pending["pending"],
+            "consumers": group.get("consumers", 0),
+            "oldest_waiting_seconds": age(waiting[0][0] if waiting else None),
+            "oldest_pending_seconds": age(pending.get("min")),
+        }
+
+
+class LocalBackend:
+    """进程内队列（开发、测试用），提交时自动启动后台 worker 线程"""
+
+    name = "local"
+
+    def __init__(self, threads=1):
+        self.queue = queue.Queue()
+        self.threads = threads
+        self.in_flight = 0
+        self.delayed = []  # 堆：(到期时间, 任务 id, 任务)
+        self._lock = threading.Lock()
+        self._next_id = 0
+        self._started = False
+
+    def submit(self, job, delay=0):
+        with self._lock:
+            self._next_id += 1
+            msg_id = f"{self._next_id}-0"
+            if not self._started:
+                self._started = True
+                for i in range(self.threads):
+                    threading.Thread(target=ModerationWorker(self, f"local-{i}").run, daemon=True).start()
+            if delay > 0:
+                heapq.heappush(self.delayed, (time.monotonic() + delay, self._next_id, dict(job)))
+                return None
+        self.queue.put((msg_id, dict(job)))
+        return msg_id
+
+    def promote_delayed(self, count):
+        moved = 0
+        with self._lock:
+            while self.delayed and self.delayed[0][0] <= time.monotonic() and moved < count:
+                _, next_id, job = heapq.heappop(self.delayed)
+                self.queue.put((f"{next_id}-0", job))
+                moved += 1
+        return moved
+
+    def read(self, consumer, count, block):
+        self.promote_delayed(count)
+        messages = []
+        try:
+            messages.append(self.queue.get(timeout=block))
+            while len(messages) < count:
+                messages.append(self.queue.get_nowait())
+        except queue.Empty:
+            pass
+        with self._lock:
+            self.in_flight += len(messages)
+        return messages
+
+    def ack(self, ids):
+        with self._lock:
+            self.in_flight -= len(ids)
+
+    def join(self, timeout=10):
+        """等待队列处理完（测试用）"""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            with self._lock:
+                if self.queue.empty() and self.in_flight == 0 and not self.delayed:
+                    return True
+            time.sleep(0.01)
+        return False
+
+    def stats(self):
+        with self._lock:
+            return {"length": self.queue.qsize() + self.in_flight, "delayed": len(self.delayed),
+                    "lag": self.queue.qsize(), "pending": self.in_flight, "consumers": self.threads if self._started else 0}
+
+
+class ModerationMetrics:
+    COUNTERS = ("submitted", "processed", "retried", "dropped", "handler_errors")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = dict.fromkeys(self.COUNTERS, 0)
+
+    def incr(self, name, count=1):
+        if count:
+            with self._lock:
+                self.counters[name] += count
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters)
+
+
+metrics = ModerationMetrics()
+
+
+class ModerationWorker:
+    """
+    从后端取一批任务 → check_nsfw_batch 批量检测（相同文本只调用一次模型）→ 调用回调 → 确认
+    """
+
+    def __init__(self, backend, consumer, batch_size=MODERATION_BATCH_SIZE, block=5):
+        self.backend = backend
+        self.consumer = consumer
+        self.batch_size = batch_size
+        self.block = block
+
+    def run_once(self):
+        messages = self.backend.read(self.consumer, self.batch_size, self.block)
+        if not messages:
+            return 0
+        results = check_nsfw_batch([job.get("text") or "" for _, job in messages])
+        for (msg_id, job), result in zip(messages, results):
+            self._handle(job, result)
+        self.backend.ack([msg_id for msg_id, _ in messages])
+        metrics.incr("processed", len(messages))
+        return len(messages)
+
+    def _handle(self, job, result):
+        attempts = int(job.get("attempts") or 1)
+        # 模型调用异常或结果无法解析：还有次数就延迟重新入队，否则按当前结果交给回调
+        # （角色卡回调：调用异常保持待审核，无法解析按不通过处理）
+        uncertain = result.get("error") or (result.get("is_nsfw") is None and job.get("text"))
+        if uncertain and attempts < MODERATION_MAX_ATTEMPTS:
+            self._retry(job, attempts)
+            return
+        handler = _get_handler(job.get("kind"))
+        if handler is None:
+            print(f"[MODERATION] 未注册的任务类型 {job.get('kind')}，丢弃")
+            metrics.incr("dropped")
+            return
+        try:
+            handler(job.get("target"), result)
+        except Exception as e:
+            metrics.incr("handler_errors")
+            print(f"[MODERATION] 处理 {job.get('kind')}:{job.get('target')} 结果失败: {e}")
+            if attempts < MODERATION_MAX_ATTEMPTS:
+                self._retry(job, attempts)
+            else:
+                metrics.incr("dropped")
+
+    def _retry(self, job, attempts):
+        """延迟重新入队：模型短时不可用时，不会在几秒内把重试次数用完"""
+        metrics.incr("retried")
+        self.backend.submit(dict(job, attempts=str(attempts + 1)), delay=retry_delay(attempts))
+
+    def run(self, stop_event=None):
+        """
+        长期运行的线程：每批前后关闭超时、出错的数据库连接，
+        否则空闲超过 MySQL wait_timeout 后回调中的 ORM 写入会报 "server has gone away"
+        """
+        while stop_event is None or not stop_event.is_set():
+            close_old_connections()
+            try:
+                self.run_once()
+            except Exception as e:
+                print(f"[MODERATION] worker {self.consumer} 出错: {e}")
+                time.sleep(1)
+            finally:
+                close_old_connections()
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                _backend = LocalBackend() if MODERATION_BACKEND == "local" else RedisStreamBackend()
+    return _backend
+
+
+def consumer_name(index=0):
+    return f"{socket.gethostname()}-{os.getpid()}-{index}"
+
+
+def submit_moderation(kind, target_id, text):
+    """提交审核任务，返回任务 id；结果由 kind 对应的回调异步处理"""
+    job_id = get_backend().submit({"kind": kind, "target": str(target_id), "text": text or "", "attempts": "1"})
+    metrics.incr("submitted")
+    return job_id
+
+
+def moderation_stats():
+    backend = get_backend()
+    return {"backend": backend.name, **backend.stats(), "worker": metrics.stats(), "pid": os.getpid()}
+
+
+@api_view(["GET"])
+@permission_classes([IsAdminUser])
+def moderation_stats_view(request):
+    """
+    查看审核队列积压情况（仅管理员；worker 计数只包含处理本次请求的进程）
+    """
+    return Response({"success": True, "data": moderation_stats()})
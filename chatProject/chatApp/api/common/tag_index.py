@@ -0,0 +1,117 @@
+"""
+房间标签/语言倒排索引（RoomTagIndex）
+- 角色卡写入、房间绑定变更时重建相关房间的索引
+- 搜索时先在标签词表中做子串匹配，再用 tag IN (...) 走索引取房间，分页前完成过滤
+- 只收录列表中会展示的房间（角色卡审核通过且有图片，与 resolve_room_images 一致），
+  否则分页后这些房间被过滤掉，搜索结果的页会变短
+"""
+
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from chatApp.api.common.cache import cached_call, invalidate
+
+from chatApp.models import CharacterCard, RoomImageBinding, RoomInfo, RoomTagIndex
+from chatApp.api.common.common import normalize_tag
+
+TAG_VOCAB_CACHE_KEY = "room_tag_index:vocab"
+TAG_VOCAB_CACHE_TTL = 300
+
+LANGUAGES = ("en", "cn")
+
+
+def reindex_room_tags(room_ids):
+    """
+    重建指定房间的标签索引：房间 uid + room_id → 绑定 → 角色卡 tags/language
+    角色卡审核状态变化时由 post_save 信号触发重建，审核中、未通过、没有图片的房间不收录
+    """
+    room_ids = {room_id for room_id in room_ids if room_id}
+    if not room_ids:
+        return
+
+    room_uids = dict(RoomInfo.objects.filter(room_id__in=room_ids).values_list("room_id", "uid"))
+
+    # 与 build_full_image_url 一致：同一 (uid, room_id) 取最早的绑定
+    bindings = {}
+    for uid, room_id, image_id in RoomImageBinding.objects.filter(room_id__in=room_ids)\
+            .order_by("id").values_list("uid", "room_id", "image_id"):
+        if room_id in room_uids and str(uid) == str(room_uids[room_id]):
+            bindings.setdefault(room_id, image_id)
+
+    cards = {
+        card["id"]: card
+        for card in CharacterCard.objects.filter(id__in=set(bindings.values()), review_status="approved")
+        .exclude(image_name="").values("id", "tags", "language")
+    }
+
+    rows = []
+    for room_id, image_id in bindings.items():
+        card = cards.get(image_id)
+        if not card:
+            continue
+        rows.append(RoomTagIndex(room_id=room_id, tag=(card["language"] or "en").lower(),
+                                 kind=RoomTagIndex.KIND_LANGUAGE))
+        tags = {normalize_tag(t.strip()) for t in (card["tags"] or "").split(",")}
+        rows.extend(RoomTagIndex(room_id=room_id, tag=tag[:255], kind=RoomTagIndex.KIND_TAG)
+                    for tag in tags if tag)
+
+    with transaction.atomic():
+        RoomTagIndex.objects.filter(room_id__in=room_ids).delete()
+        RoomTagIndex.objects.bulk_create(rows, ignore_conflicts=True)
+
+    try:
+        invalidate(TAG_VOCAB_CACHE_KEY)
+    except Exception:
+        pass
+
+
+def _load_tag_vocab():
+    return list(
+        RoomTagIndex.objects.filter(kind=RoomTagIndex.KIND_TAG).values_list("tag", flat=True).distinct()
+    )
+
+
+def _get_tag_vocab():
+    """所有标准化标签（词表远小于房间数），Redis 缓存，过期时只有一个 worker 重新查询"""
+    return set(cached_call(TAG_VOCAB_CACHE_KEY, _load_tag_vocab, ttl=TAG_VOCAB_CACHE_TTL))
+
+
+def filter_rooms_by_tags(queryset, raw_tags):
+    """
+    按标签搜索过滤 RoomInfo 查询集，多个标签用逗号分隔，取交集
+    - en / cn 匹配角色卡语言
+    - 其他标签与原逻辑一致：搜索词是标签的子串即匹配
+    """
+    terms = [normalize_tag(term.strip()) for term in raw_tags.split(",")]
+    terms = [term for term in terms if term]
+    if not terms:
+        return queryset
+
+    vocab = None
+    for term in terms:
+        if term in LANGUAGES:
+            matched = RoomTagIndex.objects.filter(kind=RoomTagIndex.KIND_LANGUAGE, tag=term)
+        else:
+            if vocab is None:
+                vocab = _get_tag_vocab()
+            tags = [tag for tag in vocab if term in tag]
+            if not tags:
+                return queryset.none()
+            matched = RoomTagIndex.objects.filter(kind=RoomTagIndex.KIND_TAG, tag__in=tags)
+        queryset = queryset.filter(room_id__in=matched.values("room_id"))
+    return queryset
+
+
+# ---------- 角色卡 / 绑定变更时维护索引 ----------
+def _on_binding_changed(sender, instance, **kwargs):
+    reindex_room_tags([instance.room_id])
+
+
+def _on_card_changed(sender, instance, **kwargs):
+    room_ids = RoomImageBinding.objects.filter(image_id=instance.id).values_list("room_id", flat=True)
+    reindex_room_tags(list(room_ids))
+
+
+post_save.connect(_on_binding_changed, sender=RoomImageBinding, dispatch_uid="room_tag_binding_saved")
+post_delete.connect(_on_binding_changed, sender=RoomImageBinding, dispatch_uid="room_tag_binding_deleted")
+post_save.connect(_on_card_changed, sender=CharacterCard, dispatch_uid="room_tag_card_saved")
+post_delete.connect(_on_card_changed, sender=CharacterCard, dispatch_uid="room_tag_card_deleted")
@@ -0,0 +1,26 @@
+"""
+token 数估算（不依赖具体模型的分词器，只用于拼接上下文时控制长度）
+- 中日韩文字、全角标点：每个字符约 1 个 token
+- 其他字符：约 4 个字符 1 个 token
+- 每条消息另加固定开销（角色、分隔符）
+估算规则变化时修改 TOKEN_ESTIMATOR_VERSION，已缓存在消息上的 token_count 会重新计算
+"""
+
+import re
+
+TOKEN_ESTIMATOR_VERSION = 1
+MESSAGE_OVERHEAD = 4
+
+_WIDE_CHARS = re.compile(r"[\u2e80-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]")
+
+
+def estimate_tokens(text):
+    if not text or not isinstance(text, str):
+        return 0
+    narrow = len(_WIDE_CHARS.sub("", text))
+    return (len(text) - narrow) + (narrow + 3) // 4
+
+
+def message_tokens(text):
+    """一条消息在上下文中占用的 token 数（含固定开销）"""
+    return estimate_tokens(text) + MESSAGE_OVERHEAD
@@ -1,24 +1,130 @@
 from rest_framework.decorators import api_view
 from rest_framework.response import Response
 from chatApp.models import RoomInfo, CharacterCard ,ForkRelation,Anchor ,ForkTrace,ChatUser, RoomImageBinding
-from chatApp.api.common.common import build_full_image_url,generate_new_room_id, generate_new_room_name
-from pymongo import MongoClient
+from chatApp.api.common.common import build_full_image_urls,generate_new_room_id, generate_new_room_name
+from chatApp.api.common.messages import copy_history
+from chatApp.api.common.feed import refresh_feed_cards
 from django.conf import settings
 from django.contrib.auth import get_user
+from django.db import transaction
 from rest_framework_simplejwt.tokens import AccessToken, RefreshToken
 from rest_framework_simplejwt.authentication import JWTAuthentication
 from rest_framework.decorators import authentication_classes, permission_classes
 from rest_framework.permissions import IsAuthenticated
 from django.utils import timezone
-from django_redis import get_redis_connection  # 获取 Redis 连接
+from chatApp.api.common.connections import lazy_redis
 from rest_framework.pagination import PageNumberPagination
 import hashlib
+import json
+import os
+import threading
+import time
 
-redis_client = get_redis_connection('default')  # 使用 django-redis 配置
+redis_client = lazy_redis('default')  # 使用 django-redis 配置
 
-# 初始化 MongoDB 连接
-client = MongoClient(settings.MONGO_URI)
-db = client.get_database()
+# 复制楼层数超过该值时改为后台复制，接口立即返回 pending
+FORK_ASYNC_THRESHOLD = getattr(settings, "FORK_ASYNC_THRESHOLD", 2000)
+FORK_STATUS_TTL = 24 * 60 * 60
+# 后台复制超过该秒数仍是 pending，视为进程重启或崩溃导致复制中断
+FORK_COPY_STALE_AFTER = getattr(settings, "FORK_COPY_STALE_AFTER", 10 * 60)
+# 复制失败或中断后最多重新执行的次数（含第一次）
+FORK_COPY_MAX_ATTEMPTS = getattr(settings, "FORK_COPY_MAX_ATTEMPTS", 3)
+
+# 值没有被其他进程改过才写入（抢占重新复制、复制线程写回结果都用它，过期的线程不会覆盖新一轮的状态）
+COMPARE_AND_SET_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    redis.call('SET', KEYS[1], ARGV[2], 'EX', ARGV[3])
+    return 1
+end
+return 0
+"""
+
+
+def _fork_status_key(room_id):
+    return f"fork_status:{room_id}"
+
+
+def _copy_state(status, origin_room_id, floor, overrides, attempts):
+    """
+    复制状态（JSON）：除了状态还记下复制参数，中断后可以用同样的参数重新执行 $merge（keepExisting，重复执行是幂等的）
+    token 区分每一轮复制
+    """
+    return json.dumps({
+        "status": status, "started_at": time.time(), "token": os.urandom(8).hex(), "attempts": attempts,
+        "origin_room_id": origin_room_id, "floor": floor, "overrides": overrides,
+    }, ensure_ascii=False)
+
+
+def _compare_and_set(key, expected, value):
+    return redis_client.register_script(COMPARE_AND_SET_LUA)(keys=[key], args=[expected, value, FORK_STATUS_TTL])
+
+
+def _start_copy(new_room_id, raw_state):
+    state = json.loads(raw_state)
+    threading.Thread(
+        target=_copy_room_history_background,
+        args=(new_room_id, raw_state, state),
+        daemon=True
+    ).start()
+
+
+def _copy_room_history_background(new_room_id, raw_state, state):
+    key = _fork_status_key(new_room_id)
+    try:
+        copy_history(state["origin_room_id"], new_room_id, state["floor"], state["overrides"])
+        refresh_feed_cards([new_room_id])
+        result = "done"
+    except Exception:
+        import traceback
+        traceback.print_exc()
+        result = "failed"
+    try:
+        _compare_and_set(key, raw_state, json.dumps(dict(state, status=result), ensure_ascii=False))
+    except Exception as e:
+        # 写不回结果时状态保持 pending，超过 FORK_COPY_STALE_AFTER 后重新复制
+        print(f"[FORK] 写入复制状态失败: {e}")
+
+
+def resume_fork_copy(room_id):
+    """
+    返回房间聊天记录复制的当前状态：pending / done / failed
+    - 没有记录：同步复制（或记录已过期），视为已完成
+    - failed，或 pending 超过 FORK_COPY_STALE_AFTER（复制进程已退出）：还有次数就在本进程重新开始复制，返回 pending；
+      多个进程同时发现时只有抢到（比较并写入）的那个执行
+    fork_status 轮询和 fork_chat 写入前都会调用，复制中断后由下一次请求恢复
+    """
+    key = _fork_status_key(room_id)
+    raw_state = redis_client.get(key)
+    if not raw_state:
+        return "done"
+    raw_state = raw_state.decode()
+    try:
+        state = json.loads(raw_state)
+    except ValueError:
+        return raw_state  # 旧格式：直接保存的状态字符串
+    status = state.get("status")
+    if status == "pending" and time.time() - state.get("started_at", 0) > FORK_COPY_STALE_AFTER:
+        status = "failed"
+    if status != "failed":
+        return status
+    if state.get("attempts", 1) >= FORK_COPY_MAX_ATTEMPTS:
+        return "failed"
+
+    new_state = _copy_state("pending", state["origin_room_id"], state["floor"], state["overrides"],
+                            state.get("attempts", 1) + 1)
+    if _compare_and_set(key, raw_state, new_state):
+        print(f"[FORK] 房间 {room_id} 聊天记录复制中断或失败，重新复制（第 {state.get('attempts', 1) + 1} 次）")
+        _start_copy(room_id, new_state)
+    return "pending"
+
+
+def fork_copy_pending(room_id):
+    """后台复制聊天记录还没完成（此时写入新消息会占用被复制的楼层号，导致复制失败）"""
+    try:
+        return resume_fork_copy(room_id) == "pending"
+    except Exception as e:
+        print(f"[FORK] 读取复制状态失败: {e}")
+        return False
 
 class ForkedListPagination(PageNumberPagination):
     page_size = 10  # 每页返回的条目数
@@ -75,95 +181,82 @@ def fork_confirm(request):
         new_room_name = generate_new_room_name(user_id, character_name)
         new_room_id, character_date = generate_new_room_id(user_id, character_name)
 
-        # ------------------ 创建新房间 ------------------
-        new_room = RoomInfo.objects.create(
-            uid=user_id,
-            user_name=user_name,
-            room_id=new_room_id,
-            room_name=new_room_name,
-            character_name=character_name,
-            character_date=character_date,
-            room_type=origin_room.room_type,
-            file_name=origin_room.file_name,
-            file_branch='branch',
-            is_info=origin_room.is_info,
-            is_show=1,  # 新房间默认公开
-            created_at=timezone.now()
-        )
-
-        # ------------------ 写入 ForkRelation ------------------
-        ForkRelation.objects.create(
-            from_user_id=user_id,
-            target_id=target_id,
-            room_id=room_id,
-            floor=floor,
-            character_name=character_name,
-            created_at=timezone.now()
-        )
-
-        # ------------------ 复制 MongoDB 聊天记录（≤ floor） ------------------
-        client = MongoClient(settings.MONGO_URI)
-        db = client[settings.MONGO_DB_NAME]
-
-        origin_collection = db[str(room_id)]
-        new_collection = db[str(new_room_id)]
-
-        chat_records = list(origin_collection.find({}).sort("_id", 1))
-        forked_chat_info = []
-
-        for index, item in enumerate(chat_records, start=1):
-            if index > floor:
-                break
-            new_item = item.copy()
-            new_item.pop("_id", None)
-            new_item.update({
+        with transaction.atomic():
+            # ------------------ 创建新房间 ------------------
+            new_room = RoomInfo.objects.create(
+                uid=user_id,
+                user_name=user_name,
+                room_id=new_room_id,
+                room_name=new_room_name,
+                character_name=character_name,
+                character_date=character_date,
+                room_type=origin_room.room_type,
+                file_name=origin_room.file_name,
+                file_branch='branch',
+                is_info=origin_room.is_info,
+                is_show=1,  # 新房间默认公开
+                created_at=timezone.now()
+            )
+
+            # ------------------ 写入 ForkRelation ------------------
+            ForkRelation.objects.create(
+                from_user_id=user_id,
+                target_id=target_id,
+                room_id=room_id,
+                floor=floor,
+                character_name=character_name,
+                created_at=timezone.now()
+            )
+
+            # ------------------ 复制 MongoDB 聊天记录（≤ floor） ------------------
+            overrides = {
                 "uid": user_id,
                 "username": user_name,
                 "room_id": new_room_id,
                 "room_name": new_room_name
-            })
-            new_collection.insert_one(new_item)
-
-            data = new_item.get("data", {})
-            forked_chat_info.append({
-                "floor": index,
-                "data_type": new_item.get("data_type"),
-                "data": {
-                    "name": data.get("name"),
-                    "is_user": data.get("is_user"),
-                    "send_date": data.get("send_date"),
-                    "mes": data.get("mes")
-                },
-                "mes_html": new_item.get("mes_html", "")
-            })
-
-        # ------------------ 创建新的 RoomImageBinding ------------------
-        origin_binding = RoomImageBinding.objects.filter(room_id=room_id).first()
-        if origin_binding:
-            RoomImageBinding.objects.create(
-                uid=user_id,
-                image_id=origin_binding.image_id,
-                room_id=new_room_id
+            }
+            if floor > FORK_ASYNC_THRESHOLD:
+                # 楼层很深：后台复制，前端通过 fork_status 轮询
+                fork_status = "pending"
+                copy_state = _copy_state(fork_status, room_id, floor, overrides, 1)
+                redis_client.set(_fork_status_key(new_room_id), copy_state, ex=FORK_STATUS_TTL)
+            else:
+                fork_status = "done"
+                copy_history(room_id, new_room_id, floor, overrides)
+                # 复制完成后新房间已有用户消息，生成信息流卡片
+                refresh_feed_cards([new_room_id])
+
+            # ------------------ 创建新的 RoomImageBinding ------------------
+            origin_binding = RoomImageBinding.objects.filter(room_id=room_id).first()
+            if origin_binding:
+                RoomImageBinding.objects.create(
+                    uid=user_id,
+                    image_id=origin_binding.image_id,
+                    room_id=new_room_id
+                )
+
+            # ------------------ 写入 ForkTrace ------------------
+            last_trace = ForkTrace.objects.filter(current_room_id=room_id).order_by('-created_at').first()
+            if last_trace:
+                source_room_id = last_trace.source_room_id
+                source_uid = last_trace.source_uid
+            else:
+                source_room_id = origin_room.room_id
+                source_uid = origin_room.uid
+
+            ForkTrace.objects.create(
+                source_room_id=source_room_id,
+                source_uid=source_uid,
+                prev_room_id=room_id,
+                prev_uid=origin_room.uid,
+                current_room_id=new_room_id,
+                current_uid=user_id,
+                created_at=timezone.now()
             )
 
-        # ------------------ 写入 ForkTrace ------------------
-        last_trace = ForkTrace.objects.filter(current_room_id=room_id).order_by('-created_at').first()
-        if last_trace:
-            source_room_id = last_trace.source_room_id
-            source_uid = last_trace.source_uid
-        else:
-            source_room_id = origin_room.room_id
-            source_uid = origin_room.uid
-
-        ForkTrace.objects.create(
-            source_room_id=source_room_id,
-            source_uid=source_uid,
-            prev_room_id=room_id,
-            prev_uid=origin_room.uid,
-            current_room_id=new_room_id,
-            current_uid=user_id,
-            created_at=timezone.now()
-        )
+            if fork_status == "pending":
+                # 房间、绑定、ForkTrace 都提交后再开始复制；复制完成前 fork_chat 返回 409
+                transaction.on_commit(lambda: _start_copy(new_room_id, copy_state))
 
         # ------------------ 返回结果 ------------------
         return Response({
@@ -172,7 +265,8 @@ def fork_confirm(request):
             "data": {
                 "room_info": {
                     "room_id": new_room.room_id
-                }
+                },
+                "fork_status": fork_status
             }
         }, status=200)
 
@@ -185,6 +279,24 @@ def fork_confirm(request):
         }, status=500)
 
 
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def fork_status(request):
+    """
+    查询 fork 聊天记录复制进度（只能查询自己的房间）
+    GET /api/fork/fork_status/?room_id=<新房间 room_id>
+    返回 status: pending / done / failed；复制中断或失败时会自动重新复制（见 resume_fork_copy）
+    """
+    room_id = request.GET.get('room_id')
+    if not room_id:
+        return Response({"success": False, "message": "room_id 必填"}, status=400)
+    if not RoomInfo.objects.filter(room_id=room_id, uid=str(request.user.id)).exists():
+        return Response({"success": False, "message": "房间不存在"}, status=404)
+
+    status = resume_fork_copy(room_id)
+    return Response({"success": True, "data": {"room_id": room_id, "status": status}}, status=200)
+
+
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
 def forked_list(request):
@@ -201,43 +313,46 @@ def forked_list(request):
     paginator = ForkedListPagination()
     result_page = paginator.paginate_queryset(forks, request)
 
-    result_list = []
-    for fork in result_page:
-        try:
+    # 当前页新房间的 RoomInfo 一条 IN 查询取出，房间信息不存在的跳过
+    rooms_by_id = {}
+    for room in RoomInfo.objects.filter(room_id__in={fork.current_room_id for fork in result_page}).order_by('id'):
+        rooms_by_id.setdefault(room.room_id, room)
+    room_infos = [rooms_by_id[fork.current_room_id] for fork in result_page if fork.current_room_id in rooms_by_id]
+
+    # 批量获取房间的图片信息、房主昵称
+    image_infos = build_full_image_urls(request, [(r.uid, r.room_id) for r in room_infos])
+    nicknames = {
+        str(user_id): nickname
+        for user_id, nickname in ChatUser.objects.filter(
+            id__in={int(r.uid) for r in room_infos if str(r.uid).isdigit()}
+        ).values_list('id', 'nickname')
+    }
 
-            # 获取当前新房间的 RoomInfo 信息
-            room_info = RoomInfo.objects.get(room_id=fork.current_room_id)
-
-            # 获取房间的图片信息
-            image_info = build_full_image_url(request, uid=room_info.uid, room_id=room_info.room_id)
-
-            nickname_obj = ChatUser.objects.filter(id=room_info.uid).first()
-            nickname = nickname_obj.nickname if nickname_obj and nickname_obj.nickname else ""
-
-            # 构建返回的结果
-            result_list.append({
-                "room_id": room_info.room_id,
-                "room_name": room_info.room_name,
-                "uid": room_info.uid,
-                "username": room_info.user_name,
-                "nickname": nickname,
-                "character_name": room_info.character_name,
-                "character_date": room_info.character_date,
-                "image_name": image_info['image_name'],
-                "image_path": image_info['image_path'],
-                "tags": image_info['tags'],
-                "language": image_info['language'],
-                "room_info": {
-                    "title": room_info.title or "",
-                    "describe": room_info.describe or "",
-                    "coin_num": room_info.coin_num if room_info.coin_num is not None else 0,
-                    "room_type": room_info.room_type or 0,
-                },
-                "last_ai_reply_timestamp": room_info.last_ai_reply_timestamp
-            })
+    result_list = []
+    for room_info, image_info in zip(room_infos, image_infos):
+        nickname = nicknames.get(str(room_info.uid)) or ""
 
-        except RoomInfo.DoesNotExist:
-            continue  # 如果房间信息不存在，跳过该项
+        # 构建返回的结果
+        result_list.append({
+            "room_id": room_info.room_id,
+            "room_name": room_info.room_name,
+            "uid": room_info.uid,
+            "username": room_info.user_name,
+            "nickname": nickname,
+            "character_name": room_info.character_name,
+            "character_date": room_info.character_date,
+            "image_name": image_info['image_name'],
+            "image_path": image_info['image_path'],
+            "tags": image_info['tags'],
+            "language": image_info['language'],
+            "room_info": {
+                "title": room_info.title or "",
+                "describe": room_info.describe or "",
+                "coin_num": room_info.coin_num if room_info.coin_num is not None else 0,
+                "room_type": room_info.room_type or 0,
+            },
+            "last_ai_reply_timestamp": room_info.last_ai_reply_timestamp
+        })
 
     return Response({
         "code": 0,
@@ -1,25 +1,36 @@
+import asyncio
 import os
-from openai import OpenAI
 from google import generativeai as genai
 import json
 from dotenv import load_dotenv
 import re
 from django.views.decorators.csrf import csrf_exempt
-from rest_framework.decorators import api_view
+from django.http import JsonResponse, StreamingHttpResponse
+from django.views.decorators.http import require_POST
+from asgiref.sync import sync_to_async
+from rest_framework.exceptions import APIException, NotAuthenticated
+from rest_framework.request import Request
 from rest_framework.response import Response
+from rest_framework.settings import api_settings
 from chatApp.models import Preset, CharacterCard,ForkTrace,RoomImageBinding
-from chatApp.api.common.common import build_full_image_url,generate_new_room_id, generate_new_room_name
-from pymongo import MongoClient
+from chatApp.api.common.common import build_full_image_url,generate_new_room_id, generate_new_room_name, update_last_ai_reply, \
+    normalize_send_date, allocate_floor
+from chatApp.api.common.messages import insert_message, latest_messages, history_within_budget
+from chatApp.api.common.tokens import message_tokens
+from chatApp.api.common.feed import note_user_message
+from chatApp.api.common.connections import mongo_db
+from chatApp.api.common.llm_gateway import get_gateway, LLMGatewayBusy
 from django.conf import settings
-from rest_framework.decorators import permission_classes
-from rest_framework.permissions import IsAuthenticated
 import traceback
 from django.utils import timezone
 from google.generativeai.types import HarmCategory, HarmBlockThreshold
 
 from datetime import datetime
 from .api_model.kemini import first_mes_model,current_mes_model
-from .fork_format import format_message
+from .fork import fork_copy_pending
+from .fork_format import format_message, render_key
+from .lorebook import get_lorebook
+from .prompt_template import PromptTemplate, expand_values, get_compiled_preset, merge_contents
 from dateutil import parser
 import hashlib
 
@@ -32,23 +43,36 @@ API_KEY = os.getenv("GEMINI_API_KEY")
 genai.configure(api_key=API_KEY)
 
 # 初始化 MongoDB 连接
-client = MongoClient(settings.MONGO_URI)
-db = client.get_database()
-
-@csrf_exempt
-@api_view(['POST'])
-@permission_classes([IsAuthenticated])
-def fork_chat(request):
+db = mongo_db
+
+# 没有预设时的上下文长度（token），聊天记录按预算从最新一条往前取
+FORK_DEFAULT_MAX_CONTEXT = getattr(settings, "FORK_DEFAULT_MAX_CONTEXT", 128000)
+# 单次最多取的聊天记录条数
+FORK_HISTORY_MAX_MESSAGES = getattr(settings, "FORK_HISTORY_MAX_MESSAGES", 200)
+
+# 没有预设时使用的默认模板（导入时编译一次）
+FIRST_MES_TEMPLATE_SLOTS = ("character_description", "entrie", "user")
+FIRST_MES_TEMPLATE = PromptTemplate(first_mes_model, FIRST_MES_TEMPLATE_SLOTS)
+CURRENT_MES_TEMPLATE_SLOTS = ("user", "message")
+CURRENT_MES_TEMPLATE = PromptTemplate(current_mes_model, CURRENT_MES_TEMPLATE_SLOTS)
+
+def _prepare_fork_chat(request):
+    """
+    写入用户消息并构造发给模型的上下文（普通接口和流式接口共用）
+    返回 (ctx, None)，出错时返回 (None, Response)
+    """
     # 获取用户信息
     user = request.user
     if not user:
-        return Response({"success": False, "message": "用户未登录"}, status=401)
+        return None, Response({"success": False, "message": "用户未登录"}, status=401)
 
     user_name = user.username
     user_id = user.id
     room_id = request.data.get('room_id')
 
-
+    # 后台复制聊天记录期间不能写入新消息（楼层号会和复制过来的记录冲突）
+    if fork_copy_pending(room_id):
+        return None, Response({"success": False, "message": "聊天记录复制中，请稍后再试"}, status=409)
 
     fork_room_info = ForkTrace.objects.filter(current_room_id=room_id).first()
     source_room_id = fork_room_info.source_room_id
@@ -60,11 +84,11 @@ def fork_chat(request):
     character_card = None
     if binding:
         character_card = CharacterCard.objects.filter(id=binding.image_id).values(
-            "character_name", "character_data", "username"
+            "id", "character_name", "character_data", "username"
         ).first()
 
     if not character_card:
-        return Response({"success": False, "message": "未找到角色卡绑定信息"}, status=404)
+        return None, Response({"success": False, "message": "未找到角色卡绑定信息"}, status=404)
 
     character_name = character_card['character_name']
     character_date = character_card['character_data']
@@ -84,9 +108,8 @@ def fork_chat(request):
     formatted_date = current_date.strftime("%B %d, %Y %I:%M%p").replace("AM", "am").replace("PM", "pm")
 
     #将数据写入mongodb
-    collection = db[room_id]
-    floor_user = collection.count_documents({}) + 1
-    collection.insert_one({
+    floor_user = allocate_floor(db, room_id)
+    insert_message(room_id, {
         "username": user_name,
         "uid": user_id,
         "character_name": character_name,
@@ -96,8 +119,11 @@ def fork_chat(request):
         "data_type": "user",
         "data": {"name":user_name,"is_user":True,"send_date":formatted_date,"mes":current_message},
         "mes_html": current_message,
+        "send_date_iso": normalize_send_date(formatted_date),
         "floor": floor_user
     })
+    # 第一条用户消息写入后生成信息流卡片
+    note_user_message(room_id)
 
 
 
@@ -116,10 +142,12 @@ def fork_chat(request):
     character_book = character_data_json.get("data").get("character_book","")
 
     if character_book:
-        entries = character_book.get("entries","")
-        if entries:
-            for row in entries:
-                entrie += row.get("content")
+        # 世界书只注入最近几条消息触发的条目（本次用户消息已写入，包含在内）
+        lorebook = get_lorebook(character_card["id"], character_date, character_book)
+        recent_records = []
+        if lorebook.scan_depth > 0 and lorebook.by_key:
+            recent_records = latest_messages(room_id, lorebook.scan_depth, projection={"data.mes": 1})
+        entrie = lorebook.activate([(item.get("data") or {}).get("mes") for item in recent_records])
     character_description = character_data_json.get("description","")
     extensions = character_data_json.get("data").get("extensions","")
     if extensions:
@@ -129,37 +157,6 @@ def fork_chat(request):
 
 
 
-    # 从 MongoDB 查询聊天记录并添加到 contents
-    try:
-
-        # chat_records = list(collection.find({}).sort("_id", 1))
-        chat_records = list(collection.find({}).sort("_id", -1).limit(10))
-        chat_records.reverse()
-
-        for item in chat_records:
-            data = item.get("data", {})
-            is_user = data.get("is_user")
-            mes = data.get("mes")
-
-            if not mes or not isinstance(mes, str):
-                continue
-            role = "user" if is_user  else "model"
-            chat_history_contents.append({
-                "role": role,
-                "parts": [{"text": mes}]
-            })
-
-
-
-    except Exception as e:
-        return Response({
-            "code": 1,
-            "message": f"获取聊天历史失败: {str(e)}"
-        }, status=500)
-
-
-
-
     # 预设处理，没有则使用默认预设
 
     candidate_count= 1
@@ -167,12 +164,15 @@ def fork_chat(request):
     top_p= 0.98
     top_k= 40
     max_output_tokens= 65535
+    openai_max_context = FORK_DEFAULT_MAX_CONTEXT
     frequency_penalty= 0
     presence_penalty= 0
 
     contents = []
+    history_positions = []  # 聊天历史插入的位置，按 token 预算取完记录后再插入
     #获取当前房间的预设
-    preset_info = Preset.objects.filter(room_id=source_room_id).first()
+    # preset_json 可能很大，只在编译缓存未命中时才读取
+    preset_info = Preset.objects.filter(room_id=source_room_id).defer("preset_json").first()
     #已经保存了预设
     if preset_info:
         preset_settings_openai = preset_info.preset_settings_openai
@@ -183,35 +183,32 @@ def fork_chat(request):
         max_output_tokens      = preset_info.openai_max_tokens
         google_model           = preset_info.google_model
         model_n                = preset_info.model_n
-        preset_json            = preset_info.preset_json
-
-        preset_json_list = json.loads(preset_json)
-        for data in preset_json_list:
-            identifier = data.get("identifier","")
-            content = data.get("content","")
-
-            content = content.replace('{{character_description}}', character_description).replace('{{entrie}}', entrie).replace('{{user}}', character_user_name).replace('{{lastUserMessage}}', current_message)
-            if identifier != "chatHistory":
-                contents.append({
-                "role": data.get("role","user"),
-                "parts": [{"text":content }]
-                })
-            else:
-                #合并历史聊天内容
-                contents.extend(chat_history_contents)
+
+        compiled_preset = get_compiled_preset(source_room_id, preset_info.version, lambda: preset_info.preset_json)
+        #合并历史聊天内容的位置记录在 history_positions
+        contents, history_positions = compiled_preset.render({
+            "character_description": character_description,
+            "entrie": entrie,
+            "user": character_user_name,
+            "lastUserMessage": current_message,
+        })
     #未保存预设
     else:
 
-        first_mes = first_mes_model.replace('{{character_description}}', character_description).replace('{{entrie}}', entrie).replace('{{user}}', character_user_name)
+        first_mes = FIRST_MES_TEMPLATE.render(expand_values(FIRST_MES_TEMPLATE_SLOTS, {
+            "character_description": character_description, "entrie": entrie, "user": character_user_name
+        }))
         # contents.append({"text":first_mes})
         contents.append({
             "role": "user",
             "parts": [{"text": first_mes}]
         })
         #合并历史聊天内容
-        contents.extend(chat_history_contents)
+        history_positions.append(len(contents))
 
-        current_message = current_mes_model.replace('{{user}}', character_user_name).replace('{{message}}', current_message)
+        current_message = CURRENT_MES_TEMPLATE.render(expand_values(CURRENT_MES_TEMPLATE_SLOTS, {
+            "user": character_user_name, "message": current_message
+        }))
         # 添加用户最新消息
         contents.append({
             "role": "user",
@@ -220,28 +217,197 @@ def fork_chat(request):
 
 
 
+    # 从 MongoDB 按 token 预算取聊天记录：上下文长度 - 输出长度 - 预设等固定内容
+    fixed_tokens = sum(message_tokens(row["parts"][0]["text"]) for row in contents)
+    history_budget = openai_max_context - max_output_tokens - fixed_tokens
+    try:
+
+        chat_records, _ = history_within_budget(room_id, history_budget, FORK_HISTORY_MAX_MESSAGES)
+
+        for item in chat_records:
+            data = item.get("data", {})
+            is_user = data.get("is_user")
+            mes = data.get("mes")
+
+            if not mes or not isinstance(mes, str):
+                continue
+            role = "user" if is_user  else "model"
+            chat_history_contents.append({
+                "role": role,
+                "parts": [{"text": mes}]
+            })
+
+
+
+    except Exception as e:
+        return None, Response({
+            "code": 1,
+            "message": f"获取聊天历史失败: {str(e)}"
+        }, status=500)
+
+    for position in reversed(history_positions):
+        contents[position:position] = chat_history_contents
+
+
     #合并contents
-    contents_final = []
-    for row in contents:
-            role = row.get("role")
-            if role in('system','tool'):
-                role = "user"
-            elif role == "assistant":
-                role = "model"
-            if role:
-
-                if len(contents_final) >0 and role == contents_final[-1].get("role"):
-                    # 拼接内容
-                    current_content = row.get("parts")[0].get("text")
-                    existing_content = contents_final[-1].get("parts")[0].get("text")
-                    contents_final[-1]["parts"] =[{"text":  existing_content + "\n\n" + current_content}]
-                else:
-                    contents_final.append({
-                        "role": role,
-                        "parts": [{"text": row.get("parts")[0].get("text")}]
-                    });
+    contents_final = merge_contents(contents)
+
+
+
+    messages_openai = []
 
+    for msg in contents_final:
 
+        role = msg["role"]
+        parts = msg["parts"]
+        if role == "model":
+            role = "assistant"    # 关键替换
+
+        messages_openai.append({
+            "role": role,
+            "content": parts[0]["text"]
+        })
+
+    return {
+        "user_name": user_name,
+        "user_id": user_id,
+        "room_id": room_id,
+        "character_name": character_name,
+        "character_regex_scripts": character_regex_scripts,
+        "contents_final": contents_final,
+        "messages_openai": messages_openai,
+        "temperature": temperature,
+        "top_p": top_p,
+        "max_output_tokens": max_output_tokens,
+    }, None
+
+
+def _completion_kwargs(ctx):
+    return {
+        "model": "gemini-2.5-pro-c",
+        "messages": ctx["messages_openai"],
+        "temperature": ctx["temperature"],
+        "top_p": ctx["top_p"],
+        "max_tokens": ctx["max_output_tokens"],
+    }
+
+
+def _save_ai_reply(ctx, response_text):
+    """格式化 AI 回复并写入 MongoDB"""
+    room_id = ctx["room_id"]
+    mes_html = format_message(
+        content=response_text,
+        placement=2,  # AI_OUTPUT
+        is_markdown=True,
+        is_prompt=True,
+        is_edit=False,
+        depth=0,
+        character_regex_scripts=ctx["character_regex_scripts"]
+    )
+    # print("mes_html")
+    # print(mes_html)
+
+    # 获取当前日期时间（或指定日期时间）
+    current_date = datetime.now()  # 当前时间
+    # 或者指定具体日期时间，例如：
+    # current_date = datetime(2025, 9, 30, 17, 51)
+
+    # 格式化为 "September 30, 2025 5:51pm"
+    formatted_date = current_date.strftime("%B %d, %Y %I:%M%p").replace("AM", "am").replace("PM", "pm")
+
+    floor_ai = allocate_floor(db, room_id)
+
+    insert_message(room_id, {
+        "username": ctx["user_name"],
+        "uid": ctx["user_id"],
+        "character_name": ctx["character_name"],
+        "character_date": "",
+        "room_id": room_id,
+        "room_name": "",
+        "data_type": "ai",
+        "data": {"name":ctx["character_name"],"is_user":False,"send_date":formatted_date,"mes":response_text},
+        "mes_html": mes_html,
+        # 渲染指纹，正则脚本或格式化逻辑变化后由 rerender_mes_html 重新渲染
+        "mes_html_key": render_key(ctx["character_regex_scripts"]),
+        "send_date_iso": normalize_send_date(formatted_date),
+        "floor": floor_ai
+    })
+    update_last_ai_reply(room_id, formatted_date)
+
+
+def _latest_result(room_id):
+    result = []
+
+    # 从 MongoDB 查询最新的两条聊天记录，按插入顺序排列
+    chat_records = latest_messages(room_id, 2)  # 获取最新的2条消息，按楼层从旧到新
+
+    # 遍历聊天记录，只返回 'user' 或 'ai' 类型的消息
+    for item in chat_records:
+        data = item.get("data", {})
+        data_type = item.get("data_type")  # 获取消息类型（user 或 ai）
+
+        # 只返回 'user' 或 'ai' 类型的消息
+        if data_type not in ['user', 'ai']:
+            continue
+
+        send_date =  timezone.now().isoformat() + 'Z'
+
+
+        filtered_data = {
+            "name": data.get("name"),
+            "is_user": data.get("is_user"),
+            "send_date": send_date,
+            "mes": data.get("mes")
+        }
+
+        # 添加消息到结果
+        result.append({
+            "floor": item.get("floor", 0),
+            "data_type": data_type,  # 'user' 或 'ai'
+            "data": filtered_data,
+            "mes_html": item.get("mes_html", "")
+        })
+    return result
+
+
+def _json_response(data, status):
+    return JsonResponse(data, status=status, safe=False, json_dumps_params={"ensure_ascii": False})
+
+
+def _prepare_async_request(request):
+    """
+    异步视图用：DRF 的 api_view 不支持异步视图，这里按全局配置的认证类、解析器包装请求，
+    校验登录后执行 _prepare_fork_chat（ORM、MongoDB 都是同步的，由 sync_to_async 放到线程中执行）
+    返回 (ctx, None)，出错时返回 (None, JsonResponse)
+    """
+    drf_request = Request(
+        request,
+        parsers=[parser_class() for parser_class in api_settings.DEFAULT_PARSER_CLASSES],
+        authenticators=[auth_class() for auth_class in api_settings.DEFAULT_AUTHENTICATION_CLASSES],
+    )
+    try:
+        authenticated = drf_request.user.is_authenticated
+    except APIException as e:
+        return None, _json_response({"detail": e.detail}, e.status_code)
+    if not authenticated:
+        return None, _json_response({"detail": str(NotAuthenticated.default_detail)}, 401)
+
+    ctx, error = _prepare_fork_chat(drf_request)
+    if error is not None:
+        return None, _json_response(error.data, error.status_code)
+    return ctx, None
+
+
+@csrf_exempt
+@require_POST
+async def fork_chat(request):
+    """
+    fork 后续聊天（异步视图：等待模型回复期间不占用线程，网关的并发、排队限制才能真正生效）
+    POST /api/fork/fork_chat/  参数：room_id、message
+    """
+    ctx, error = await sync_to_async(_prepare_async_request)(request)
+    if error is not None:
+        return error
 
     # 调用 Gemini API
     try:
@@ -279,130 +445,91 @@ def fork_chat(request):
         # )
 
         # # 调用 generate_content（非流式）
-        # response = model.generate_content(contents_final)
+        # response = model.generate_content(ctx["contents_final"])
 
 
 
 
-        # 把这里换成你的代理地址（一定要带 https:// 和 /v1）
-        base_url = "https://api.evopower.net/v1"    # 例如：https://api.gemini-proxy.com/v1
+        # 通过进程内网关调用（复用连接池、限制并发），流式请使用 fork_chat_stream
+        response_text = await get_gateway().acomplete(ctx["user_id"], **_completion_kwargs(ctx))
 
-        client = OpenAI(
-            api_key="sk-qaeqm7Tsdm3sWuxvWknKnbCEKHjPzxgnRhNAsxxBF8EUD7O9",  # 大部分国内代理随便填或留空
-            base_url=base_url
-        )
-
-        messages_openai = []
-        
-        for msg in contents_final:
-
-            role = msg["role"]
-            parts = msg["parts"]
-            if role == "model":
-                role = "assistant"    # 关键替换
-            
-            messages_openai.append({
-                "role": role,
-                "content": parts[0]["text"]
-            })
-
-        response = client.chat.completions.create(
-            model="gemini-2.5-pro-c",        
-            messages=messages_openai,
-            temperature=temperature,
-            top_p=top_p,
-            max_tokens=max_output_tokens,
-            stream=False   # 如果要流式就改成 True
-        )
-
-
-
-        # 取结果
-        response_text = response.choices[0].message.content
-
-
-        mes_html = format_message(
-            content=response_text,
-            placement=2,  # AI_OUTPUT
-            is_markdown=True,
-            is_prompt=True,
-            is_edit=False,
-            depth=0,
-            character_regex_scripts=character_regex_scripts
-        )
-        # print("mes_html")
-        # print(mes_html)
-
-        # 获取当前日期时间（或指定日期时间）
-        current_date = datetime.now()  # 当前时间
-        # 或者指定具体日期时间，例如：
-        # current_date = datetime(2025, 9, 30, 17, 51)
-
-        # 格式化为 "September 30, 2025 5:51pm"
-        formatted_date = current_date.strftime("%B %d, %Y %I:%M%p").replace("AM", "am").replace("PM", "pm")
-
-        floor_ai = collection.count_documents({}) + 1
-
-        collection.insert_one({
-            "username": user_name,
-            "uid": user_id,
-            "character_name": character_name,
-            "character_date": "",
-            "room_id": room_id,
-            "room_name": "",
-            "data_type": "ai",
-            "data": {"name":character_name,"is_user":False,"send_date":formatted_date,"mes":response_text},
-            "mes_html": mes_html,
-            "floor": floor_ai
-        })
+        await sync_to_async(_save_ai_reply)(ctx, response_text)
         # ------------------ 返回结果 ------------------
-        result = []
-
-        # 从 MongoDB 查询最新的两条聊天记录，按插入顺序排列
-        chat_records = list(collection.find({}).sort("_id", -1).limit(2))  # 获取最新的2条消息
-        chat_records.reverse()  # 反转顺序，使得最新的消息在前
-
-        # 遍历聊天记录，只返回 'user' 或 'ai' 类型的消息
-        for item in chat_records:
-            data = item.get("data", {})
-            data_type = item.get("data_type")  # 获取消息类型（user 或 ai）
-
-            # 只返回 'user' 或 'ai' 类型的消息
-            if data_type not in ['user', 'ai']:
-                continue
-
-            send_date =  timezone.now().isoformat() + 'Z'
-
-
-            filtered_data = {
-                "name": data.get("name"),
-                "is_user": data.get("is_user"),
-                "send_date": send_date,
-                "mes": data.get("mes")
-            }
+        result = await sync_to_async(_latest_result)(ctx["room_id"])
 
-            # 添加消息到结果
-            result.append({
-                "floor": item.get("floor", 0),
-                "data_type": data_type,  # 'user' 或 'ai'
-                "data": filtered_data,
-                "mes_html": item.get("mes_html", "")
-            })
-
-        return Response({
+        return _json_response({
             "code": 0,
             "message": "success",
             "data": result
         }, status=200)
 
 
+    except LLMGatewayBusy as e:
+        return _json_response({
+            "code": 1,
+            "message": f"当前请求过多，请稍后再试: {str(e)}"
+        }, status=503)
     except Exception as e:
-        return Response({
+        return _json_response({
             "code": 1,
             "message": f"调用 Gemini API 失败: {str(e)}"
         }, status=500)
 
 
 
+def _sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
 
 
+async def _stream_fork_chat(ctx):
+    """
+    逐个转发模型输出的 token，生成结束后格式化并写入 MongoDB
+    事件：delta（增量文本）→ done（与 fork_chat 相同的最新两条记录）；出错时为 error
+    异步生成器：ASGI 下 token 到达即发送；同步生成器会被 Django 整个读完后才发送
+    """
+    chunks = []
+    tokens = get_gateway().astream(ctx["user_id"], **_completion_kwargs(ctx))
+    try:
+        async for text in tokens:
+            chunks.append(text)
+            yield _sse("delta", {"text": text})
+    except LLMGatewayBusy as e:
+        yield _sse("error", {"code": 1, "message": f"当前请求过多，请稍后再试: {str(e)}"})
+        return
+    except asyncio.CancelledError:
+        # 客户端断开：Django 取消响应任务，关闭网关的流即取消上游请求，模型不再继续生成，也不保存半截回复
+        print(f"[FORK] 客户端断开，取消生成: {ctx['room_id']}")
+        raise
+    except Exception as e:
+        print(traceback.format_exc())
+        yield _sse("error", {"code": 1, "message": f"调用 Gemini API 失败: {str(e)}"})
+        return
+    finally:
+        await tokens.aclose()
+
+    try:
+        await sync_to_async(_save_ai_reply)(ctx, "".join(chunks))
+        result = await sync_to_async(_latest_result)(ctx["room_id"])
+        yield _sse("done", {"code": 0, "message": "success", "data": result})
+    except Exception as e:
+        print(traceback.format_exc())
+        yield _sse("error", {"code": 1, "message": f"保存 AI 回复失败: {str(e)}"})
+
+
+@csrf_exempt
+@require_POST
+async def fork_chat_stream(request):
+    """
+    fork 后续聊天（流式，Server-Sent Events，异步视图）
+    POST /api/fork/fork_chat_stream/  参数、认证方式与 fork_chat 相同
+    模型每输出一段就推送 event: delta，生成完成并保存后推送 event: done
+    """
+    ctx, error = await sync_to_async(_prepare_async_request)(request)
+    if error is not None:
+        return error
+
+    response = StreamingHttpResponse(_stream_fork_chat(ctx), content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    # 关闭 nginx 缓冲，token 到达即转发
+    response["X-Accel-Buffering"] = "no"
+    return response
@@ -1,9 +1,68 @@
 import re
 import json
+import hashlib
+import threading
+from collections import OrderedDict
 from typing import List, Dict, Any, Optional, Union
 import html
 import markdown
 from markdown.extensions import Extension
+from django.conf import settings
+
+from chatApp.api.common.connections import get_redis
+
+
+_GROUP_REF = re.compile(r'\$(\d+)')
+
+PIPELINE_CACHE_SIZE = 256
+
+
+class CompiledRegexScript:
+    """
+    预编译的单个正则脚本：正则、替换模板（字面量 / 分组编号片段）、修剪字符串都在编译时处理好
+    """
+    __slots__ = ('name', 'pattern', 'segments', 'has_groups', 'trim_strings', 'run_on_edit',
+                 'min_depth', 'max_depth', '_substitute')
+
+    def __init__(self, formatter, script: Dict, pattern: re.Pattern):
+        self.name = script.get('scriptName')
+        self.pattern = pattern
+        replace_string = (script.get('replaceString') or '').replace('{{match}}', '$0')
+        # re.split 的结果：偶数位是字面量，奇数位是分组编号
+        parts = _GROUP_REF.split(replace_string)
+        self.segments = tuple(part if i % 2 == 0 else int(part) for i, part in enumerate(parts))
+        self.has_groups = len(self.segments) > 1
+        self.trim_strings = tuple(formatter.substitute_params(t) for t in script.get('trimStrings') or [])
+        self.run_on_edit = script.get('runOnEdit', False)
+        self.min_depth = script.get('minDepth')
+        self.max_depth = script.get('maxDepth')
+        self._substitute = formatter.substitute_params
+
+    def _replace(self, match):
+        group_count = match.re.groups
+        out = []
+        for i, segment in enumerate(self.segments):
+            if i % 2 == 0:
+                out.append(segment)
+            elif segment <= group_count:
+                text = match.group(segment)
+                if text is not None:
+                    for trim_string in self.trim_strings:
+                        text = text.replace(trim_string, '')
+                    out.append(text)
+        return self._substitute(''.join(out))
+
+    def apply(self, raw_string: str) -> str:
+        if not raw_string:
+            return raw_string
+        try:
+            if self.has_groups:
+                return self.pattern.sub(self._replace, raw_string)
+            literal = self._substitute(self.segments[0])
+            return self.pattern.sub(lambda match: literal, raw_string)
+        except Exception as e:
+            print(f"Error running regex script {self.name}: {e}")
+            return raw_string
 
 
 class MessageFormatter:
@@ -102,6 +161,12 @@ class MessageFormatter:
             }
         ]
 
+        # (角色脚本哈希, placement, is_markdown, is_prompt) -> 编译好的脚本元组
+        self._pipelines = OrderedDict()
+        self._pipelines_lock = threading.Lock()
+        # (上一次的角色脚本列表, 它的哈希)：同一次渲染的多条消息传入同一个列表，按对象身份复用哈希，省去每条消息的序列化
+        self._last_scripts = (None, '')
+
     def sanitize_regex_macro(self, text: str) -> str:
         """转义正则表达式中的特殊字符"""
         if not text or not isinstance(text, str):
@@ -236,6 +301,74 @@ class MessageFormatter:
             print(f"Error running regex script {regex_script.get('scriptName')}: {e}")
             return raw_string
 
+    def compile_regex_script(self, regex_script: Dict) -> Optional[CompiledRegexScript]:
+        """按 run_regex_script 的规则解析 findRegex 并编译，无效脚本返回 None"""
+        if not regex_script or regex_script.get('disabled') or not regex_script.get('findRegex'):
+            return None
+
+        substitute_regex = regex_script.get('substituteRegex', 0)
+        if substitute_regex == self.substitute_find_regex['RAW']:
+            regex_string = self.substitute_params_extended(regex_script['findRegex'])
+        elif substitute_regex == self.substitute_find_regex['ESCAPED']:
+            regex_string = self.substitute_params_extended(regex_script['findRegex'], {}, self.sanitize_regex_macro)
+        else:
+            regex_string = regex_script['findRegex']
+
+        find_regex = self.regex_from_string(regex_string)
+        if not find_regex:
+            return None
+        return CompiledRegexScript(self, regex_script, find_regex)
+
+    def _build_pipeline(self, all_regex_scripts: List[Dict], placement: int,
+                        is_markdown: bool, is_prompt: bool) -> tuple:
+        """按 placement 和 Markdown / Prompt 条件筛选脚本并编译，保持数组顺序"""
+        pipeline = []
+        for script in all_regex_scripts:
+            if script.get('disabled'):
+                continue
+            markdown_condition = (script.get('markdownOnly') and is_markdown)
+            prompt_condition = (script.get('promptOnly') and is_prompt)
+            general_condition = (not script.get('markdownOnly') and
+                                 not script.get('promptOnly') and
+                                 not is_markdown and not is_prompt)
+            if not (markdown_condition or prompt_condition or general_condition):
+                continue
+            if placement not in script.get('placement', []):
+                continue
+            compiled = self.compile_regex_script(script)
+            if compiled is not None:
+                pipeline.append(compiled)
+        return tuple(pipeline)
+
+    def get_pipeline(self, placement: int, is_markdown: bool = False, is_prompt: bool = False,
+                     character_regex_scripts: Optional[List[Dict]] = None) -> tuple:
+        """
+        取编译好的脚本管道，按角色脚本内容的哈希缓存，同一张角色卡的消息不再重复解析、编译正则
+        """
+        scripts_hash = ''
+        if character_regex_scripts:
+            last_scripts, scripts_hash = self._last_scripts
+            if last_scripts is not character_regex_scripts:
+                scripts_hash = hashlib.sha1(json.dumps(
+                    character_regex_scripts, sort_keys=True, ensure_ascii=False, default=str
+                ).encode('utf-8')).hexdigest()
+                self._last_scripts = (character_regex_scripts, scripts_hash)
+        key = (scripts_hash, placement, bool(is_markdown), bool(is_prompt))
+
+        with self._pipelines_lock:
+            pipeline = self._pipelines.get(key)
+            if pipeline is not None:
+                self._pipelines.move_to_end(key)
+                return pipeline
+
+        all_regex_scripts = self.regex_scripts + (character_regex_scripts or [])
+        pipeline = self._build_pipeline(all_regex_scripts, placement, is_markdown, is_prompt)
+        with self._pipelines_lock:
+            self._pipelines[key] = pipeline
+            while len(self._pipelines) > PIPELINE_CACHE_SIZE:
+                self._pipelines.popitem(last=False)
+        return pipeline
+
     def get_regexed_string(self, raw_string: str, placement: int, 
                         character_override: Optional[str] = None,
                         is_markdown: bool = False, 
@@ -249,51 +382,29 @@ class MessageFormatter:
             return ''
 
         final_string = raw_string
-        if character_regex_scripts:
-            all_regex_scripts = self.regex_scripts + character_regex_scripts
-        else :
-            all_regex_scripts = self.regex_scripts
-
-        # 遍历所有正则脚本，按照数组顺序执行
-        for script in all_regex_scripts:
-            if script.get('disabled'):
-                continue
-                
-            # 检查 Markdown 和 Prompt 条件
-            markdown_condition = (script.get('markdownOnly') and is_markdown)
-            prompt_condition = (script.get('promptOnly') and is_prompt)
-            general_condition = (not script.get('markdownOnly') and 
-                            not script.get('promptOnly') and 
-                            not is_markdown and not is_prompt)
-            
-            if not (markdown_condition or prompt_condition or general_condition):
-                continue
+        pipeline = self.get_pipeline(placement, is_markdown, is_prompt,
+                                     character_regex_scripts if isinstance(character_regex_scripts, list) else None)
 
+        # 按照数组顺序执行已编译的脚本（placement、Markdown / Prompt 条件已在编译时筛选）
+        for script in pipeline:
             # 检查编辑条件
-            if is_edit and not script.get('runOnEdit', False):
-                print(f"getRegexedString: Skipping script {script.get('scriptName')} because it does not run on edit")
+            if is_edit and not script.run_on_edit:
+                print(f"getRegexedString: Skipping script {script.name} because it does not run on edit")
                 continue
 
             # 检查深度条件
             if depth is not None:
-                min_depth = script.get('minDepth')
-                max_depth = script.get('maxDepth')
-                
-                if min_depth is not None and depth < min_depth:
-                    print(f"getRegexedString: Skipping script {script.get('scriptName')} because depth {depth} is less than minDepth {min_depth}")
+                if script.min_depth is not None and depth < script.min_depth:
+                    print(f"getRegexedString: Skipping script {script.name} because depth {depth} is less than minDepth {script.min_depth}")
                     continue
-                    
-                if max_depth is not None and depth > max_depth:
-                    print(f"getRegexedString: Skipping script {script.get('scriptName')} because depth {depth} is greater than maxDepth {max_depth}")
+
+                if script.max_depth is not None and depth > script.max_depth:
+                    print(f"getRegexedString: Skipping script {script.name} because depth {depth} is greater than maxDepth {script.max_depth}")
                     continue
 
-            # 检查位置条件
-            if placement in script.get('placement', []):
-                print(f"Applying regex script: {script.get('scriptName')}")
-                # 每个脚本都在前一个脚本处理结果的基础上继续处理
-                final_string = self.run_regex_script(script, final_string, {
-                    'characterOverride': character_override
-                })
+            print(f"Applying regex script: {script.name}")
+            # 每个脚本都在前一个脚本处理结果的基础上继续处理
+            final_string = script.apply(final_string)
 
         return final_string
 
@@ -332,12 +443,43 @@ class MessageFormatter:
 # 创建全局实例
 _formatter_instance = MessageFormatter()
 
+# 渲染结果缓存：内容 + 正则脚本 + 参数 相同的消息直接复用 mes_html
+# 修改格式化逻辑（内置脚本、replace_quotes 等）时修改 HTML_CACHE_VERSION，旧缓存自然失效
+HTML_CACHE_VERSION = 1
+HTML_CACHE_PREFIX = "mes_html"
+HTML_CACHE_TTL = getattr(settings, "MES_HTML_CACHE_TTL", 7 * 24 * 3600)
+HTML_CACHE_MIN_LENGTH = getattr(settings, "MES_HTML_CACHE_MIN_LENGTH", 200)
+
+_BUILTIN_SCRIPTS_HASH = hashlib.sha1(
+    json.dumps(_formatter_instance.regex_scripts, sort_keys=True, ensure_ascii=False).encode('utf-8')
+).hexdigest()
+
+
+def render_key(character_regex_scripts=None) -> str:
+    """
+    渲染指纹：格式化逻辑版本 + 内置脚本 + 角色卡正则脚本
+    写入消息时保存在 mes_html_key 上，指纹变化说明 mes_html 需要重新渲染（见 rerender_mes_html 命令）
+    """
+    scripts = json.dumps(character_regex_scripts or [], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha1(f"{HTML_CACHE_VERSION}\0{_BUILTIN_SCRIPTS_HASH}\0{scripts}".encode('utf-8')).hexdigest()
+
+
+def _html_cache_key(content, placement, is_markdown, is_prompt, is_edit, depth, character_regex_scripts):
+    digest = hashlib.sha1()
+    for part in (render_key(character_regex_scripts),
+                 f"{placement}:{int(is_markdown)}:{int(is_prompt)}:{int(is_edit)}:{depth}", content):
+        digest.update(part.encode('utf-8'))
+        digest.update(b'\0')
+    return f"{HTML_CACHE_PREFIX}:{digest.hexdigest()}"
+
+
 def format_message(content: str, placement: int = 2, 
                   is_markdown: bool = True, 
                   is_prompt: bool = True,
                   is_edit: bool = False,
                   depth: int = 0,
-                  character_regex_scripts: Optional[List[Dict]] = None) -> str:
+                  character_regex_scripts: Optional[List[Dict]] = None,
+                  use_cache: bool = True) -> str:
     """
     外部调用的消息格式化函数
     
@@ -348,10 +490,22 @@ def format_message(content: str, placement: int = 2,
         is_prompt: 是否是提示内容
         is_edit: 是否是编辑操作
         depth: 深度级别
+        use_cache: 是否读写渲染结果缓存（短消息不走缓存）
         
     Returns:
         格式化后的内容
     """
+    cache_key = None
+    if use_cache and isinstance(content, str) and len(content) >= HTML_CACHE_MIN_LENGTH:
+        cache_key = _html_cache_key(content, placement, is_markdown, is_prompt, is_edit, depth,
+                                    character_regex_scripts)
+        try:
+            cached = get_redis().get(cache_key)
+            if cached is not None:
+                return cached.decode('utf-8') if isinstance(cached, bytes) else cached
+        except Exception as e:
+            print(f"[FORMAT] 读取渲染缓存失败，直接渲染: {e}")
+            cache_key = None
 
     mes = _formatter_instance.messageFormatting(
         content=content,
@@ -364,79 +518,88 @@ def format_message(content: str, placement: int = 2,
     )
     mes = replace_quotes(mes)
 
+    if cache_key is not None:
+        try:
+            get_redis().set(cache_key, mes, ex=HTML_CACHE_TTL)
+        except Exception as e:
+            print(f"[FORMAT] 写入渲染缓存失败: {e}")
+
     return mes
 
 
-def replace_quotes(mes):
-    def replacement_html(match):
-            contents = match.group(1)  # 捕获 HTML 标签内容
-            return f'<{contents.replace('"', '\ufffe')}>'
-
-    mes = re.sub(r'<([^>]+)>', replacement_html, mes, flags=re.MULTILINE)
-
-
-    def replacement(match):
-        # 捕获组对应正则表达式中的括号组
-        p1 = match.group(1)  # 英文双引号
-        p2 = match.group(2)  # 花括号双引号
-        p3 = match.group(3)  # 法语双角引号
-        p4 = match.group(4)  # 日式角引号
-        p5 = match.group(5)  # 日式白角引号
-        p6 = match.group(6)  # 全角双引号
-
-        if p1:
-            # 英文双引号
-            return f'<q>"{p1[1:-1]}"</q>'
-        elif p2:
-            # 花括号双引号 “ ”
-            return f'<q>“{p2[1:-1]}”</q>'
-        elif p3:
-            # 法语双角引号 « »
-            return f'<q>«{p3[1:-1]}»</q>'
-        elif p4:
-            # 日式角引号 「 」
-            return f'<q>「{p4[1:-1]}」</q>'
-        elif p5:
-            # 日式白角引号 『 』
-            return f'<q>『{p5[1:-1]}』</q>'
-        elif p6:
-            # 全角双引号 ＂ ＂
-            return f'<q>＂{p6[1:-1]}＂</q>'
-        else:
-            # 返回原始匹配内容（<style> 或代码块）
-            return match.group(0)
+# HTML 标签（标签内的英文双引号不作为引号处理）
+_HTML_TAG = re.compile(r'<[^>]+>')
 
-    # 正则表达式，与 JavaScript 版本一致
-    pattern = r'<style>[\s\S]*?</style>|```[\s\S]*?```|~~~[\s\S]*?~~~|``[\s\S]*?``|`[\s\S]*?`|(".*?")|(\u201C.*?\u201D)|(\u00AB.*?\u00BB)|(\u300C.*?\u300D)|(\u300E.*?\u300F)|(\uFF02.*?\uFF02)'
-    
-    # 使用 re.sub 进行替换，flags=re.MULTILINE 对应 JavaScript 的 /m
-    mes = re.sub(pattern, replacement, mes, flags=re.MULTILINE | re.IGNORECASE)
+# 正则表达式，与 JavaScript 版本一致；flags=re.MULTILINE 对应 JavaScript 的 /m
+_QUOTE_PATTERN = re.compile(
+    r'<style>[\s\S]*?</style>|```[\s\S]*?```|~~~[\s\S]*?~~~|``[\s\S]*?``|`[\s\S]*?`'
+    r'|(".*?")|(“.*?”)|(«.*?»)|(「.*?」)|(『.*?』)|(＂.*?＂)',
+    re.MULTILINE | re.IGNORECASE
+)
 
-    # 还原html
-    mes = mes.replace('\ufffe', '"')
+# Markdown 输出后处理：<code> 块（去换行、还原 <br>、还原 &amp;）和 <br>（还原为换行）一次扫描完成
+_CODE_OR_BR = re.compile(r'(<code[^>]*>[\s\S]*?</code>)|(?i:<br\s*/?>)', re.MULTILINE)
+_BR = re.compile(r'<br\s*/?>', re.MULTILINE | re.IGNORECASE)
 
+MARKDOWN_EXTENSIONS = ['extra', 'fenced_code', 'codehilite']
 
+# Markdown 实例构建（加载扩展、编译正则）开销不小，每个线程复用一个，转换前 reset()
+_markdown_local = threading.local()
 
-    mes = mes.replace(r'\begin{align*}', '$$')
-    mes = mes.replace(r'\end{align*}', '$$')
 
-    # 2. Markdown 转 HTML
-    mes = markdown.markdown(mes, extensions=['extra', 'fenced_code', 'codehilite'])
+def _markdown_to_html(text):
+    md = getattr(_markdown_local, 'md', None)
+    if md is None:
+        md = _markdown_local.md = markdown.Markdown(extensions=MARKDOWN_EXTENSIONS)
+    else:
+        md.reset()
+    return md.convert(text)
 
-    # 3. 清理 <code> 块中的换行符
-    mes = re.sub(r'<code[^>]*>[\s\S]*?</code>', lambda match: match.group(0).replace('\n', ''), mes, flags=re.MULTILINE)
 
-    # 4. 还原 <br> 为换行符
-    mes = re.sub(r'<br\s*/?>', '\n', mes, flags=re.MULTILINE | re.IGNORECASE)
+def _mask_tag_quotes(match):
+    return match.group(0).replace('"', '\ufffe')
 
-    # 5. 清理首尾空白
-    mes = mes.strip()
 
-    # 6. 还原 <code> 块中的 &amp; 为 &
-    mes = re.sub(r'<code[^>]*>[\s\S]*?</code>', lambda match: match.group(0).replace('&amp;', '&'), mes, flags=re.MULTILINE)
+def _wrap_quote(match):
+    # 捕获组对应正则表达式中的括号组：英文双引号、花括号双引号、法语双角引号、日式角引号、日式白角引号、全角双引号
+    index = match.lastindex
+    if index is None:
+        # 返回原始匹配内容（<style> 或代码块）
+        return match.group(0)
+    text = match.group(index)
+    return f'<q>{text[0]}{text[1:-1]}{text[-1]}</q>'
 
 
-    return mes
+def _clean_code_or_br(match):
+    code = match.group(1)
+    if code is None:
+        # 还原 <br> 为换行符
+        return '\n'
+    # 清理 <code> 块中的换行符，还原其中的 <br> 和 &amp;
+    code = code.replace('\n', '')
+    if '<' in code:
+        code = _BR.sub('\n', code)
+    return code.replace('&amp;', '&')
+
+
+def replace_quotes(mes):
+    # 1. 引号包裹 <q>：标签内的英文双引号先替换为 \ufffe，避免被当成引号，处理完再还原
+    if '"' in mes and '<' in mes:
+        mes = _HTML_TAG.sub(_mask_tag_quotes, mes)
+    mes = _QUOTE_PATTERN.sub(_wrap_quote, mes)
+    if '\ufffe' in mes:
+        mes = mes.replace('\ufffe', '"')
+
+    mes = mes.replace(r'\begin{align*}', '$$')
+    mes = mes.replace(r'\end{align*}', '$$')
+
+    # 2. Markdown 转 HTML
+    mes = _markdown_to_html(mes)
+
+    # 3. 清理 <code> 块、还原 <br>，再清理首尾空白
+    mes = _CODE_OR_BR.sub(_clean_code_or_br, mes)
+    return mes.strip()
+
 
 
 
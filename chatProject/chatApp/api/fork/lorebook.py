@@ -0,0 +1,208 @@
+"""
+角色卡世界书（character_book）条目激活
+- 只注入最近 scan_depth 条消息中出现了关键词的条目，constant 条目始终注入
+- keys 任意一个命中即触发；selective 条目还需满足 secondary_keys（extensions.selectiveLogic：
+  0 AND ANY / 1 NOT ALL / 2 NOT ANY / 3 AND ALL）
+- 关键词用 Aho-Corasick 自动机一次扫描全部匹配，/pattern/flags 形式的关键词按正则匹配
+- recursive_scanning 时已激活条目的内容也会参与扫描（最多 LOREBOOK_MAX_RECURSION 轮）
+- 超过 token_budget 时先丢弃 priority 低的条目，注入顺序按 insertion_order
+自动机按角色卡缓存在进程内，角色卡内容变化时重新构建
+"""
+
+import re
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+
+from chatApp.api.common.keywords import KeywordMatcher
+from chatApp.api.common.tokens import estimate_tokens
+
+LOREBOOK_SCAN_DEPTH = getattr(settings, "LOREBOOK_SCAN_DEPTH", 2)
+LOREBOOK_TOKEN_BUDGET = getattr(settings, "LOREBOOK_TOKEN_BUDGET", 4096)
+LOREBOOK_MAX_RECURSION = getattr(settings, "LOREBOOK_MAX_RECURSION", 3)
+LOREBOOK_CACHE_SIZE = getattr(settings, "LOREBOOK_CACHE_SIZE", 256)
+
+AND_ANY, NOT_ALL, NOT_ANY, AND_ALL = 0, 1, 2, 3
+
+_REGEX_KEY = re.compile(r"^/(.+)/([imsx]*)$", re.S)
+
+
+class _Entry:
+    __slots__ = ("content", "tokens", "order", "priority", "constant", "keys", "secondary", "logic")
+
+    def __init__(self, row, keys, secondary):
+        extensions = row.get("extensions") or {}
+        self.content = row.get("content") or ""
+        self.tokens = estimate_tokens(self.content)
+        self.order = _to_int(row.get("insertion_order"), 100)
+        self.priority = _to_int(row.get("priority"), 10)
+        self.constant = bool(row.get("constant"))
+        self.keys = keys
+        self.secondary = secondary if row.get("selective") else frozenset()
+        self.logic = _to_int(extensions.get("selectiveLogic"), AND_ANY)
+
+    def is_active(self, found):
+        if self.constant:
+            return True
+        if not self.keys & found:
+            return False
+        if not self.secondary:
+            return True
+        hits = len(self.secondary & found)
+        if self.logic == NOT_ALL:
+            return hits < len(self.secondary)
+        if self.logic == NOT_ANY:
+            return hits == 0
+        if self.logic == AND_ALL:
+            return hits == len(self.secondary)
+        return hits > 0
+
+
+def _to_int(value, default):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return default
+
+
+class Lorebook:
+    def __init__(self, character_book):
+        self.scan_depth = _to_int(character_book.get("scan_depth"), LOREBOOK_SCAN_DEPTH)
+        self.token_budget = _to_int(character_book.get("token_budget"), LOREBOOK_TOKEN_BUDGET)
+        self.recursive = bool(character_book.get("recursive_scanning"))
+
+        self._key_ids = {}     # (关键词, 是否区分大小写) -> 关键词编号
+        self._insensitive = []  # 不区分大小写的关键词（小写）
+        self._insensitive_ids = []
+        self._sensitive = []
+        self._sensitive_ids = []
+        self._regex = []       # (关键词编号, 编译好的正则)
+        self.entries = []
+        self.constants = []
+        self.by_key = {}       # 关键词编号 -> 条目列表
+
+        entries = character_book.get("entries") or []
+        if isinstance(entries, dict):
+            entries = list(entries.values())
+        for row in entries:
+            if not isinstance(row, dict) or row.get("enabled") is False or not row.get("content"):
+                continue
+            case_sensitive = bool(row.get("case_sensitive"))
+            keys = self._compile_keys(row.get("keys"), case_sensitive)
+            entry = _Entry(row, keys, self._compile_keys(row.get("secondary_keys"), case_sensitive))
+            self.entries.append(entry)
+            if entry.constant:
+                self.constants.append(entry)
+            for key_id in keys:
+                self.by_key.setdefault(key_id, []).append(entry)
+
+        self._insensitive_matcher = KeywordMatcher(self._insensitive)
+        self._sensitive_matcher = KeywordMatcher(self._sensitive)
+
+    def _compile_keys(self, keys, case_sensitive):
+        if isinstance(keys, str):
+            keys = [keys]
+        ids = set()
+        for key in keys or []:
+            if not isinstance(key, str) or not key.strip():
+                continue
+            key = key.strip()
+            regex = _REGEX_KEY.match(key)
+            if not regex and not case_sensitive:
+                key = key.lower()
+            cache_key = (key, case_sensitive or bool(regex))
+            key_id = self._key_ids.get(cache_key)
+            if key_id is None:
+                key_id = self._key_ids[cache_key] = len(self._key_ids)
+                if regex:
+                    flags = sum({"i": re.I, "m": re.M, "s": re.S, "x": re.X}[f] for f in set(regex.group(2)))
+                    try:
+                        self._regex.append((key_id, re.compile(regex.group(1), flags)))
+                    except re.error:
+                        pass
+                elif case_sensitive:
+                    self._sensitive.append(key)
+                    self._sensitive_ids.append(key_id)
+                else:
+                    self._insensitive.append(key)
+                    self._insensitive_ids.append(key_id)
+            ids.add(key_id)
+        return frozenset(ids)
+
+    def _scan(self, text):
+        # KeywordMatcher 返回的是各自列表中的下标，转换成关键词编号
+        found = set()
+        if self._insensitive:
+            found.update(self._insensitive_ids[i] for i in self._insensitive_matcher.search(text.lower()))
+        if self._sensitive:
+            found.update(self._sensitive_ids[i] for i in self._sensitive_matcher.search(text))
+        for key_id, pattern in self._regex:
+            if pattern.search(text):
+                found.add(key_id)
+        return found
+
+    def activate(self, recent_messages):
+        """
+        recent_messages: 最近的消息文本（不需要排序，调用方按 scan_depth 截取）
+        返回需要注入的条目内容，按 insertion_order 拼接
+        """
+        text = "\n".join(mes for mes in recent_messages if isinstance(mes, str))
+        found = set()
+        active = {id(entry): entry for entry in self.constants}
+        rounds = 1 + (LOREBOOK_MAX_RECURSION if self.recursive else 0)
+        for _ in range(rounds):
+            new_keys = self._scan(text) - found
+            if not new_keys:
+                break
+            found |= new_keys
+            added = []
+            for key_id in new_keys:
+                for entry in self.by_key.get(key_id, ()):
+                    if id(entry) not in active and entry.is_active(found):
+                        active[id(entry)] = entry
+                        added.append(entry)
+            if not added:
+                break
+            # 递归扫描：新激活条目的内容可能触发其他条目
+            text = "\n".join(entry.content for entry in added)
+
+        # secondary_keys 可能在后面的轮次才命中，最后再统一检查一次
+        for key_id in found:
+            for entry in self.by_key.get(key_id, ()):
+                if id(entry) not in active and entry.is_active(found):
+                    active[id(entry)] = entry
+
+        selected = []
+        used = 0
+        for entry in sorted(active.values(), key=lambda e: (not e.constant, -e.priority, e.order)):
+            if used + entry.tokens > self.token_budget:
+                continue
+            selected.append(entry)
+            used += entry.tokens
+        selected.sort(key=lambda e: e.order)
+        return "\n".join(entry.content for entry in selected)
+
+
+_cache = OrderedDict()  # card_id -> (角色卡内容指纹, Lorebook)
+_cache_lock = threading.Lock()
+
+
+def get_lorebook(card_id, character_data, character_book):
+    """
+    按角色卡缓存编译好的世界书，character_data（原始 JSON 字符串）变化时重新编译
+    """
+    fingerprint = (len(character_data), hash(character_data))
+    with _cache_lock:
+        item = _cache.get(card_id)
+        if item is not None and item[0] == fingerprint:
+            _cache.move_to_end(card_id)
+            return item[1]
+
+    lorebook = Lorebook(character_book)
+    with _cache_lock:
+        _cache[card_id] = (fingerprint, lorebook)
+        _cache.move_to_end(card_id)
+        while len(_cache) > LOREBOOK_CACHE_SIZE:
+            _cache.popitem(last=False)
+    return lorebook
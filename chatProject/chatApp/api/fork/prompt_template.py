@@ -0,0 +1,129 @@
+"""
+预设模板预编译
+- 预设每个 prompt 块编译成 “字面量 + 占位符槽位” 的片段列表，拼接时只做一次 join，不再逐个 str.replace
+- 编译结果按 (room_id, 预设版本) 缓存在进程内；preset_save 保存时版本 +1 并预先编译，其他进程首次使用时编译
+- 占位符按原来链式 replace 的顺序展开：前面的值里出现的后续占位符同样会被替换
+"""
+
+import json
+import re
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+
+PRESET_PLACEHOLDERS = ("character_description", "entrie", "user", "lastUserMessage")
+HISTORY_IDENTIFIER = "chatHistory"
+
+PRESET_TEMPLATE_CACHE_SIZE = getattr(settings, "PRESET_TEMPLATE_CACHE_SIZE", 512)
+
+# system/tool 按 user 发送，assistant 对应 model
+_ROLE_MAP = {"system": "user", "tool": "user", "assistant": "model"}
+
+
+def expand_values(placeholders, values):
+    """
+    按链式 replace 的顺序展开占位符的值：第 i 个值中出现的第 i+1.. 个占位符也替换掉
+    返回与 placeholders 同序的列表
+    """
+    expanded = []
+    for i, name in enumerate(placeholders):
+        value = values.get(name, "")
+        for later in placeholders[i + 1:]:
+            token = "{{" + later + "}}"
+            if token in value:
+                value = value.replace(token, values.get(later, ""))
+        expanded.append(value)
+    return expanded
+
+
+class PromptTemplate:
+    """一段文本编译成片段列表：偶数位是字面量，奇数位在渲染时填入占位符的值"""
+
+    def __init__(self, text, placeholders):
+        pattern = re.compile(r"\{\{(" + "|".join(re.escape(name) for name in placeholders) + r")\}\}")
+        index = {name: i for i, name in enumerate(placeholders)}
+        self.parts = pattern.split(text or "")
+        self.slots = [(i, index[self.parts[i]]) for i in range(1, len(self.parts), 2)]
+
+    def render(self, expanded):
+        if not self.slots:
+            return self.parts[0]
+        parts = self.parts[:]
+        for position, slot in self.slots:
+            parts[position] = expanded[slot]
+        return "".join(parts)
+
+
+class CompiledPreset:
+    """
+    编译好的预设：blocks 为 (role, PromptTemplate)，聊天历史的位置为 (None, None)
+    """
+
+    def __init__(self, preset_json):
+        preset_json_list = json.loads(preset_json) if isinstance(preset_json, str) else preset_json
+        self.blocks = []
+        for data in preset_json_list or []:
+            if data.get("identifier", "") == HISTORY_IDENTIFIER:
+                self.blocks.append((None, None))
+            else:
+                self.blocks.append((data.get("role", "user"), PromptTemplate(data.get("content", ""), PRESET_PLACEHOLDERS)))
+
+    def render(self, values):
+        """
+        返回 (contents, 聊天历史插入位置列表)，contents 格式与 Gemini contents 相同
+        """
+        expanded = expand_values(PRESET_PLACEHOLDERS, values)
+        contents = []
+        history_positions = []
+        for role, template in self.blocks:
+            if template is None:
+                history_positions.append(len(contents))
+            else:
+                contents.append({"role": role, "parts": [{"text": template.render(expanded)}]})
+        return contents, history_positions
+
+
+def merge_contents(contents):
+    """相邻同角色的内容合并为一条（各段用空行分隔，一次 join）"""
+    merged = []
+    for row in contents:
+        role = row.get("role")
+        role = _ROLE_MAP.get(role, role)
+        if not role:
+            continue
+        text = row.get("parts")[0].get("text")
+        if merged and merged[-1][0] == role:
+            merged[-1][1].append(text)
+        else:
+            merged.append((role, [text]))
+    return [{"role": role, "parts": [{"text": "\n\n".join(texts)}]} for role, texts in merged]
+
+
+_cache = OrderedDict()  # (room_id, version) -> CompiledPreset
+_cache_lock = threading.Lock()
+
+
+def compile_preset(room_id, version, preset_json):
+    """编译并放入缓存（preset_save 保存后调用，预热当前进程）"""
+    compiled = CompiledPreset(preset_json)
+    key = (str(room_id), version)
+    with _cache_lock:
+        _cache[key] = compiled
+        _cache.move_to_end(key)
+        while len(_cache) > PRESET_TEMPLATE_CACHE_SIZE:
+            _cache.popitem(last=False)
+    return compiled
+
+
+def get_compiled_preset(room_id, version, load_preset_json):
+    """
+    取编译好的预设，缓存未命中时调用 load_preset_json() 读取原始 JSON 再编译
+    """
+    key = (str(room_id), version)
+    with _cache_lock:
+        compiled = _cache.get(key)
+        if compiled is not None:
+            _cache.move_to_end(key)
+            return compiled
+    return compile_preset(room_id, version, load_preset_json())
@@ -6,7 +6,10 @@ import re
 from django.views.decorators.csrf import csrf_exempt
 from rest_framework.decorators import api_view
 from rest_framework.response import Response
+from django.db import transaction
+from django.db.models import F
 from chatApp.models import Preset
+from chatApp.api.fork.prompt_template import compile_preset
 from chatApp.api.common.common import build_full_image_url,generate_new_room_id, generate_new_room_name
 from pymongo import MongoClient
 from django.conf import settings
@@ -78,20 +81,24 @@ def preset_save(request):
 
     print("来了")
     # 创建房间记录
-    preset_info, created = Preset.objects.update_or_create(
-        room_id=room_id,  # 根据room_id查找，如果存在就更新
-        defaults={
-            'preset_settings_openai': preset_settings_openai,
-            'temp_openai': temp_openai,
-            'top_k_openai': top_k_openai,
-            'top_p_openai': top_p_openai,
-            'openai_max_context': openai_max_context,
-            'openai_max_tokens': openai_max_tokens,
-            'google_model': google_model,
-            'model_n': n,
-            'preset_json': json.dumps(prompts_final, ensure_ascii=False)
-        }
-    )
+    fields = {
+        'preset_settings_openai': preset_settings_openai,
+        'temp_openai': temp_openai,
+        'top_k_openai': top_k_openai,
+        'top_p_openai': top_p_openai,
+        'openai_max_context': openai_max_context,
+        'openai_max_tokens': openai_max_tokens,
+        'google_model': google_model,
+        'model_n': n,
+        'preset_json': json.dumps(prompts_final, ensure_ascii=False)
+    }
+    # 内容和版本 +1 在同一条 UPDATE 里写入，并发保存时版本号与内容一一对应，各进程缓存的旧模板失效
+    with transaction.atomic():
+        if not Preset.objects.filter(room_id=room_id).update(version=F("version") + 1, **fields):
+            Preset.objects.create(room_id=room_id, version=1, **fields)
+        # 按读取方（.first()）看到的那一行编译，当前进程直接预热新模板
+        preset_info = Preset.objects.filter(room_id=room_id).only("version", "preset_json").first()
+    compile_preset(room_id, preset_info.version, preset_info.preset_json)
 
 
 
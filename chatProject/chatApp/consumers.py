@@ -1,96 +1,79 @@
 import json
 from asgiref.sync import async_to_sync
-from channels.generic.websocket import WebsocketConsumer
-from django_redis import get_redis_connection
+from channels.generic.websocket import WebsocketConsumer, AsyncWebsocketConsumer
 from django.conf import settings
-from urllib.parse import parse_qs
-import jwt
 import threading
+from chatApp.api.common.connections import get_redis, get_async_redis
+
 
 def get_online_redis():
-    return get_redis_connection("chat-online")
+    return get_redis("chat-online")
+
+
+def get_async_online_redis():
+    """
+    获取 chat-online 库的异步 Redis 客户端，与 django-redis 的 "chat-online" 使用同一个库
+    """
+    return get_async_redis("chat-online")
 
 
-class ChatConsumer(WebsocketConsumer):
+class ChatConsumer(AsyncWebsocketConsumer):
+    """
+    用户评论 ws（原生异步版本）
+    - 在线人数记录走异步 Redis，并通过 pipeline 合并为一次往返
+    - 不再经过 async_to_sync 线程切换
+    """
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.room_id = None
         self.room_group_id = None
         self.user_id = None
-        self.User = None  # 延迟获取 Django 用户模型
         self.idle_timer = None
 
-
-    def connect(self):
-        # 延迟导入依赖 Django 的模块，避免顶层报错
-        if self.User is None:
-            from django.contrib.auth import get_user_model
-            self.User = get_user_model()
-        from rest_framework_simplejwt.tokens import UntypedToken
-        from rest_framework_simplejwt.exceptions import InvalidToken, TokenError
-
-        # 1️⃣ 从 query string 获取 JWT
-        query_string = self.scope.get("query_string", b"").decode()
-        query_params = parse_qs(query_string)
-        token_list = query_params.get("token", [])
-        token = token_list[0] if token_list else None
-        if not token:
-            self.close()
-            return
-
-        # 2️⃣ 验证 token
-        try:
-            UntypedToken(token)
-        except (InvalidToken, TokenError):
-            self.close()
-            return
-
-        # 3️⃣ 解码 token 获取用户
-        try:
-            decoded_data = jwt.decode(token, settings.SECRET_KEY, algorithms=["HS256"])
-            user_id = decoded_data.get("user_id")
-            self.scope["user"] = self.User.objects.get(id=user_id)
-        except (jwt.InvalidTokenError, self.User.DoesNotExist):
-            self.close()
+    async def connect(self):
+        # 1️⃣ 用户由 JwtAuthMiddleware 解析 token 后放入 scope
+        user = self.scope.get("user")
+        if user is None or not user.is_authenticated:
+            await self.close()
             return
 
         self.user_id = self.scope["user"].id
 
-        # 4️⃣ 房间信息
+        # 2️⃣ 房间信息
         self.room_id = self.scope['url_route']['kwargs']['room_id']
         self.room_group_id = f"chat_{self.room_id}"
 
-        # 5️⃣ 接受 WebSocket
-        self.accept()
-
-        # 6️⃣ Redis 记录在线用户
-        r = get_online_redis()
-        r.sadd(f"room:{self.room_id}:users", self.channel_name)
-        r.sadd(f"room:{self.room_id}:visited_users", self.user_id)
-
-        # 7️⃣ 加入组
-        async_to_sync(self.channel_layer.group_add)(
-            self.room_group_id, self.channel_name
-        )
+        # 3️⃣ 接受 WebSocket
+        await self.accept()
 
+        # 4️⃣ Redis 记录在线用户（一次 pipeline 往返）
+        r = get_async_online_redis()
+        async with r.pipeline(transaction=False) as pipe:
+            pipe.sadd(f"room:{self.room_id}:users", self.channel_name)
+            pipe.sadd(f"room:{self.room_id}:visited_users", self.user_id)
+            await pipe.execute()
 
-    def disconnect(self, close_code):
-        r = get_online_redis()
-        r.srem(f"room:{self.room_id}:users", self.channel_name)
-        async_to_sync(self.channel_layer.group_discard)(
-            self.room_group_id, self.channel_name
-        )
+        # 5️⃣ 加入组
+        await self.channel_layer.group_add(self.room_group_id, self.channel_name)
 
+    async def disconnect(self, close_code):
+        # 未完成握手（token 无效等）时没有房间信息，无需清理
+        if not self.room_id:
+            return
+        r = get_async_online_redis()
+        await r.srem(f"room:{self.room_id}:users", self.channel_name)
+        await self.channel_layer.group_discard(self.room_group_id, self.channel_name)
 
-    def receive(self, text_data=None, bytes_data=None):
-        r = get_online_redis()
+    async def receive(self, text_data=None, bytes_data=None):
+        r = get_async_online_redis()
         muted_set = f"room:{self.room_id}:muted_users"
-        if r.sismember(muted_set, self.user_id):
-            self.send(text_data=json.dumps({"error": "You are muted"}))
+        if await r.sismember(muted_set, self.user_id):
+            await self.send(text_data=json.dumps({"error": "You are muted"}))
             return
 
         data = json.loads(text_data)
-        async_to_sync(self.channel_layer.group_send)(
+        await self.channel_layer.group_send(
             self.room_group_id,
             {
                 "type": "chat_user_message",
@@ -98,11 +81,11 @@ class ChatConsumer(WebsocketConsumer):
             },
         )
 
-    def chat_user_message(self, event):
-        self.send(text_data=json.dumps(event))
+    async def chat_user_message(self, event):
+        await self.send(text_data=json.dumps(event))
 
-    def chat_live_message(self, event):
-        self.send(text_data=json.dumps(event))
+    async def chat_live_message(self, event):
+        await self.send(text_data=json.dumps(event))
 
     @staticmethod
     def get_online_count(room_id: str) -> int:
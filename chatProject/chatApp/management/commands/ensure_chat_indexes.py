@@ -0,0 +1,38 @@
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.base import BaseCommand, CommandError
+
+from chatApp.models import RoomInfo
+from chatApp.api.common.connections import get_mongo_db
+from chatApp.api.common.messages import ensure_indexes, ensure_messages_indexes, is_consolidated
+
+
+class Command(BaseCommand):
+    """
+    给已有的聊天集合建 floor 索引（get_room_chat 等读接口不再建索引，新房间在第一次写入时建）
+    - per_room 模式：RoomInfo 中已经有聊天集合的房间逐个建索引，不会为没有消息的房间建出空集合
+    - consolidated 模式：只需要建 messages 集合的索引
+    python manage.py ensure_chat_indexes
+    python manage.py ensure_chat_indexes --room <room_id>
+    """
+    help = "给已有的聊天集合建 floor 索引"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--room", action="append", dest="rooms", help="只处理指定房间，可重复")
+
+    def handle(self, *args, **options):
+        if is_consolidated():
+            try:
+                ensure_messages_indexes()
+            except ImproperlyConfigured as e:
+                raise CommandError(str(e))
+            self.stdout.write(self.style.SUCCESS("messages 集合索引已就绪"))
+            return
+
+        existing = set(get_mongo_db().list_collection_names())
+        room_ids = options["rooms"] or RoomInfo.objects.values_list("room_id", flat=True).iterator()
+        done = 0
+        for room_id in room_ids:
+            if room_id in existing:
+                ensure_indexes(room_id)
+                done += 1
+        self.stdout.write(self.style.SUCCESS(f"完成 {done} 个房间"))
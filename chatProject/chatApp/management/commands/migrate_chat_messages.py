@@ -0,0 +1,103 @@
+import time
+
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.base import BaseCommand, CommandError
+from pymongo import ReplaceOne
+from pymongo.errors import BulkWriteError
+
+from chatApp.models import RoomInfo
+from chatApp.api.common.connections import get_mongo_db
+from chatApp.api.common.messages import MESSAGES_COLLECTION, ensure_messages_indexes, send_timestamp
+
+MIGRATION_STATE_COLLECTION = "messages_migration_state"
+
+
+class Command(BaseCommand):
+    """
+    把按房间分开的聊天集合（db[room_id]）批量复制到 messages 集合
+    - 每个房间按 _id 顺序复制，每批写完记录断点（messages_migration_state），中断后重新执行会从断点继续
+    - 保留原 _id，重复执行是幂等的；切换 CHAT_STORAGE_MODE 后再执行一次可补齐切换期间的新消息
+    - 不会删除原集合，确认无误后再手动清理
+    python manage.py migrate_chat_messages --batch-size 1000
+    python manage.py migrate_chat_messages --room <room_id> --restart
+    """
+    help = "把每个房间的聊天集合迁移到 messages 集合（可断点续传）"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000)
+        parser.add_argument("--room", action="append", dest="rooms", help="只迁移指定房间，可重复")
+        parser.add_argument("--restart", action="store_true", help="忽略断点，从头复制")
+        parser.add_argument("--sleep", type=float, default=0, help="每批之间暂停的秒数，降低对线上库的压力")
+
+    def handle(self, *args, **options):
+        self.db = get_mongo_db()
+        self.state = self.db[MIGRATION_STATE_COLLECTION]
+        self.batch_size = options["batch_size"]
+        self.sleep = options["sleep"]
+        # 唯一索引建不出来时不迁移：否则重复楼层会被写进 messages，之后 $merge 无法按 (room_id, floor) 匹配
+        try:
+            ensure_messages_indexes()
+        except ImproperlyConfigured as e:
+            raise CommandError(str(e))
+
+        existing = set(self.db.list_collection_names())
+        room_ids = options["rooms"] or RoomInfo.objects.values_list("room_id", flat=True).iterator()
+
+        total_copied = total_skipped = rooms_done = 0
+        for room_id in room_ids:
+            if room_id not in existing:
+                continue
+            if options["restart"]:
+                self.state.delete_one({"_id": room_id})
+            copied, skipped = self._migrate_room(room_id)
+            total_copied += copied
+            total_skipped += skipped
+            rooms_done += 1
+            if copied or skipped:
+                self.stdout.write(f"{room_id}: 复制 {copied} 条，跳过 {skipped} 条")
+
+        self.stdout.write(self.style.SUCCESS(
+            f"完成 {rooms_done} 个房间，共复制 {total_copied} 条，跳过 {total_skipped} 条（楼层重复或缺失）"
+        ))
+
+    def _migrate_room(self, room_id):
+        checkpoint = self.state.find_one({"_id": room_id}) or {}
+        query = {"_id": {"$gt": checkpoint["last_id"]}} if checkpoint.get("last_id") else {}
+        cursor = self.db[room_id].find(query).sort("_id", 1).batch_size(self.batch_size)
+
+        copied = skipped = 0
+        batch = []
+        for doc in cursor:
+            doc["room_id"] = room_id
+            if "send_ts" not in doc:
+                doc["send_ts"] = send_timestamp(doc)
+            batch.append(doc)
+            if len(batch) >= self.batch_size:
+                c, s = self._flush(room_id, batch)
+                copied, skipped, batch = copied + c, skipped + s, []
+                if self.sleep:
+                    time.sleep(self.sleep)
+        if batch:
+            c, s = self._flush(room_id, batch)
+            copied, skipped = copied + c, skipped + s
+        return copied, skipped
+
+    def _flush(self, room_id, batch):
+        """写入一批并推进断点，返回 (写入数, 跳过数)"""
+        ops = [ReplaceOne({"_id": doc["_id"]}, doc, upsert=True) for doc in batch]
+        skipped = 0
+        try:
+            self.db[MESSAGES_COLLECTION].bulk_write(ops, ordered=False)
+        except BulkWriteError as e:
+            errors = e.details.get("writeErrors", [])
+            # 只容忍 (room_id, floor) 唯一索引冲突，其他错误直接抛出，断点不推进
+            if any(error.get("code") != 11000 for error in errors):
+                raise
+            skipped = len(errors)
+
+        self.state.update_one(
+            {"_id": room_id},
+            {"$set": {"last_id": batch[-1]["_id"]}, "$inc": {"copied": len(batch) - skipped, "skipped": skipped}},
+            upsert=True
+        )
+        return len(batch) - skipped, skipped
@@ -0,0 +1,53 @@
+import signal
+import threading
+from importlib import import_module
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from chatApp.api.common.moderation import (
+    ModerationWorker, RedisStreamBackend, consumer_name, moderation_stats, MODERATION_BATCH_SIZE
+)
+
+
+class Command(BaseCommand):
+    """
+    内容审核队列 worker：以消费组方式读取 Redis Streams 中的审核任务，调用 NSFW 检测并执行结果回调
+    - 可以在多台机器上同时运行多个进程，每个线程是一个消费者
+    - 进程退出时未确认的任务在 MODERATION_CLAIM_IDLE 秒后由其他消费者认领
+    - --stats 只打印一次队列积压情况（长度、未确认数、lag、最早积压任务的等待秒数）
+    python manage.py moderation_worker --threads 4
+    python manage.py moderation_worker --stats
+    """
+    help = "运行内容审核队列 worker（Redis Streams 消费组）"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--threads", type=int, default=2)
+        parser.add_argument("--batch-size", type=int, default=MODERATION_BATCH_SIZE)
+        parser.add_argument("--stats", action="store_true", help="打印队列积压情况后退出")
+
+    def handle(self, *args, **options):
+        if options["stats"]:
+            self.stdout.write(str(moderation_stats()))
+            return
+
+        # 加载 URLconf：各模块的信号处理（图片缓存、信息流卡片等）随之注册，回调中 save 时才会触发
+        import_module(settings.ROOT_URLCONF)
+
+        stop = threading.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(sig, lambda *_: stop.set())
+
+        backend = RedisStreamBackend()
+        threads = []
+        for i in range(max(1, options["threads"])):
+            worker = ModerationWorker(backend, consumer_name(i), batch_size=options["batch_size"], block=1)
+            thread = threading.Thread(target=worker.run, args=(stop,), name=worker.consumer)
+            thread.start()
+            threads.append(thread)
+        self.stdout.write(f"审核 worker 已启动：{len(threads)} 个消费者")
+
+        while any(thread.is_alive() for thread in threads):
+            for thread in threads:
+                thread.join(timeout=1)
+        self.stdout.write(self.style.SUCCESS(f"审核 worker 已退出：{moderation_stats()['worker']}"))
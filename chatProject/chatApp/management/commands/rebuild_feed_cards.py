@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand
+from chatApp.models import RoomInfo, FeedCard
+from chatApp.api.common.feed import refresh_feed_cards
+
+
+class Command(BaseCommand):
+    """
+    全量重建首页信息流卡片（首次上线或数据修复时执行）
+    python manage.py rebuild_feed_cards --batch-size 500
+    """
+    help = "全量重建 FeedCard"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=500)
+
+    def handle(self, *args, **options):
+        batch_size = options["batch_size"]
+
+        # 符合条件的房间 + 已有卡片的房间（后者用于清理已不满足条件的卡片）
+        room_ids = set(RoomInfo.objects.filter(is_show=0, file_branch="branch").values_list("room_id", flat=True))
+        room_ids.update(FeedCard.objects.values_list("room_id", flat=True))
+
+        batch = []
+        total = 0
+        for room_id in room_ids:
+            batch.append(room_id)
+            if len(batch) >= batch_size:
+                refresh_feed_cards(batch)
+                total += len(batch)
+                batch = []
+
+        if batch:
+            refresh_feed_cards(batch)
+            total += len(batch)
+
+        self.stdout.write(self.style.SUCCESS(f"已处理 {total} 个房间的信息流卡片"))
@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+from chatApp.models import RoomInfo
+from chatApp.api.common.tag_index import reindex_room_tags
+
+
+class Command(BaseCommand):
+    """
+    全量重建房间标签倒排索引（首次上线或数据修复时执行）
+    python manage.py rebuild_room_tag_index --batch-size 500
+    """
+    help = "全量重建 RoomTagIndex"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=500)
+
+    def handle(self, *args, **options):
+        batch_size = options["batch_size"]
+
+        batch = []
+        total = 0
+        for room_id in RoomInfo.objects.values_list("room_id", flat=True).iterator(chunk_size=batch_size):
+            batch.append(room_id)
+            if len(batch) >= batch_size:
+                reindex_room_tags(batch)
+                total += len(batch)
+                batch = []
+
+        if batch:
+            reindex_room_tags(batch)
+            total += len(batch)
+
+        self.stdout.write(self.style.SUCCESS(f"已重建 {total} 个房间的标签索引"))
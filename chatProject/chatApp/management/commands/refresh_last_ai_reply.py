@@ -0,0 +1,62 @@
+from django.core.management.base import BaseCommand
+from chatApp.models import RoomInfo
+from chatApp.api.common.common import parse_send_date
+from chatApp.api.common.messages import first_message_per_room
+
+
+class Command(BaseCommand):
+    """
+    批量校准 RoomInfo.last_ai_reply_timestamp
+    正常情况下由 chat_data / fork_chat 写入时实时维护，本命令用于定时兜底（例如 crontab 每 10 分钟）
+    python manage.py refresh_last_ai_reply --batch-size 500
+    """
+    help = "批量从 MongoDB 校准房间最后 AI 回复时间"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=500)
+        parser.add_argument("--all", action="store_true", help="包含未公开房间和分支房间")
+
+    def handle(self, *args, **options):
+        batch_size = options["batch_size"]
+
+        rooms = RoomInfo.objects.only("id", "room_id", "last_ai_reply_timestamp")
+        if not options["all"]:
+            rooms = rooms.filter(is_show=0, file_branch="main")
+
+        updated = 0
+        batch = []
+        for room in rooms.iterator(chunk_size=batch_size):
+            batch.append(room)
+            if len(batch) >= batch_size:
+                updated += self._refresh_batch(batch)
+                batch = []
+        if batch:
+            updated += self._refresh_batch(batch)
+
+        self.stdout.write(self.style.SUCCESS(f"已更新 {updated} 个房间的 last_ai_reply_timestamp"))
+
+    def _refresh_batch(self, rooms):
+        # 每个房间最后一条 AI 消息（messages 集合模式下一次聚合取完整批）
+        last_ai_docs = first_message_per_room(
+            [room.room_id for room in rooms],
+            {"data_type": "ai"},
+            projection={"data.send_date": 1},
+            latest=True,
+        )
+
+        changed = []
+        for room in rooms:
+            last_ai_doc = last_ai_docs.get(room.room_id)
+            if not last_ai_doc:
+                continue
+            dt = parse_send_date(last_ai_doc.get("data", {}).get("send_date"))
+            if not dt:
+                continue
+            timestamp = dt.timestamp()
+            if room.last_ai_reply_timestamp != timestamp:
+                room.last_ai_reply_timestamp = timestamp
+                changed.append(room)
+
+        if changed:
+            RoomInfo.objects.bulk_update(changed, ["last_ai_reply_timestamp"])
+        return len(changed)
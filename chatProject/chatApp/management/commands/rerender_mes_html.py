@@ -0,0 +1,200 @@
+import hashlib
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from django.core.management.base import BaseCommand
+from pymongo import UpdateOne
+
+from chatApp.models import CharacterCard, ForkTrace, RoomImageBinding
+from chatApp.api.common.connections import get_mongo_db
+from chatApp.api.common.messages import bulk_update_messages, find_messages
+from chatApp.api.fork.fork_format import format_message, render_key
+
+RERENDER_STATE_COLLECTION = "mes_html_rerender_state"
+RERENDER_STATE_ID = "fork_rooms"
+
+
+def _checkpoint_id(rooms=None, cards=None, skip_legacy=False):
+    """断点按过滤条件区分：不带条件的全量任务用 RERENDER_STATE_ID，带 --room/--card/--skip-legacy 的各用各的"""
+    if not (rooms or cards or skip_legacy):
+        return RERENDER_STATE_ID
+    scope = json.dumps({"rooms": sorted(set(rooms or [])), "cards": sorted(set(cards or [])),
+                        "skip_legacy": bool(skip_legacy)}, sort_keys=True)
+    return f"{RERENDER_STATE_ID}:{hashlib.sha1(scope.encode('utf-8')).hexdigest()[:16]}"
+
+
+def _init_worker(verbose):
+    import django
+    django.setup()
+    if not verbose:
+        # 格式化时每条消息都会打印正则脚本日志，批量任务中关掉
+        sys.stdout = open(os.devnull, "w")
+
+
+def _render_chunk(args):
+    """子进程中执行：渲染一组 (_id, mes)，参数与 fork_chat 写入 AI 回复时一致"""
+    character_regex_scripts, items = args
+    return [
+        (doc_id, format_message(
+            content=mes,
+            placement=2,  # AI_OUTPUT
+            is_markdown=True,
+            is_prompt=True,
+            is_edit=False,
+            depth=0,
+            character_regex_scripts=character_regex_scripts,
+            use_cache=False
+        ))
+        for doc_id, mes in items
+    ]
+
+
+class Command(BaseCommand):
+    """
+    正则脚本或格式化逻辑变化后，重新渲染分支房间中 AI 回复的 mes_html
+    - 只处理 fork_chat 生成的消息：mes_html_key（渲染指纹）与角色卡当前指纹不同的消息；
+      没有 mes_html_key 的旧消息按 character_date 为空识别（--skip-legacy 跳过）
+    - 按 _id 游标分批读取，进程池渲染（格式化是 CPU 密集的），无序 bulk_write 写回 mes_html 和 mes_html_key
+    - 每批写完记录断点（mes_html_rerender_state），中断后用相同参数重新执行会从断点继续；已写回的消息指纹一致，不会重复处理
+      断点按 --room/--card/--skip-legacy 区分，带条件的任务完成后只清除自己的断点，不影响中断的全量任务
+    - --max-writes-per-sec 限制每秒写入的文档数，降低对线上库的压力
+    python manage.py rerender_mes_html --workers 4 --max-writes-per-sec 500
+    python manage.py rerender_mes_html --card 123 --restart
+    """
+    help = "重新渲染分支房间 AI 回复的 mes_html（可断点续传、可限速）"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=500)
+        parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+        parser.add_argument("--max-writes-per-sec", type=float, default=500, help="0 表示不限速")
+        parser.add_argument("--room", action="append", dest="rooms", help="只处理指定分支房间，可重复")
+        parser.add_argument("--card", type=int, action="append", dest="cards", help="只处理绑定指定角色卡的房间，可重复")
+        parser.add_argument("--skip-legacy", action="store_true", help="跳过没有 mes_html_key 的旧消息")
+        parser.add_argument("--restart", action="store_true", help="忽略断点，从头处理")
+        parser.add_argument("--verbose", action="store_true", help="保留格式化时的脚本日志")
+
+    def handle(self, *args, **options):
+        self.state = get_mongo_db()[RERENDER_STATE_COLLECTION]
+        self.batch_size = options["batch_size"]
+        self.workers = max(1, options["workers"])
+        self.rate = options["max_writes_per_sec"]
+        self.skip_legacy = options["skip_legacy"]
+        self.cards = set(options["cards"] or [])
+        self._scripts = {}  # 角色卡 id -> (regex_scripts, 渲染指纹)
+        self.state_id = _checkpoint_id(options["rooms"], self.cards, self.skip_legacy)
+
+        if options["restart"]:
+            self.state.delete_one({"_id": self.state_id})
+        checkpoint = self.state.find_one({"_id": self.state_id}) or {}
+
+        traces = ForkTrace.objects.order_by("id").values_list("id", "current_room_id", "source_room_id")
+        if options["rooms"]:
+            traces = traces.filter(current_room_id__in=options["rooms"])
+        if checkpoint.get("trace_id"):
+            traces = traces.filter(id__gte=checkpoint["trace_id"])
+
+        self.written = 0
+        self.started = time.monotonic()
+        rendered = changed = rooms_done = 0
+        seen = set()
+        with ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker,
+                                 initargs=(options["verbose"],)) as pool:
+            for trace_id, room_id, source_room_id in traces.iterator(chunk_size=self.batch_size):
+                if room_id in seen:
+                    continue
+                seen.add(room_id)
+                card = self._room_scripts(source_room_id)
+                if card is None:
+                    continue
+                last_id = checkpoint.get("last_id") if checkpoint.get("trace_id") == trace_id else None
+                r, c = self._rerender_room(pool, trace_id, room_id, card, last_id)
+                rendered, changed = rendered + r, changed + c
+                rooms_done += 1
+                if r:
+                    self.stdout.write(f"{room_id}: 渲染 {r} 条，mes_html 变化 {c} 条")
+
+        self.state.delete_one({"_id": self.state_id})
+        elapsed = time.monotonic() - self.started
+        self.stdout.write(self.style.SUCCESS(
+            f"完成 {rooms_done} 个房间，渲染 {rendered} 条，mes_html 变化 {changed} 条，耗时 {elapsed:.1f}s"
+        ))
+
+    def _room_scripts(self, source_room_id):
+        """分支房间使用源房间绑定的角色卡（与 fork_chat 一致），返回 (regex_scripts, 渲染指纹)"""
+        binding = RoomImageBinding.objects.filter(room_id=source_room_id).values("image_id").first()
+        if not binding or (self.cards and binding["image_id"] not in self.cards):
+            return None
+        card_id = binding["image_id"]
+        if card_id not in self._scripts:
+            card = CharacterCard.objects.filter(id=card_id).values("character_data").first()
+            scripts = None
+            if card:
+                try:
+                    extensions = (json.loads(card["character_data"]).get("data") or {}).get("extensions") or {}
+                    scripts = extensions.get("regex_scripts")
+                except (ValueError, AttributeError):
+                    scripts = None
+            self._scripts[card_id] = None if card is None else (scripts, render_key(scripts))
+        return self._scripts[card_id]
+
+    def _rerender_room(self, pool, trace_id, room_id, card, last_id):
+        scripts, key = card
+        stale = [{"mes_html_key": {"$exists": True, "$ne": key}}]
+        if not self.skip_legacy:
+            # 旧消息没有渲染指纹：fork_chat 写入的 AI 回复 character_date 为空
+            stale.append({"mes_html_key": {"$exists": False}, "character_date": ""})
+        query = {"data_type": "ai", "$or": stale}
+        if last_id is not None:
+            query["_id"] = {"$gt": last_id}
+        cursor = find_messages(room_id, query, {"data.mes": 1, "mes_html": 1}, sort=[("_id", 1)])
+        cursor = cursor.batch_size(self.batch_size)
+
+        rendered = changed = 0
+        batch = []
+        for doc in cursor:
+            batch.append(doc)
+            if len(batch) >= self.batch_size:
+                c = self._flush(pool, trace_id, room_id, scripts, key, batch)
+                rendered, changed, batch = rendered + len(batch), changed + c, []
+        if batch:
+            c = self._flush(pool, trace_id, room_id, scripts, key, batch)
+            rendered, changed = rendered + len(batch), changed + c
+        return rendered, changed
+
+    def _flush(self, pool, trace_id, room_id, scripts, key, batch):
+        """渲染并写回一批，推进断点，返回 mes_html 发生变化的条数"""
+        items = [(doc["_id"], (doc.get("data") or {}).get("mes") or "") for doc in batch]
+        size = max(1, -(-len(items) // self.workers))
+        chunks = [(scripts, items[i:i + size]) for i in range(0, len(items), size)]
+        old_html = {doc["_id"]: doc.get("mes_html") for doc in batch}
+
+        ops = []
+        changed = 0
+        for results in pool.map(_render_chunk, chunks):
+            for doc_id, mes_html in results:
+                update = {"mes_html_key": key}
+                if mes_html != old_html[doc_id]:
+                    update["mes_html"] = mes_html
+                    changed += 1
+                ops.append(UpdateOne({"_id": doc_id}, {"$set": update}))
+        bulk_update_messages(room_id, ops)
+
+        self.state.update_one(
+            {"_id": self.state_id},
+            {"$set": {"trace_id": trace_id, "last_id": batch[-1]["_id"]}, "$inc": {"rendered": len(batch)}},
+            upsert=True
+        )
+        self._throttle(len(ops))
+        return changed
+
+    def _throttle(self, count):
+        """按目标写入速率计算应到达的时间，写得太快就等一等"""
+        self.written += count
+        if self.rate <= 0:
+            return
+        delay = self.started + self.written / self.rate - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
@@ -0,0 +1,36 @@
+import json
+
+from django.core.management.base import BaseCommand
+from chatApp.models import CharacterCard
+from chatApp.api.anchor.card import card_review_text, submit_card_review
+
+
+class Command(BaseCommand):
+    """
+    重新提交停在 pending 的角色卡审核（提交失败、任务丢失，或重试用完时模型服务仍不可用）
+    重复提交是安全的：回调只按最后一次结果更新审核状态
+    python manage.py resubmit_card_reviews
+    python manage.py resubmit_card_reviews --card 123
+    """
+    help = "重新提交待审核角色卡的内容审核"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--card", type=int, action="append", dest="cards", help="只处理指定角色卡，可重复")
+
+    def handle(self, *args, **options):
+        cards = CharacterCard.objects.filter(review_status="pending").order_by("id")
+        if options["cards"]:
+            cards = cards.filter(id__in=options["cards"])
+
+        submitted = failed = 0
+        for card_id, character_data in cards.values_list("id", "character_data").iterator():
+            try:
+                review_text = card_review_text(json.loads(character_data))
+            except (ValueError, AttributeError):
+                review_text = character_data
+            if submit_card_review(card_id, review_text):
+                submitted += 1
+            else:
+                failed += 1
+
+        self.stdout.write(self.style.SUCCESS(f"已提交 {submitted} 张角色卡，失败 {failed} 张"))
@@ -0,0 +1,153 @@
+"""
+进程内 IP 黑名单
+- 单个 IP 以 (版本, 整数) 形式存放在 set 中，网段按整数区间排序后二分查找
+- 新增/解封通过 Redis pub/sub 广播，每个 worker 增量更新，不再每个请求查 MySQL
+- 定期全量重新加载一次，兜底丢失的广播消息或直接改库的情况
+"""
+
+import bisect
+import ipaddress
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.db.models.signals import post_save, post_delete
+from chatApp.api.common.connections import get_redis
+
+BLACKLIST_CHANNEL = "ip_blacklist"
+
+
+def _pack_ip(ip):
+    """IP 字符串 -> (版本, 整数)，非法 IP 返回 None"""
+    try:
+        addr = ipaddress.ip_address(ip)
+    except (TypeError, ValueError):
+        return None
+    return addr.version, int(addr)
+
+
+class IpBlacklistSet:
+
+    def __init__(self, refresh_interval=300, networks=()):
+        self.refresh_interval = refresh_interval
+        self.networks = list(networks)  # 静态封禁网段（CIDR）
+        self._ips = set()
+        self._ranges = []  # 排序后的 (版本, 起始, 结束)
+        self._loaded_at = None  # None 表示还没有加载过
+        self._pid = None
+        self._lock = threading.Lock()
+        self._reload_lock = threading.Lock()  # 同一时间只有一个线程全量加载
+
+    # ---------- 加载 ----------
+    def reload(self):
+        from chatApp.models import IPBlacklist
+
+        ips = set()
+        for ip in IPBlacklist.objects.filter(is_active=True).values_list("ip", flat=True):
+            packed = _pack_ip(ip)
+            if packed:
+                ips.add(packed)
+
+        ranges = []
+        for cidr in self.networks:
+            network = ipaddress.ip_network(cidr, strict=False)
+            ranges.append((network.version, int(network.network_address), int(network.broadcast_address)))
+        ranges.sort()
+
+        with self._lock:
+            self._ips = ips
+            self._ranges = ranges
+            self._loaded_at = time.monotonic()
+
+    def add(self, ip):
+        packed = _pack_ip(ip)
+        if packed:
+            with self._lock:
+                self._ips.add(packed)
+
+    def remove(self, ip):
+        packed = _pack_ip(ip)
+        if packed:
+            with self._lock:
+                self._ips.discard(packed)
+
+    # ---------- 订阅 ----------
+    def _ensure_ready(self):
+        # fork 之后子进程需要重新加载并重新订阅
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid == os.getpid():
+                    return
+                self._pid = os.getpid()
+                self._loaded_at = None
+            self._start_listener()
+        if self._stale():
+            with self._reload_lock:
+                # 等锁期间其他线程可能已经加载完成
+                if self._stale():
+                    self.reload()
+
+    def _stale(self):
+        loaded_at = self._loaded_at
+        return loaded_at is None or time.monotonic() - loaded_at > self.refresh_interval
+
+    def _start_listener(self):
+        thread = threading.Thread(target=self._listen, name="ip-blacklist-listener", daemon=True)
+        thread.start()
+
+    def _listen(self):
+        while True:
+            try:
+                pubsub = get_redis("default").pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(BLACKLIST_CHANNEL)
+                # 订阅成功后全量加载一次，避免漏掉订阅前的变更
+                self._loaded_at = None
+                for message in pubsub.listen():
+                    action, _, ip = message["data"].decode().partition(":")
+                    if action == "add":
+                        self.add(ip)
+                    elif action == "remove":
+                        self.remove(ip)
+            except Exception as e:
+                print(f"[BLACKLIST] 订阅中断，5 秒后重连: {e}")
+                time.sleep(5)
+
+    # ---------- 查询 ----------
+    def contains(self, ip):
+        self._ensure_ready()
+        packed = _pack_ip(ip)
+        if packed is None:
+            return False
+        if packed in self._ips:
+            return True
+        ranges = self._ranges
+        i = bisect.bisect_right(ranges, (packed[0], packed[1], float("inf"))) - 1
+        return i >= 0 and ranges[i][0] == packed[0] and ranges[i][1] <= packed[1] <= ranges[i][2]
+
+
+def publish_blacklist_change(ip, active):
+    """广播黑名单变更，所有 worker 收到后增量更新"""
+    action = "add" if active else "remove"
+    try:
+        get_redis("default").publish(BLACKLIST_CHANNEL, f"{action}:{ip}")
+    except Exception as e:
+        print(f"[BLACKLIST] 广播失败 {action}:{ip}: {e}")
+
+
+def _on_blacklist_saved(sender, instance, **kwargs):
+    publish_blacklist_change(instance.ip, instance.is_active)
+
+
+def _on_blacklist_deleted(sender, instance, **kwargs):
+    publish_blacklist_change(instance.ip, False)
+
+
+post_save.connect(_on_blacklist_saved, sender="chatApp.IPBlacklist", dispatch_uid="ip_blacklist_saved")
+post_delete.connect(_on_blacklist_deleted, sender="chatApp.IPBlacklist", dispatch_uid="ip_blacklist_deleted")
+
+
+ip_blacklist = IpBlacklistSet(
+    refresh_interval=getattr(settings, "IP_BLACKLIST_REFRESH_INTERVAL", 300),
+    networks=getattr(settings, "IP_BLACKLIST_NETWORKS", []),
+)
@@ -1,12 +1,8 @@
-import time
 from django.http import JsonResponse
 from django.utils import timezone
-from collections import defaultdict
 from chatApp.models import IPBlacklist  # 替换为你的实际路径
-
-# 单 IP 单接口访问记录
-VISIT_RECORD_60S = defaultdict(list)  # 60s 限流
-VISIT_RECORD_10S = defaultdict(list)  # 10s 黑名单检测
+from chatApp.middleware.rate_limiter import RateLimitEngine
+from chatApp.middleware.ip_blacklist import ip_blacklist
 
 
 class IpRateLimitMiddleware:
@@ -23,37 +19,30 @@ class IpRateLimitMiddleware:
 
     def __init__(self, get_response):
         self.get_response = get_response
+        # 单 IP 单接口访问计数（Redis 共享 / 进程内固定内存）
+        self.limiter = RateLimitEngine()
 
     def __call__(self, request):
         ip = self.get_client_ip(request)
         path = request.path
-        now = time.time()
 
-        # 1️⃣ 检查黑名单
-        if IPBlacklist.objects.filter(ip=ip, is_active=True).exists():
+        # 1️⃣ 检查黑名单（进程内集合，不查数据库）
+        if ip_blacklist.contains(ip):
             return JsonResponse({
                 "status": "error",
                 "message": "您的IP已被封禁，禁止访问。"
             }, status=403)
 
-        # 2️⃣ 60s 限流逻辑
-        key_60s = (ip, path)
-        record_60s = VISIT_RECORD_60S[key_60s]
-        record_60s = [t for t in record_60s if now - t < self.TIME_WINDOW_LIMIT]
-        record_60s.append(now)
-        VISIT_RECORD_60S[key_60s] = record_60s
+        # 2️⃣ 60s 限流 + 10s 黑名单检测，一次计数
+        count_60s, count_10s = self.limiter.hit(
+            f"{ip}:{path}", [self.TIME_WINDOW_LIMIT, self.BLACKLIST_WINDOW]
+        )
 
-        if len(record_60s) > self.MAX_REQUESTS_LIMIT:
+        if count_60s > self.MAX_REQUESTS_LIMIT:
             return JsonResponse({"status": "error", "message": "请求过于频繁"}, status=429)
 
         # 3️⃣ 10s 黑名单检测逻辑
-        key_10s = (ip, path)
-        record_10s = VISIT_RECORD_10S[key_10s]
-        record_10s = [t for t in record_10s if now - t < self.BLACKLIST_WINDOW]
-        record_10s.append(now)
-        VISIT_RECORD_10S[key_10s] = record_10s
-
-        if len(record_10s) > self.MAX_REQUESTS_BLACKLIST:
+        if count_10s > self.MAX_REQUESTS_BLACKLIST:
             self.add_to_blacklist(ip, path)
             return JsonResponse({
                 "status": "error",
@@ -63,7 +52,7 @@ class IpRateLimitMiddleware:
         return self.get_response(request)
 
     def add_to_blacklist(self, ip, path):
-        """写入数据库黑名单"""
+        """写入数据库黑名单（post_save 会广播给所有 worker）"""
         IPBlacklist.objects.update_or_create(
             ip=ip,
             defaults={
@@ -73,6 +62,7 @@ class IpRateLimitMiddleware:
                 "created_at": timezone.now()
             }
         )
+        ip_blacklist.add(ip)
         print(f"[BLACKLIST] IP {ip} 已被封禁，接口 {path}")
 
     @staticmethod
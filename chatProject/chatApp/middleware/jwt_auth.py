@@ -0,0 +1,197 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import parse_qs
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import AnonymousUser
+from django.db.models.signals import post_save, post_delete
+from rest_framework.decorators import api_view, permission_classes
+from rest_framework.permissions import IsAdminUser
+from rest_framework.response import Response
+from rest_framework_simplejwt.exceptions import InvalidToken, TokenError
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.tokens import UntypedToken
+
+from chatApp.api.common.connections import get_redis
+
+USER_INVALIDATION_CHANNEL = "ws_auth_user_invalidate"
+
+
+class UserSnapshotCache:
+    """
+    进程内用户快照缓存（LRU + TTL）
+    - 重连风暴时同一用户的握手只查一次 MySQL
+    - ChatUser 保存/删除时通过 Redis pub/sub 广播，所有 worker 失效对应条目（与 IP 黑名单相同的方式）
+    - 没有订阅上（Redis 不可用、刚启动、订阅中断）时不使用缓存，直接查库：
+      收不到广播期间不能用快照，否则其他 worker 停用的用户还能继续连接
+    """
+
+    def __init__(self, max_size=10000, ttl=300, channel=USER_INVALIDATION_CHANNEL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.channel = channel
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        self.invalidations = 0
+        self._data = OrderedDict()  # str(user_id) -> (过期时间, user)
+        self._lock = threading.Lock()
+        self._pid = None
+        self._subscribed = False
+
+    # ---------- 订阅 ----------
+    def _ensure_listener(self):
+        # fork 之后子进程需要重新订阅
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._subscribed = False
+            self._data.clear()
+        threading.Thread(target=self._listen, name="ws-auth-user-listener", daemon=True).start()
+
+    def _listen(self):
+        while True:
+            try:
+                pubsub = get_redis("default").pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel)
+                # 订阅中断期间可能漏掉广播：重新订阅后清空缓存再启用
+                with self._lock:
+                    self._data.clear()
+                    self._subscribed = True
+                for message in pubsub.listen():
+                    self.invalidate(message["data"].decode())
+            except Exception as e:
+                self._subscribed = False
+                print(f"[WS_AUTH] 用户失效订阅中断，5 秒后重连: {e}")
+                time.sleep(5)
+
+    def get(self, user_id):
+        self._ensure_listener()
+        if not self._subscribed:
+            self.bypassed += 1
+            return None
+        now = time.monotonic()
+        with self._lock:
+            item = self._data.get(user_id)
+            if item is not None and item[0] > now:
+                self._data.move_to_end(user_id)
+                self.hits += 1
+                return item[1]
+            if item is not None:
+                del self._data[user_id]
+            self.misses += 1
+            return None
+
+    def set(self, user_id, user):
+        if not self._subscribed:
+            return
+        with self._lock:
+            self._data[user_id] = (time.monotonic() + self.ttl, user)
+            self._data.move_to_end(user_id)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self.invalidations += 1
+            self._data.pop(user_id, None)
+
+    def stats(self):
+        with self._lock:
+            size = len(self._data)
+        return {"hits": self.hits, "misses": self.misses, "bypassed": self.bypassed,
+                "invalidations": self.invalidations, "size": size, "subscribed": self._subscribed}
+
+
+user_cache = UserSnapshotCache(
+    max_size=getattr(settings, "WS_AUTH_USER_CACHE_SIZE", 10000),
+    ttl=getattr(settings, "WS_AUTH_USER_CACHE_TTL", 300),
+)
+
+
+def publish_user_invalidation(user_id):
+    """广播用户变更，所有 worker（包括本进程）收到后删除快照"""
+    user_cache.invalidate(str(user_id))
+    try:
+        get_redis("default").publish(USER_INVALIDATION_CHANNEL, str(user_id))
+    except Exception as e:
+        # 广播失败时其他 worker 的订阅大概率也已中断（中断期间不使用缓存）
+        print(f"[WS_AUTH] 广播用户 {user_id} 失效失败: {e}")
+
+
+def _invalidate_user(sender, instance, **kwargs):
+    publish_user_invalidation(instance.pk)
+
+
+post_save.connect(_invalidate_user, sender=settings.AUTH_USER_MODEL, dispatch_uid="ws_auth_user_saved")
+post_delete.connect(_invalidate_user, sender=settings.AUTH_USER_MODEL, dispatch_uid="ws_auth_user_deleted")
+
+
+def ws_auth_stats():
+    return dict(user_cache.stats(), pid=os.getpid())
+
+
+@api_view(["GET"])
+@permission_classes([IsAdminUser])
+def ws_auth_stats_view(request):
+    """
+    查看处理本次请求的 worker 的 WebSocket 认证用户快照缓存命中情况（仅管理员）
+    """
+    return Response({"success": True, "data": ws_auth_stats()})
+
+
+@database_sync_to_async
+def _load_user(user_id):
+    User = get_user_model()
+    try:
+        return User.objects.get(**{api_settings.USER_ID_FIELD: user_id})
+    except User.DoesNotExist:
+        return None
+
+
+async def get_user_from_token(token):
+    """
+    token 只解码一次，用户优先从快照缓存获取
+    """
+    try:
+        # token 里的 user_id 可能是字符串，统一用 str 作为缓存 key
+        user_id = str(UntypedToken(token)[api_settings.USER_ID_CLAIM])
+    except (InvalidToken, TokenError, KeyError):
+        return AnonymousUser()
+
+    user = user_cache.get(user_id)
+    if user is None:
+        user = await _load_user(user_id)
+        if user is None:
+            return AnonymousUser()
+        user_cache.set(user_id, user)
+
+    if not user.is_active:
+        return AnonymousUser()
+    return user
+
+
+class JwtAuthMiddleware:
+    """
+    WebSocket JWT 认证中间件，替代 AuthMiddlewareStack
+    ws://host/ws/chat/<room_id>/?token=<jwt>
+    """
+
+    def __init__(self, inner):
+        self.inner = inner
+
+    async def __call__(self, scope, receive, send):
+        query_params = parse_qs(scope.get("query_string", b"").decode())
+        token_list = query_params.get("token", [])
+        token = token_list[0] if token_list else None
+
+        scope = dict(scope)
+        scope["user"] = await get_user_from_token(token) if token else AnonymousUser()
+        return await self.inner(scope, receive, send)
@@ -0,0 +1,238 @@
+"""
+限流引擎：滑动窗口计数（当前窗口计数 + 上一窗口计数按剩余比例加权）
+- 每个 key 每个窗口只保存两个计数，单次判断 O(1)
+- RedisRateLimiter：Lua 脚本一次往返完成所有窗口的计数，所有机器的所有 worker 共享配额
+- SharedRateLimiter：计数放在本机共享内存文件中（mmap + flock），本机所有 worker 共享配额，内存固定
+- LocalRateLimiter：进程内实现（只在没有 fcntl 的平台使用，例如 Windows 开发环境），每个 worker 单独计数
+"""
+
+import hashlib
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from chatApp.api.common.connections import get_redis
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+# Redis 不可用时降级日志的最短间隔（秒），避免每个请求打印一次
+REDIS_ERROR_LOG_INTERVAL = 60
+
+# KEYS: 每个窗口两个 key（当前窗口、上一窗口）
+# ARGV: 每个窗口两个参数（窗口秒数、当前窗口已过去的比例）
+SLIDING_WINDOW_LUA = """
+local result = {}
+for i = 1, #ARGV / 2 do
+    local window = tonumber(ARGV[2 * i - 1])
+    local elapsed = tonumber(ARGV[2 * i])
+    local current = redis.call('INCR', KEYS[2 * i - 1])
+    if current == 1 then
+        redis.call('EXPIRE', KEYS[2 * i - 1], window * 2)
+    end
+    local previous = tonumber(redis.call('GET', KEYS[2 * i]) or '0')
+    result[i] = math.floor(previous * (1 - elapsed) + current)
+end
+return result
+"""
+
+
+def _window_position(now, window):
+    """返回 (窗口编号, 当前窗口已过去的比例)"""
+    index = int(now // window)
+    return index, (now - index * window) / window
+
+
+def _roll(counter_index, current, previous, index):
+    """计数跨窗口时滚动，返回 (当前计数, 上一窗口计数)：只有紧邻的上一个窗口计数有效"""
+    if counter_index == index:
+        return current, previous
+    return 0, current if counter_index == index - 1 else 0
+
+
+class RedisRateLimiter:
+    """
+    Redis 滑动窗口限流，配额在所有 worker 之间共享
+    """
+
+    def __init__(self, alias="chat-limit", prefix="ratelimit"):
+        self.alias = alias
+        self.prefix = prefix
+        self._script = None
+
+    def _get_script(self):
+        if self._script is None:
+            self._script = get_redis(self.alias).register_script(SLIDING_WINDOW_LUA)
+        return self._script
+
+    def hit(self, key, windows):
+        """
+        记录一次访问，返回每个窗口内的估算访问次数（包含本次）
+        windows: 窗口秒数列表，例如 [60, 10]
+        """
+        now = time.time()
+        keys, args = [], []
+        for window in windows:
+            index, elapsed = _window_position(now, window)
+            keys.append(f"{self.prefix}:{window}:{key}:{index}")
+            keys.append(f"{self.prefix}:{window}:{key}:{index - 1}")
+            args.extend([window, elapsed])
+        return [int(c) for c in self._get_script()(keys=keys, args=args)]
+
+
+class SharedRateLimiter:
+    """
+    本机共享内存滑动窗口限流，配额在本机所有 worker 之间共享（不依赖 Redis）
+    - 计数放在 mmap 映射的文件中（默认在 /dev/shm），flock 保证多进程互斥
+    - 固定 slots 个槽位，按 key 的 64 位哈希开放寻址，最多探测 PROBES 个槽位；
+      都被其他 key 占用时覆盖其中最久未访问的一个，文件大小固定为 slots * 32 字节
+    """
+
+    # 哈希、窗口编号、当前计数、上一窗口计数、最后访问时间（秒）
+    SLOT = struct.Struct("<QqIII4x")
+    PROBES = 8
+
+    def __init__(self, path, slots=100000):
+        self.path = path
+        self.slots = slots
+        self._lock = threading.Lock()
+        self._pid = None
+        self._fd = None
+        self._map = None
+
+    def _open(self):
+        # 每个进程（包括 fork 出的 worker）各自打开文件：flock 按打开的文件加锁
+        if self._pid != os.getpid():
+            size = self.slots * self.SLOT.size
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                if os.fstat(fd).st_size < size:
+                    os.ftruncate(fd, size)
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+            self._fd, self._map, self._pid = fd, mmap.mmap(fd, size), os.getpid()
+        return self._map
+
+    def _find(self, buf, digest):
+        """返回 (偏移, 槽位内容)；key 不存在时返回空槽位或最久未访问的槽位，内容为 None"""
+        first = digest % self.slots
+        victim = None
+        for i in range(self.PROBES):
+            offset = (first + i) % self.slots * self.SLOT.size
+            record = self.SLOT.unpack_from(buf, offset)
+            if record[0] == digest:
+                return offset, record
+            if record[0] == 0:
+                return offset, None
+            if victim is None or record[4] < victim[1]:
+                victim = (offset, record[4])
+        return victim[0], None
+
+    def hit(self, key, windows):
+        now = time.time()
+        result = []
+        with self._lock:
+            buf = self._open()
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                for window in windows:
+                    index, elapsed = _window_position(now, window)
+                    digest = int.from_bytes(hashlib.blake2b(f"{window}:{key}".encode("utf-8"),
+                                                            digest_size=8).digest(), "little") or 1
+                    offset, record = self._find(buf, digest)
+                    current, previous = _roll(record[1], record[2], record[3], index) if record else (0, 0)
+                    current += 1
+                    self.SLOT.pack_into(buf, offset, digest, index, current, previous, int(now))
+                    result.append(int(previous * (1 - elapsed) + current))
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+        return result
+
+
+class LocalRateLimiter:
+    """
+    进程内滑动窗口限流（单 worker 内有效，N 个 worker 相当于 N 倍配额；只在没有 fcntl 的平台使用）
+    key 数量超过 max_keys 时淘汰最久未访问的 key
+    """
+
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        self._counters = OrderedDict()  # (window, key) -> [窗口编号, 当前计数, 上一窗口计数]
+        self._lock = threading.Lock()
+
+    def hit(self, key, windows):
+        now = time.time()
+        result = []
+        with self._lock:
+            for window in windows:
+                index, elapsed = _window_position(now, window)
+                counter_key = (window, key)
+                counter = self._counters.get(counter_key)
+                if counter is None:
+                    counter = [index, 0, 0]
+                    self._counters[counter_key] = counter
+                else:
+                    self._counters.move_to_end(counter_key)
+                    counter[1], counter[2] = _roll(counter[0], counter[1], counter[2], index)
+                    counter[0] = index
+                counter[1] += 1
+                result.append(int(counter[2] * (1 - elapsed) + counter[1]))
+
+            while len(self._counters) > self.max_keys:
+                self._counters.popitem(last=False)
+        return result
+
+
+def _local_limiter():
+    max_keys = getattr(settings, "RATE_LIMIT_LOCAL_MAX_KEYS", 100000)
+    if fcntl is None:
+        return LocalRateLimiter(max_keys)
+    path = getattr(settings, "RATE_LIMIT_LOCAL_PATH", None)
+    if not path:
+        # 同一台机器上的不同项目（BASE_DIR 不同）使用不同的文件
+        name = hashlib.sha1(str(settings.BASE_DIR).encode("utf-8")).hexdigest()[:12]
+        directory = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+        path = os.path.join(directory, f"ratelimit-{name}")
+    return SharedRateLimiter(path, max_keys)
+
+
+class RateLimitEngine:
+    """
+    根据 settings.RATE_LIMIT_BACKEND 选择后端（redis / local）
+    Redis 不可用时降级为本机共享限流，不影响正常请求
+    """
+
+    def __init__(self):
+        backend = getattr(settings, "RATE_LIMIT_BACKEND", "redis")
+        self.local = _local_limiter()
+        self.backend = RedisRateLimiter() if backend == "redis" else self.local
+        self._log_lock = threading.Lock()
+        self._last_error_log = float("-inf")
+        self._errors = 0
+
+    def hit(self, key, windows):
+        if self.backend is self.local:
+            return self.local.hit(key, windows)
+        try:
+            return self.backend.hit(key, windows)
+        except Exception as e:
+            self._log_redis_error(e)
+            return self.local.hit(key, windows)
+
+    def _log_redis_error(self, error):
+        """Redis 故障期间每 REDIS_ERROR_LOG_INTERVAL 秒最多打印一次，附带期间失败次数"""
+        now = time.monotonic()
+        with self._log_lock:
+            self._errors += 1
+            if now - self._last_error_log < REDIS_ERROR_LOG_INTERVAL:
+                return
+            errors, self._errors, self._last_error_log = self._errors, 0, now
+        print(f"[RATE_LIMIT] Redis 限流失败 {errors} 次（上次日志以来），降级为本机共享限流: {error}")
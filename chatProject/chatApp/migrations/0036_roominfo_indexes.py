@@ -0,0 +1,21 @@
+# Generated by Django 5.2.4 on 2026-10-18 10:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatApp', '0035_roomimagebinding_uid_roominfo_weight'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='roominfo',
+            index=models.Index(fields=['room_id'], name='idx_room_info_room_id'),
+        ),
+        migrations.AddIndex(
+            model_name='roominfo',
+            index=models.Index(fields=['is_show', 'file_branch', '-weight', '-last_ai_reply_timestamp'], name='idx_room_info_lives'),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.2.4 on 2026-10-18 10:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatApp', '0036_roominfo_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RoomTagIndex',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('room_id', models.CharField(max_length=255, verbose_name='房间ID')),
+                ('tag', models.CharField(max_length=255, verbose_name='标准化后的标签或语言')),
+                ('kind', models.SmallIntegerField(choices=[(0, '标签'), (1, '语言')], default=0, verbose_name='类型')),
+            ],
+            options={
+                'verbose_name': '房间标签索引',
+                'verbose_name_plural': '房间标签索引',
+                'db_table': 'room_tag_index',
+                'indexes': [models.Index(fields=['room_id'], name='idx_room_tag_room_id')],
+                'constraints': [models.UniqueConstraint(fields=('kind', 'tag', 'room_id'), name='unique_room_tag_index')],
+            },
+        ),
+    ]
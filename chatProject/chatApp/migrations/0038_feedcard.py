@@ -0,0 +1,30 @@
+# Generated by Django 5.2.4 on 2026-10-18 14:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatApp', '0037_roomtagindex'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FeedCard',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('room_id', models.CharField(max_length=255, unique=True, verbose_name='房间ID')),
+                ('uid', models.CharField(max_length=255, verbose_name='房主ID')),
+                ('room_created_at', models.DateTimeField(verbose_name='房间创建时间')),
+                ('card', models.JSONField(verbose_name='卡片内容')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='更新时间')),
+            ],
+            options={
+                'verbose_name': '信息流卡片',
+                'verbose_name_plural': '信息流卡片',
+                'db_table': 'feed_card',
+                'indexes': [models.Index(fields=['-room_created_at', '-id'], name='idx_feed_card_created'), models.Index(fields=['uid', '-room_created_at', '-id'], name='idx_feed_card_uid')],
+            },
+        ),
+    ]
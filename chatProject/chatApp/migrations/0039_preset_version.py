@@ -0,0 +1,18 @@
+# Generated by Django 5.2.4 on 2026-10-18 16:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatApp', '0038_feedcard'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='preset',
+            name='version',
+            field=models.PositiveIntegerField(default=0, verbose_name='预设版本'),
+        ),
+    ]
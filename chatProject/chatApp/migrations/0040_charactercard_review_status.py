@@ -0,0 +1,23 @@
+# Generated by Django 5.2.4 on 2026-10-18 18:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatApp', '0039_preset_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='charactercard',
+            name='review_status',
+            field=models.CharField(choices=[('pending', '待审核'), ('approved', '已通过'), ('rejected', '未通过')], default='approved', max_length=10, verbose_name='审核状态'),
+        ),
+        migrations.AddField(
+            model_name='charactercard',
+            name='review_reason',
+            field=models.CharField(blank=True, max_length=255, null=True, verbose_name='审核说明'),
+        ),
+    ]
@@ -41,6 +41,12 @@ def creator_character_image_upload_path(instance, filename):
 
 
 class CharacterCard(models.Model):
+    REVIEW_STATUS_CHOICES = (
+        ('pending', '待审核'),
+        ('approved', '已通过'),
+        ('rejected', '未通过'),
+    )
+
     uid = models.CharField(max_length=150, verbose_name="用户ID")  # 用户id
     username = models.CharField(max_length=150, verbose_name="用户名")  # 用户名
     character_name = models.CharField(max_length=150, verbose_name="角色卡名称")  # 角色卡名称
@@ -72,6 +78,14 @@ class CharacterCard(models.Model):
         default='pt',
         verbose_name="数据来源"
     )
+    # 导入时为 pending，内容审核队列（chatApp/api/common/moderation.py）异步更新；审核通过前不对外展示图片
+    review_status = models.CharField(
+        max_length=10,
+        choices=REVIEW_STATUS_CHOICES,
+        default='approved',
+        verbose_name="审核状态"
+    )
+    review_reason = models.CharField(max_length=255, null=True, blank=True, verbose_name="审核说明")
 
     class Meta:
         db_table = 'character_card'
@@ -130,6 +144,37 @@ class RoomImageBinding(models.Model):
         return f"Room {self.room_id} → Image ID {self.image_id}"
 
 
+class RoomTagIndex(models.Model):
+    """
+    房间标签/语言倒排索引：标签 → 房间
+    由绑定的角色卡（RoomImageBinding → CharacterCard）生成，标签已做 normalize_tag 处理
+    """
+    KIND_TAG = 0
+    KIND_LANGUAGE = 1
+    KIND_CHOICES = (
+        (KIND_TAG, '标签'),
+        (KIND_LANGUAGE, '语言'),
+    )
+
+    room_id = models.CharField(max_length=255, verbose_name="房间ID")
+    tag = models.CharField(max_length=255, verbose_name="标准化后的标签或语言")
+    kind = models.SmallIntegerField(choices=KIND_CHOICES, default=KIND_TAG, verbose_name="类型")
+
+    class Meta:
+        db_table = "room_tag_index"
+        verbose_name = "房间标签索引"
+        verbose_name_plural = "房间标签索引"
+        constraints = [
+            models.UniqueConstraint(fields=["kind", "tag", "room_id"], name="unique_room_tag_index")
+        ]
+        indexes = [
+            models.Index(fields=["room_id"], name="idx_room_tag_room_id"),
+        ]
+
+    def __str__(self):
+        return f"{self.tag} → Room {self.room_id}"
+
+
 class ChatUser(AbstractBaseUser):
     id = models.AutoField(primary_key=True)
     password = models.CharField(max_length=128)
@@ -297,11 +342,41 @@ class RoomInfo(models.Model):
 
     class Meta:
         db_table = 'room_info'  # 设置表名
+        indexes = [
+            models.Index(fields=['room_id'], name='idx_room_info_room_id'),
+            # 首页列表：is_show + file_branch 过滤，按权重、最后 AI 回复时间排序
+            models.Index(fields=['is_show', 'file_branch', '-weight', '-last_ai_reply_timestamp'],
+                         name='idx_room_info_lives'),
+        ]
 
     def __str__(self):
         return f"Room: {self.title} (UID: {self.uid}, Character: {self.character_name})"
 
 
+class FeedCard(models.Model):
+    """
+    首页信息流物化投影：每个公开的分支房间一张卡片（房主信息、第一条用户消息、图片已反规范化）
+    由 chatApp/api/common/feed.py 在写入时维护
+    """
+    room_id = models.CharField(max_length=255, unique=True, verbose_name="房间ID")
+    uid = models.CharField(max_length=255, verbose_name="房主ID")
+    room_created_at = models.DateTimeField(verbose_name="房间创建时间")
+    card = models.JSONField(verbose_name="卡片内容")
+    updated_at = models.DateTimeField(auto_now=True, verbose_name="更新时间")
+
+    class Meta:
+        db_table = "feed_card"
+        verbose_name = "信息流卡片"
+        verbose_name_plural = "信息流卡片"
+        indexes = [
+            models.Index(fields=["-room_created_at", "-id"], name="idx_feed_card_created"),
+            models.Index(fields=["uid", "-room_created_at", "-id"], name="idx_feed_card_uid"),
+        ]
+
+    def __str__(self):
+        return f"FeedCard: {self.room_id}"
+
+
 class PaymentRechargeRecord(models.Model):
     PAYMENT_STATUS_CHOICES = [
         ('waiting', 'Waiting'),
@@ -527,6 +602,8 @@ class Preset(models.Model):
     google_model = models.CharField(max_length=255, verbose_name="模型名称")
     model_n = models.IntegerField(max_length=10, verbose_name="")
     preset_json = models.TextField(verbose_name="")
+    # 每次保存预设 +1，编译好的预设模板按 (room_id, version) 缓存
+    version = models.PositiveIntegerField(default=0, verbose_name="预设版本")
 
     class Meta:
         db_table = "preset"
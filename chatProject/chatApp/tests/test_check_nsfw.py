@@ -0,0 +1,147 @@
+"""
+NSFW 检测：本地预筛（屏蔽词、复核词、放行）、Gemini 判定的缓存命中、批量去重、Redis 不可用时的降级和统计
+Gemini 客户端、Redis 用桩对象代替
+"""
+
+import contextlib
+import io
+import json
+import random
+import time
+from types import SimpleNamespace
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from chatApp.api.common import check_nsfw
+from chatApp.api.common.check_nsfw import NSFWMetrics, _Lexicon
+
+BLOCK = ["色情", "porn"]
+REVIEW = ["脱衣", "kiss"]
+
+TEXTS = 1000
+
+
+class _FakeRedis:
+    def __init__(self):
+        self.data = {}
+
+    def mget(self, keys):
+        return [self.data.get(key) for key in keys]
+
+    def set(self, key, value, ex=None):
+        self.data[key] = value.encode("utf-8")
+
+
+class _DownRedis:
+    def mget(self, keys):
+        raise ConnectionError("redis down")
+
+    def set(self, key, value, ex=None):
+        raise ConnectionError("redis down")
+
+
+class _FakeModels:
+    def __init__(self, reply):
+        self.reply = reply
+        self.prompts = []
+
+    def generate_content(self, model, contents):
+        self.prompts.append(contents)
+        if isinstance(self.reply, Exception):
+            raise self.reply
+        return SimpleNamespace(text=self.reply)
+
+
+class CheckNSFWTests(SimpleTestCase):
+    def setUp(self):
+        self.redis = _FakeRedis()
+        self.models = _FakeModels('```json\n{"is_nsfw": false, "score": 0.1, "reason": "ok"}\n```')
+        self.lexicon = _Lexicon(BLOCK, REVIEW)
+        self.metrics = NSFWMetrics()
+        patchers = [
+            mock.patch.object(check_nsfw, "get_redis", side_effect=lambda: self.redis),
+            mock.patch.object(check_nsfw, "_get_client", side_effect=lambda: SimpleNamespace(models=self.models)),
+            mock.patch.object(check_nsfw, "_get_lexicon", side_effect=lambda: self.lexicon),
+            mock.patch.object(check_nsfw, "metrics", self.metrics),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _check(self, texts):
+        with contextlib.redirect_stdout(io.StringIO()):
+            return check_nsfw.check_nsfw_batch(texts)
+
+    def test_prefilter_decides_without_gemini(self):
+        blocked, passed, empty = self._check(["这是 色 . 情 内容", "今天天气不错", ""])
+        self.assertEqual((blocked["is_nsfw"], blocked["source"]), (True, "prefilter"))
+        self.assertIn("色情", blocked["reason"])
+        self.assertEqual((passed["is_nsfw"], passed["source"]), (False, "prefilter"))
+        self.assertIsNone(empty["is_nsfw"])
+        # 全角、大小写也能命中
+        self.assertTrue(self._check(["ＰＯＲＮ"])[0]["is_nsfw"])
+        self.assertEqual(self.models.prompts, [])
+
+    def test_review_keyword_goes_to_gemini(self):
+        result = check_nsfw.is_nsfw("他们 KISS 了")
+        self.assertEqual(result, {"is_nsfw": False, "score": 0.1, "reason": "ok", "source": "llm"})
+        self.assertEqual(len(self.models.prompts), 1)
+
+    def test_without_keywords_everything_goes_to_gemini(self):
+        self.lexicon = _Lexicon([], [])
+        self.assertEqual(self._check(["今天天气不错"])[0]["source"], "llm")
+        self.assertEqual(len(self.models.prompts), 1)
+
+    def test_gemini_verdict_is_cached_by_normalized_text(self):
+        first = self._check(["他们 kiss 了"])[0]
+        second = self._check(["  他们\t KISS  了 "])[0]
+        self.assertEqual(first["source"], "llm")
+        self.assertEqual(second, dict(first, source="cache"))
+        self.assertEqual(len(self.models.prompts), 1)
+        cached, = self.redis.data.values()
+        self.assertEqual(json.loads(cached)["reason"], "ok")
+
+    def test_duplicate_texts_in_a_batch_call_gemini_once(self):
+        results = self._check(["kiss 1", "kiss 2", "KISS 1", "kiss 1"])
+        self.assertEqual(len(self.models.prompts), 2)
+        self.assertEqual({result["source"] for result in results}, {"llm"})
+        self.assertEqual(self.metrics.counters["deduplicated"], 2)
+
+    def test_errors_and_unparsable_replies_are_not_cached(self):
+        self.models.reply = RuntimeError("quota")
+        result = self._check(["kiss"])[0]
+        self.assertTrue(result["error"])
+        self.assertTrue(result["is_nsfw"])
+        self.models.reply = "不是 JSON"
+        self.assertIsNone(self._check(["kiss"])[0]["is_nsfw"])
+        self.assertEqual(self.redis.data, {})
+        self.assertEqual(len(self.models.prompts), 2)
+
+    def test_redis_down_falls_back_to_gemini(self):
+        self.redis = _DownRedis()
+        for _ in range(2):
+            self.assertEqual(self._check(["kiss"])[0]["source"], "llm")
+        self.assertEqual(len(self.models.prompts), 2)
+        self.assertEqual(self.metrics.counters["cache_hits"], 0)
+
+    def test_prefilter_and_cache_hit_rates(self):
+        rng = random.Random(24)
+        # 大部分是普通聊天，少量命中屏蔽词，复核词的文本有大量重复
+        texts = [rng.choice([f"普通的一句话{i}" for i in range(50)] + ["色情内容"] * 3
+                            + [f"kiss 场景{i}" for i in range(20)] * 2)
+                 for _ in range(TEXTS)]
+        started = time.perf_counter()
+        for start in range(0, TEXTS, 50):
+            self._check(texts[start:start + 50])
+        elapsed_ms = (time.perf_counter() - started) * 1000
+
+        stats = self.metrics.stats()
+        print(f"\n[bench] NSFW 检测 {TEXTS} 条: {elapsed_ms:.1f} ms，预筛直接判定 {stats['prefilter_rate']:.0%}，"
+              f"缓存命中 {stats['cache_hit_rate']:.0%}，调用 Gemini {stats['llm_calls']} 次")
+        self.assertEqual(stats["checked"], TEXTS)
+        self.assertLessEqual(stats["llm_calls"], 20)
+        self.assertEqual(stats["llm_calls"], len(self.models.prompts))
+        self.assertEqual(stats["cache_hits"] + stats["cache_misses"] + stats["deduplicated"],
+                         TEXTS - stats["prefilter_flagged"] - stats["prefilter_passed"])
+        self.assertGreater(stats["cache_hit_rate"], 0.5)
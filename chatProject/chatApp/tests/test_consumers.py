@@ -0,0 +1,104 @@
+"""
+用户评论 ws（ChatConsumer）：未登录拒绝、连接风暴下在线人数记录准确、禁言
+channel layer 用内存实现；风暴用例需要 Redis（chat-online 库），连不上时跳过
+"""
+
+import asyncio
+import time
+import uuid
+from types import SimpleNamespace
+from unittest import SkipTest, mock
+
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth.models import AnonymousUser
+from django.test import SimpleTestCase, override_settings
+
+from chatApp.api.common import connections
+from chatApp.consumers import ChatConsumer
+
+STORM_CONNECTIONS = 300
+STORM_USERS = 50
+
+IN_MEMORY_CHANNEL_LAYERS = {"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}}
+
+
+async def _wait_online_count(room_id, expected, timeout=5):
+    # accept 先于在线记录写入，connect() 返回时 pipeline 可能还没执行完
+    deadline = time.monotonic() + timeout
+    while ChatConsumer.get_online_count(room_id) != expected and time.monotonic() < deadline:
+        await asyncio.sleep(0.01)
+    return ChatConsumer.get_online_count(room_id)
+
+
+def _communicator(room_id, user):
+    communicator = WebsocketCommunicator(ChatConsumer.as_asgi(), f"/ws/chat/{room_id}/")
+    communicator.scope["user"] = user
+    communicator.scope["url_route"] = {"kwargs": {"room_id": room_id}}
+    return communicator
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class ChatConsumerAuthTests(SimpleTestCase):
+    async def test_anonymous_user_is_rejected(self):
+        communicator = _communicator("room", AnonymousUser())
+        connected, _ = await communicator.connect()
+        self.assertFalse(connected)
+        await communicator.disconnect()
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class ChatConsumerStormTests(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        try:
+            connections.get_redis("chat-online").ping()
+        except Exception as e:
+            raise SkipTest(f"Redis 不可用: {type(e).__name__}")
+        super().setUpClass()
+
+    def setUp(self):
+        self.room_id = f"test_storm_{uuid.uuid4().hex[:12]}"
+        self.addCleanup(connections.get_redis("chat-online").delete, *[
+            f"room:{self.room_id}:{name}" for name in ("users", "visited_users", "muted_users")
+        ])
+        # 异步客户端的连接绑定事件循环，每个用例用新的客户端
+        patcher = mock.patch.dict(connections._async_redis, clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def test_connection_storm(self):
+        communicators = [
+            _communicator(self.room_id, SimpleNamespace(id=i % STORM_USERS, is_authenticated=True))
+            for i in range(STORM_CONNECTIONS)
+        ]
+        started = time.perf_counter()
+        results = await asyncio.gather(*(communicator.connect() for communicator in communicators))
+        self.assertTrue(all(connected for connected, _ in results))
+        self.assertEqual(await _wait_online_count(self.room_id, STORM_CONNECTIONS), STORM_CONNECTIONS)
+        elapsed = time.perf_counter() - started
+        print(f"\n[bench] {STORM_CONNECTIONS} 个并发连接并写入在线记录: {elapsed * 1000:.0f} ms")
+        self.assertEqual(ChatConsumer.get_visited_count(self.room_id), STORM_USERS)
+
+        await asyncio.gather(*(communicator.disconnect() for communicator in communicators))
+        self.assertEqual(await _wait_online_count(self.room_id, 0), 0)
+        self.assertEqual(ChatConsumer.get_visited_count(self.room_id), STORM_USERS)
+
+    async def test_messages_are_broadcast_unless_muted(self):
+        speaker = _communicator(self.room_id, SimpleNamespace(id=1, is_authenticated=True))
+        listener = _communicator(self.room_id, SimpleNamespace(id=2, is_authenticated=True))
+        await speaker.connect()
+        await listener.connect()
+        await _wait_online_count(self.room_id, 2)
+
+        await speaker.send_json_to({"text": "hi"})
+        expected = {"type": "chat_user_message", "data": {"text": "hi"}}
+        self.assertEqual(await listener.receive_json_from(), expected)
+        self.assertEqual(await speaker.receive_json_from(), expected)
+
+        connections.get_redis("chat-online").sadd(f"room:{self.room_id}:muted_users", 1)
+        await speaker.send_json_to({"text": "again"})
+        self.assertEqual(await speaker.receive_json_from(), {"error": "You are muted"})
+        self.assertTrue(await listener.receive_nothing())
+
+        await speaker.disconnect()
+        await listener.disconnect()
@@ -0,0 +1,96 @@
+"""
+楼层分配并发测试：多线程同时 allocate_floors，楼层号不重复、不留空，计数器冷启动时从已有的最大楼层接着分配
+需要 MongoDB（settings.MONGO_URI），连不上时跳过
+"""
+
+import random
+import threading
+import uuid
+from unittest import SkipTest
+
+from django.conf import settings
+from django.test import SimpleTestCase, override_settings
+from pymongo import MongoClient
+from pymongo.errors import PyMongoError
+
+from chatApp.api.common.common import FLOOR_COUNTER_COLLECTION, allocate_floors, seed_floor_counter
+from chatApp.api.common.connections import get_mongo_db
+from chatApp.api.common.messages import insert_message
+
+THREADS = 16
+ROUNDS = 50
+
+
+@override_settings(CHAT_STORAGE_MODE="per_room")
+class AllocateFloorsHammerTests(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        client = MongoClient(settings.MONGO_URI, serverSelectionTimeoutMS=1000)
+        try:
+            client.admin.command("ping")
+        except PyMongoError as e:
+            raise SkipTest(f"MongoDB 不可用: {type(e).__name__}")
+        finally:
+            client.close()
+        super().setUpClass()
+
+    def setUp(self):
+        self.db = get_mongo_db()
+        self.room_id = f"test_floors_{uuid.uuid4().hex[:12]}"
+
+    def tearDown(self):
+        self.db[FLOOR_COUNTER_COLLECTION].delete_one({"_id": self.room_id})
+        self.db.drop_collection(self.room_id)
+
+    def _hammer(self):
+        """THREADS 个线程同时起跑，每个线程分配 ROUNDS 次、每次 1~3 层，返回所有分到的楼层号"""
+        barrier = threading.Barrier(THREADS)
+        floors = [[] for _ in range(THREADS)]
+        errors = []
+
+        def worker(index):
+            rng = random.Random(index)
+            try:
+                barrier.wait()
+                for _ in range(ROUNDS):
+                    count = rng.randint(1, 3)
+                    first = allocate_floors(self.db, self.room_id, count)
+                    floors[index].extend(range(first, first + count))
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(THREADS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        return [floor for chunk in floors for floor in chunk]
+
+    def test_cold_counter_is_duplicate_free_and_contiguous(self):
+        # 计数器不存在：多个线程同时走初始化分支
+        allocated = self._hammer()
+        self.assertEqual(len(allocated), len(set(allocated)))
+        self.assertEqual(sorted(allocated), list(range(1, len(allocated) + 1)))
+
+    def test_cold_counter_continues_after_existing_messages(self):
+        for floor in range(1, 6):
+            insert_message(self.room_id, {"floor": floor, "data_type": "ai", "data": {"mes": "x"}})
+        allocated = self._hammer()
+        self.assertEqual(sorted(allocated), list(range(6, 6 + len(allocated))))
+
+    def test_seeded_counter_never_moves_backwards(self):
+        seed_floor_counter(self.db, self.room_id, 100)
+        barrier = threading.Barrier(2)
+
+        def reseed():
+            barrier.wait()
+            for _ in range(ROUNDS):
+                seed_floor_counter(self.db, self.room_id, 50)
+
+        thread = threading.Thread(target=reseed)
+        thread.start()
+        barrier.wait()
+        first = [allocate_floors(self.db, self.room_id, 1) for _ in range(ROUNDS)]
+        thread.join()
+        self.assertEqual(first, list(range(101, 101 + ROUNDS)))
@@ -0,0 +1,114 @@
+"""
+fork_chat_stream（SSE）：第一个 token 在生成结束前送达、done 前保存完整回复、网关繁忙和客户端断开的处理
+大模型网关、MongoDB 写入用桩函数代替
+"""
+
+import asyncio
+import contextlib
+import io
+import json
+import time
+from unittest import mock
+
+from django.test import RequestFactory, SimpleTestCase
+
+from chatApp.api.common.llm_gateway import LLMGatewayBusy
+from chatApp.api.fork import fork_chat
+
+TOKEN_INTERVAL = 0.1
+TOKENS = ["你", "好", "，", "世", "界"]
+
+CTX = {"user_id": 1, "room_id": "room", "messages_openai": [{"role": "user", "content": "hi"}],
+       "temperature": 1.0, "top_p": 0.9, "max_output_tokens": 100}
+
+
+class _FakeGateway:
+    def __init__(self, error=None):
+        self.error = error
+        self.closed = False
+
+    async def astream(self, user_id, **kwargs):
+        try:
+            for token in TOKENS:
+                await asyncio.sleep(TOKEN_INTERVAL)
+                yield token
+            if self.error:
+                raise self.error
+        finally:
+            self.closed = True
+
+
+def _parse(chunk):
+    chunk = chunk.decode() if isinstance(chunk, bytes) else chunk
+    event, data = chunk.strip().split("\n")
+    return event.removeprefix("event: "), json.loads(data.removeprefix("data: "))
+
+
+class ForkChatStreamTests(SimpleTestCase):
+    def setUp(self):
+        self.gateway = _FakeGateway()
+        self.saved = []
+        patchers = [
+            mock.patch.object(fork_chat, "_prepare_async_request", return_value=(CTX, None)),
+            mock.patch.object(fork_chat, "get_gateway", side_effect=lambda: self.gateway),
+            mock.patch.object(fork_chat, "_save_ai_reply", side_effect=lambda ctx, text: self.saved.append(text)),
+            mock.patch.object(fork_chat, "_latest_result", return_value=[{"floor": 2}]),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    async def _post(self):
+        request = RequestFactory().post("/api/fork/fork_chat_stream/", {"room_id": "room", "message": "hi"})
+        return await fork_chat.fork_chat_stream(request)
+
+    async def test_first_token_arrives_before_generation_ends(self):
+        started = time.perf_counter()
+        response = await self._post()
+        self.assertEqual(response["Content-Type"], "text/event-stream")
+        events = []
+        arrivals = []
+        async for chunk in response.streaming_content:
+            arrivals.append(time.perf_counter() - started)
+            events.append(_parse(chunk))
+        print(f"\n[bench] SSE 首个 token: {arrivals[0] * 1000:.0f} ms，完成: {arrivals[-1] * 1000:.0f} ms")
+
+        self.assertEqual(events[:-1], [("delta", {"text": token}) for token in TOKENS])
+        self.assertEqual(events[-1], ("done", {"code": 0, "message": "success", "data": [{"floor": 2}]}))
+        # 没有被整体缓冲：第一个 token 比最后一个 token 至少早 3 个间隔送达
+        self.assertLess(arrivals[0], arrivals[-2] - 3 * TOKEN_INTERVAL)
+        self.assertEqual(self.saved, ["".join(TOKENS)])
+
+    async def test_busy_gateway_sends_error_event_without_saving(self):
+        self.gateway = _FakeGateway(error=LLMGatewayBusy("queue full"))
+        response = await self._post()
+        events = [_parse(chunk) async for chunk in response.streaming_content]
+        self.assertEqual(events[-1][0], "error")
+        self.assertIn("queue full", events[-1][1]["message"])
+        self.assertEqual(self.saved, [])
+
+    async def test_client_disconnect_closes_upstream_without_saving(self):
+        response = await self._post()
+        received = []
+
+        async def send_response():
+            async for chunk in response.streaming_content:
+                received.append(_parse(chunk))
+
+        # 客户端断开时 Django 取消发送响应的任务
+        task = asyncio.ensure_future(send_response())
+        while not received:
+            await asyncio.sleep(0.01)
+        task.cancel()
+        with contextlib.redirect_stdout(io.StringIO()), self.assertRaises(asyncio.CancelledError):
+            await task
+        self.assertEqual(received, [("delta", {"text": TOKENS[0]})])
+        self.assertTrue(self.gateway.closed)
+        self.assertEqual(self.saved, [])
+
+
+class ForkChatStreamAuthTests(SimpleTestCase):
+    async def test_anonymous_request_is_rejected_before_streaming(self):
+        request = RequestFactory().post("/api/fork/fork_chat_stream/", {"room_id": "room", "message": "hi"})
+        response = await fork_chat.fork_chat_stream(request)
+        self.assertEqual(response.status_code, 401)
@@ -0,0 +1,165 @@
+"""
+fork 聊天记录复制：后台复制中断后的恢复、fork_status 的权限、10k 楼层复制基准
+恢复用例需要 Redis，基准需要 MongoDB，连不上时跳过
+"""
+
+import json
+import threading
+import time
+import uuid
+from unittest import SkipTest, mock
+
+from django.conf import settings
+from django.test import SimpleTestCase, TestCase, override_settings
+from pymongo import MongoClient
+from pymongo.errors import PyMongoError
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from chatApp.api.common.connections import get_mongo_db
+from chatApp.api.common.messages import copy_history, find_messages
+from chatApp.api.fork import fork
+from chatApp.models import ChatUser, RoomInfo
+
+BENCH_FLOORS = 10000
+
+
+class ForkCopyResumeTests(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        try:
+            fork.redis_client.ping()
+        except Exception as e:
+            raise SkipTest(f"Redis 不可用: {type(e).__name__}")
+        super().setUpClass()
+
+    def setUp(self):
+        self.room_id = f"test_fork_{uuid.uuid4().hex[:12]}"
+        self.key = fork._fork_status_key(self.room_id)
+        self.addCleanup(fork.redis_client.delete, self.key)
+        self.copies = []
+        patchers = [
+            mock.patch.object(fork, "copy_history", side_effect=self._copy),
+            mock.patch.object(fork, "refresh_feed_cards"),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _copy(self, origin_room_id, new_room_id, floor, overrides):
+        self.copies.append((origin_room_id, new_room_id, floor, overrides))
+
+    def _set_state(self, status, age=0, attempts=1):
+        state = json.loads(fork._copy_state(status, "origin", 5000, {"uid": 1, "room_id": self.room_id}, attempts))
+        state["started_at"] -= age
+        fork.redis_client.set(self.key, json.dumps(state), ex=fork.FORK_STATUS_TTL)
+
+    def _wait_done(self, timeout=2):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            status = fork.resume_fork_copy(self.room_id)
+            if status != "pending":
+                return status
+            time.sleep(0.01)
+        return "pending"
+
+    def test_no_record_means_done(self):
+        self.assertEqual(fork.resume_fork_copy(self.room_id), "done")
+        self.assertFalse(fork.fork_copy_pending(self.room_id))
+
+    def test_running_copy_stays_pending(self):
+        self._set_state("pending")
+        self.assertTrue(fork.fork_copy_pending(self.room_id))
+        self.assertEqual(self.copies, [])
+
+    def test_stale_pending_is_copied_again(self):
+        self._set_state("pending", age=fork.FORK_COPY_STALE_AFTER + 1)
+        self.assertEqual(fork.resume_fork_copy(self.room_id), "pending")
+        self.assertEqual(self._wait_done(), "done")
+        self.assertEqual(self.copies, [("origin", self.room_id, 5000, {"uid": 1, "room_id": self.room_id})])
+
+    def test_failed_copy_is_retried_until_attempts_run_out(self):
+        self._set_state("failed", attempts=fork.FORK_COPY_MAX_ATTEMPTS)
+        self.assertEqual(fork.resume_fork_copy(self.room_id), "failed")
+        self.assertFalse(fork.fork_copy_pending(self.room_id))
+        self.assertEqual(self.copies, [])
+
+        self._set_state("failed", attempts=1)
+        self.assertEqual(self._wait_done(), "done")
+        self.assertEqual(len(self.copies), 1)
+
+    def test_concurrent_resume_starts_one_copy(self):
+        self._set_state("pending", age=fork.FORK_COPY_STALE_AFTER + 1)
+        barrier = threading.Barrier(8)
+
+        def poll():
+            barrier.wait()
+            fork.resume_fork_copy(self.room_id)
+
+        threads = [threading.Thread(target=poll) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self._wait_done(), "done")
+        self.assertEqual(len(self.copies), 1)
+
+
+class ForkStatusPermissionTests(TestCase):
+    def test_other_users_room_is_not_visible(self):
+        owner = ChatUser.objects.create(username="owner", password="x")
+        other = ChatUser.objects.create(username="other", password="x")
+        # bulk_create 不触发 post_save（信息流卡片刷新需要 MongoDB）
+        RoomInfo.objects.bulk_create([RoomInfo(uid=str(owner.id), room_id="forked_room", room_name="n",
+                                               character_name="c", title="t", is_info=0, is_show=0,
+                                               file_branch="branch", coin_num=0)])
+        factory = APIRequestFactory()
+        request = factory.get("/api/fork/fork_status/", {"room_id": "forked_room"})
+        force_authenticate(request, user=other)
+        self.assertEqual(fork.fork_status(request).status_code, 404)
+
+        request = factory.get("/api/fork/fork_status/", {"room_id": "forked_room"})
+        force_authenticate(request, user=owner)
+        with mock.patch.object(fork, "resume_fork_copy", return_value="done"):
+            response = fork.fork_status(request)
+        self.assertEqual(response.data["data"]["status"], "done")
+
+
+@override_settings(CHAT_STORAGE_MODE="per_room")
+class ForkCopyBenchmarkTests(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        client = MongoClient(settings.MONGO_URI, serverSelectionTimeoutMS=1000)
+        try:
+            client.admin.command("ping")
+        except PyMongoError as e:
+            raise SkipTest(f"MongoDB 不可用: {type(e).__name__}")
+        finally:
+            client.close()
+        super().setUpClass()
+
+    def setUp(self):
+        self.db = get_mongo_db()
+        self.origin = f"test_fork_src_{uuid.uuid4().hex[:12]}"
+        self.new = f"test_fork_dst_{uuid.uuid4().hex[:12]}"
+        for room_id in (self.origin, self.new):
+            self.addCleanup(self.db.drop_collection, room_id)
+        self.addCleanup(self.db["room_floor_counters"].delete_one, {"_id": self.new})
+        self.db[self.origin].insert_many([
+            {"floor": floor, "room_id": self.origin, "data_type": "ai" if floor % 2 else "user",
+             "data": {"mes": "消息内容 " * 40, "send_date": "2025-01-01T00:00:00Z"}}
+            for floor in range(1, BENCH_FLOORS + 1)
+        ])
+
+    def test_fork_10k_floors(self):
+        started = time.perf_counter()
+        copy_history(self.origin, self.new, BENCH_FLOORS - 100, {"uid": 2, "room_id": self.new})
+        elapsed = time.perf_counter() - started
+        print(f"\n[bench] fork 复制 {BENCH_FLOORS - 100} 楼: {elapsed * 1000:.0f} ms")
+
+        self.assertEqual(self.db[self.new].count_documents({}), BENCH_FLOORS - 100)
+        last = list(find_messages(self.new, projection={"floor": 1, "uid": 1}, sort=[("floor", -1)], limit=1))
+        self.assertEqual(last[0]["floor"], BENCH_FLOORS - 100)
+        self.assertEqual(last[0]["uid"], 2)
+        # 重复执行（恢复中断的复制）是幂等的
+        copy_history(self.origin, self.new, BENCH_FLOORS - 100, {"uid": 2, "room_id": self.new})
+        self.assertEqual(self.db[self.new].count_documents({}), BENCH_FLOORS - 100)
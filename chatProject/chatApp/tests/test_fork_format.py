@@ -0,0 +1,85 @@
+"""
+fork_format 渲染结果与重写前的实现逐字节一致
+fixtures/fork_format_golden.json 由单次扫描改写前的 replace_quotes / format_message 生成（人工用例 + 固定种子的随机拼接），
+修改格式化逻辑导致输出变化时需要同时重新生成金样并修改 HTML_CACHE_VERSION
+- cases：逐字节比较
+- codehilite_cases：含代码块，高亮结果由 Pygments 生成，不同版本对引号等字符的转义不同（" 或 &quot;），
+  还原 HTML 实体后再比较
+"""
+
+import contextlib
+import html
+import io
+import json
+from pathlib import Path
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from chatApp.api.fork import fork_format
+
+GOLDEN_PATH = Path(__file__).resolve().parent / "fixtures" / "fork_format_golden.json"
+
+
+class _DictRedis:
+    """只实现 get / set 的内存 Redis，记录写入次数"""
+
+    def __init__(self):
+        self.data = {}
+        self.sets = 0
+
+    def get(self, key):
+        value = self.data.get(key)
+        return value.encode("utf-8") if value is not None else None
+
+    def set(self, key, value, ex=None):
+        self.sets += 1
+        self.data[key] = value
+
+
+class ForkFormatGoldenTests(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        with open(GOLDEN_PATH, encoding="utf-8") as f:
+            golden = json.load(f)
+        cls.scripts = golden["character_regex_scripts"]
+        cls.cases = golden["cases"]
+        cls.codehilite_cases = golden["codehilite_cases"]
+
+    def _format(self, text, **kwargs):
+        # 格式化时每条消息都会打印正则脚本日志
+        with contextlib.redirect_stdout(io.StringIO()):
+            return fork_format.format_message(text, character_regex_scripts=self.scripts, **kwargs)
+
+    def test_replace_quotes(self):
+        for case in self.cases:
+            with self.subTest(case["name"]):
+                self.assertEqual(fork_format.replace_quotes(case["input"]), case["replace_quotes"])
+
+    def test_format_message(self):
+        for case in self.cases:
+            with self.subTest(case["name"]):
+                self.assertEqual(self._format(case["input"], use_cache=False), case["format_message"])
+
+    def test_codehilite_cases(self):
+        for case in self.codehilite_cases:
+            with self.subTest(case["name"]):
+                self.assertEqual(html.unescape(fork_format.replace_quotes(case["input"])),
+                                 html.unescape(case["replace_quotes"]))
+                self.assertEqual(html.unescape(self._format(case["input"], use_cache=False)),
+                                 html.unescape(case["format_message"]))
+
+    def test_format_message_cached(self):
+        """缓存未命中时写入渲染结果，命中时原样返回；短消息不走缓存"""
+        redis_client = _DictRedis()
+        with mock.patch.object(fork_format, "get_redis", return_value=redis_client):
+            for case in self.cases:
+                with self.subTest(case["name"]):
+                    self.assertEqual(self._format(case["input"]), case["format_message"])
+                    sets = redis_client.sets
+                    self.assertEqual(self._format(case["input"]), case["format_message"])
+                    self.assertEqual(redis_client.sets, sets)
+        cacheable = [case for case in self.cases if len(case["input"]) >= fork_format.HTML_CACHE_MIN_LENGTH]
+        self.assertTrue(cacheable)
+        self.assertEqual(redis_client.sets, len({case["input"] for case in cacheable}))
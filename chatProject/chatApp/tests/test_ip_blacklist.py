@@ -0,0 +1,59 @@
+"""
+进程内 IP 黑名单：首次查询一定先加载、并发查询只加载一次、单个 IP 与网段匹配
+不启动 Redis 订阅线程
+"""
+
+import threading
+import time
+from unittest import mock
+
+from django.test import SimpleTestCase, TestCase
+
+from chatApp.middleware import ip_blacklist as blacklist_module
+from chatApp.models import IPBlacklist
+
+
+def _blacklist(**kwargs):
+    blacklist = blacklist_module.IpBlacklistSet(**kwargs)
+    blacklist._start_listener = lambda: None
+    return blacklist
+
+
+class IpBlacklistLoadTests(TestCase):
+    def test_first_lookup_loads_even_right_after_boot(self):
+        # bulk_create 不触发 post_save 广播
+        IPBlacklist.objects.bulk_create([IPBlacklist(ip="203.0.113.7"), IPBlacklist(ip="203.0.113.8", is_active=False)])
+        blacklist = _blacklist(networks=["10.0.0.0/8", "2001:db8::/32"])
+        # 主机刚启动时 monotonic() 可能小于刷新间隔
+        with mock.patch.object(blacklist_module.time, "monotonic", return_value=1.0):
+            self.assertTrue(blacklist.contains("203.0.113.7"))
+        self.assertFalse(blacklist.contains("203.0.113.8"))
+        self.assertTrue(blacklist.contains("10.1.2.3"))
+        self.assertTrue(blacklist.contains("2001:db8::1"))
+        self.assertFalse(blacklist.contains("11.0.0.1"))
+        self.assertFalse(blacklist.contains("not-an-ip"))
+
+
+class IpBlacklistConcurrencyTests(SimpleTestCase):
+    def test_concurrent_lookups_reload_once(self):
+        blacklist = _blacklist()
+        calls = []
+
+        def reload():
+            calls.append(1)
+            time.sleep(0.05)
+            blacklist._loaded_at = time.monotonic()
+
+        blacklist.reload = reload
+        barrier = threading.Barrier(8)
+
+        def lookup():
+            barrier.wait()
+            blacklist.contains("203.0.113.7")
+
+        threads = [threading.Thread(target=lookup) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(calls), 1)
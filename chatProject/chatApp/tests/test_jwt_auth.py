@@ -0,0 +1,97 @@
+"""
+WebSocket JWT 认证的用户快照缓存：未订阅时不使用缓存、广播失效、停用用户立即无法连接
+广播用例需要 Redis，连不上时跳过
+"""
+
+import time
+import uuid
+from unittest import SkipTest, mock
+
+from asgiref.sync import async_to_sync
+from django.contrib.auth.models import AnonymousUser
+from django.test import SimpleTestCase, TestCase
+from rest_framework_simplejwt.tokens import AccessToken
+
+from chatApp.api.common.connections import get_redis
+from chatApp.middleware import jwt_auth
+from chatApp.models import ChatUser
+
+
+def _wait(predicate, timeout=3):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+class _RedisRequired:
+    @classmethod
+    def setUpClass(cls):
+        try:
+            get_redis().ping()
+        except Exception as e:
+            raise SkipTest(f"Redis 不可用: {type(e).__name__}")
+        super().setUpClass()
+
+
+class UserSnapshotCacheTests(SimpleTestCase):
+    def _cache(self, subscribed, ttl=300):
+        cache = jwt_auth.UserSnapshotCache(max_size=2, ttl=ttl)
+        cache._ensure_listener = lambda: None
+        cache._subscribed = subscribed
+        return cache
+
+    def test_cache_is_bypassed_until_subscribed(self):
+        cache = self._cache(subscribed=False)
+        cache.set("1", "user")
+        self.assertIsNone(cache.get("1"))
+        self.assertEqual(cache.stats()["bypassed"], 1)
+        self.assertEqual(cache.stats()["size"], 0)
+
+    def test_hits_expiry_and_lru(self):
+        cache = self._cache(subscribed=True)
+        cache.set("1", "a")
+        cache.set("2", "b")
+        self.assertEqual(cache.get("1"), "a")
+        cache.set("3", "c")  # 淘汰最久未使用的 "2"
+        self.assertIsNone(cache.get("2"))
+        cache.invalidate("1")
+        self.assertIsNone(cache.get("1"))
+        stats = cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"], stats["size"]), (1, 2, 1))
+
+        cache = self._cache(subscribed=True, ttl=0)
+        cache.set("1", "a")
+        self.assertIsNone(cache.get("1"))
+
+
+class UserCacheBroadcastTests(_RedisRequired, SimpleTestCase):
+    def test_invalidation_reaches_every_worker(self):
+        channel = f"test:ws_auth:{uuid.uuid4().hex[:12]}"
+        workers = [jwt_auth.UserSnapshotCache(channel=channel) for _ in range(2)]
+        for cache in workers:
+            cache._ensure_listener()
+        self.assertTrue(_wait(lambda: all(cache._subscribed for cache in workers)))
+        for cache in workers:
+            cache.set("7", "user")
+            self.assertEqual(cache.get("7"), "user")
+
+        get_redis().publish(channel, "7")
+        self.assertTrue(_wait(lambda: all(cache.stats()["size"] == 0 for cache in workers)))
+
+
+class DeactivatedUserTests(_RedisRequired, TestCase):
+    def test_deactivated_user_is_rejected_on_next_handshake(self):
+        self.assertTrue(_wait(lambda: jwt_auth.user_cache._ensure_listener() or jwt_auth.user_cache._subscribed))
+        user = ChatUser.objects.create(username=f"ws_{uuid.uuid4().hex[:8]}", password="x")
+        token = str(AccessToken.for_user(user))
+        self.assertEqual(async_to_sync(jwt_auth.get_user_from_token)(token).pk, user.pk)
+
+        # 另一个 worker 停用用户：本进程只通过广播得知
+        with mock.patch.object(jwt_auth.user_cache, "invalidate", wraps=jwt_auth.user_cache.invalidate) as invalidate:
+            ChatUser.objects.filter(pk=user.pk).update(is_active=False)
+            get_redis().publish(jwt_auth.USER_INVALIDATION_CHANNEL, str(user.pk))
+            self.assertTrue(_wait(lambda: invalidate.called))
+        self.assertIsInstance(async_to_sync(jwt_auth.get_user_from_token)(token), AnonymousUser)
@@ -0,0 +1,111 @@
+"""
+首页直播列表：不再逐个房间查询 MongoDB，房间数从 100 增加到 100k 时查询条数不变
+last_ai_reply_timestamp 由写入时维护、refresh_last_ai_reply 命令批量校准（MongoDB 用桩函数代替）
+"""
+
+import contextlib
+import io
+import time
+from unittest import mock
+
+from django.core.management import call_command
+from django.db import connection
+from django.utils import timezone
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIRequestFactory
+
+from chatApp.api.client import lives
+from chatApp.api.common.common import update_last_ai_reply
+from chatApp.management.commands import refresh_last_ai_reply
+from chatApp.models import CharacterCard, RoomImageBinding, RoomInfo
+
+ROOM_COUNTS = (100, 1000, 10000, 100000)
+
+
+def _rooms(start, stop, **fields):
+    return [RoomInfo(uid=str(i % 100), room_id=f"room_{i}", room_name="n", character_name="c", title="t",
+                     coin_num=0, is_show=0, file_branch="main", weight=i % 3,
+                     last_ai_reply_timestamp=float(i), **fields) for i in range(start, stop)]
+
+
+def _insert_rooms(start, stop):
+    # 10 万行用 bulk_create 要半分钟以上，直接 executemany
+    now = timezone.now()
+    columns = ["uid", "room_id", "room_name", "character_name", "character_date", "title", "coin_num", "room_type",
+               "is_show", "file_branch", "created_at", "updated_at", "last_ai_reply_timestamp", "weight"]
+    sql = "INSERT INTO {} ({}) VALUES ({})".format(
+        RoomInfo._meta.db_table, ", ".join(columns), ", ".join(["%s"] * len(columns)))
+    with connection.cursor() as cursor:
+        cursor.executemany(sql, [(str(i % 100), f"room_{i}", "n", "c", "", "t", 0, 0, 0, "main", now, now, float(i), i % 3)
+                                 for i in range(start, stop)])
+
+
+class GetAllLivesScalingTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        # bulk_create 不触发 post_save（信息流卡片刷新需要 MongoDB）
+        cls.card = CharacterCard.objects.bulk_create([CharacterCard(
+            uid="1", username="u", character_name="c", image_name="i.png", image_path="p",
+            character_data="{}", create_date="", review_status="approved", tags="t", language="cn")])[0]
+
+    def _get_page(self):
+        request = APIRequestFactory().get("/api/live/get_all_lives")
+        with mock.patch.object(lives, "find_one_message", side_effect=AssertionError("列表接口不应查询 MongoDB")), \
+                CaptureQueriesContext(connection) as queries:
+            started = time.perf_counter()
+            response = lives.get_all_lives(request)
+            elapsed = time.perf_counter() - started
+        return response, len(queries), elapsed
+
+    def test_page_cost_does_not_grow_with_room_count(self):
+        created = 0
+        query_counts = set()
+        for count in ROOM_COUNTS:
+            _insert_rooms(created, count)
+            created = count
+            # 权重优先，其次最后 AI 回复时间；只给能排进第一页的房间绑定角色卡
+            expected = sorted(range(count), key=lambda i: (i % 3, i), reverse=True)[:lives.IDCursorPagination.page_size]
+            RoomImageBinding.objects.bulk_create([
+                RoomImageBinding(uid=str(i % 100), room_id=f"room_{i}", image_id=self.card.id) for i in expected
+            ])
+
+            response, num_queries, elapsed = self._get_page()
+            print(f"\n[bench] get_all_lives {count} 个房间: {elapsed * 1000:.1f} ms, {num_queries} 条 SQL")
+            query_counts.add(num_queries)
+            self.assertEqual([r["room_id"] for r in response.data["data"]["results"]], [f"room_{i}" for i in expected])
+        self.assertEqual(len(query_counts), 1)
+
+
+class LastAiReplyTests(TestCase):
+    def setUp(self):
+        RoomInfo.objects.bulk_create(_rooms(0, 3))
+
+    def _timestamp(self, room_id):
+        return RoomInfo.objects.get(room_id=room_id).last_ai_reply_timestamp
+
+    def test_write_path_only_moves_forward(self):
+        update_last_ai_reply("room_1", "2025-09-12 22:30:00")
+        newer = self._timestamp("room_1")
+        self.assertGreater(newer, 1.0)
+        update_last_ai_reply("room_1", "2025-01-01 00:00:00")
+        update_last_ai_reply("room_1", "not a date")
+        self.assertEqual(self._timestamp("room_1"), newer)
+
+    def test_refresh_command_reconciles_in_batches(self):
+        docs = {"room_0": {"data": {"send_date": "September 12, 2025 10:30pm"}},
+                "room_2": {"data": {"send_date": "garbage"}}}
+        calls = []
+
+        def first_message_per_room(room_ids, query, projection=None, latest=False):
+            calls.append(list(room_ids))
+            return {room_id: docs[room_id] for room_id in room_ids if room_id in docs}
+
+        with mock.patch.object(refresh_last_ai_reply, "first_message_per_room", side_effect=first_message_per_room), \
+                contextlib.redirect_stdout(io.StringIO()):
+            call_command("refresh_last_ai_reply", batch_size=2, stdout=io.StringIO())
+
+        self.assertEqual([len(batch) for batch in calls], [2, 1])
+        self.assertGreater(self._timestamp("room_0"), 1.0)
+        self.assertEqual(self._timestamp("room_1"), 1.0)
+        self.assertEqual(self._timestamp("room_2"), 2.0)
@@ -0,0 +1,223 @@
+"""
+大模型网关：用本地的 OpenAI 兼容桩服务器测试并发名额、排队截止时间、重试和取消
+"""
+
+import asyncio
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import openai
+from django.test import SimpleTestCase
+
+from chatApp.api.common.llm_gateway import LLMGateway, LLMGatewayBusy
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    """POST /v1/chat/completions：先等 delay 秒再返回；failures > 0 时返回 500 并减一"""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        server = self.server
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        with server.lock:
+            server.requests.append(body)
+            server.active += 1
+            server.peak = max(server.peak, server.active)
+            fail = server.failures > 0
+            if fail:
+                server.failures -= 1
+        try:
+            if fail:
+                self._send_json(500, {"error": {"message": "stub error", "type": "server_error"}})
+            elif body.get("stream"):
+                self._send_stream(body)
+            else:
+                time.sleep(server.delay)
+                self._send_json(200, {
+                    "id": "stub", "object": "chat.completion", "created": 0, "model": body["model"],
+                    "choices": [{"index": 0, "finish_reason": "stop",
+                                 "message": {"role": "assistant", "content": body["messages"][-1]["content"]}}],
+                })
+        finally:
+            with server.lock:
+                server.active -= 1
+
+    def _send_json(self, status, data):
+        payload = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _send_stream(self, body):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        def write(data):
+            data = data.encode()
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+            self.wfile.flush()
+
+        try:
+            for i in range(self.server.chunks):
+                chunk = {"id": "stub", "object": "chat.completion.chunk", "created": 0, "model": body["model"],
+                         "choices": [{"index": 0, "delta": {"content": f"t{i} "}, "finish_reason": None}]}
+                write(f"data: {json.dumps(chunk)}\n\n")
+                time.sleep(self.server.delay)
+            write("data: [DONE]\n\n")
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+
+class LLMGatewayTests(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), _StubHandler)
+        cls.server.daemon_threads = True
+        cls.server.lock = threading.Lock()
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    def setUp(self):
+        self.server.requests = []
+        self.server.active = self.server.peak = self.server.failures = 0
+        self.server.delay = 0.05
+        self.server.chunks = 3
+        self.gateways = []
+
+    def tearDown(self):
+        for gateway in self.gateways:
+            asyncio.run_coroutine_threadsafe(gateway.loop.shutdown_asyncgens(), gateway.loop).result(timeout=5)
+            gateway.loop.call_soon_threadsafe(gateway.loop.stop)
+            gateway.thread.join(timeout=5)
+
+    def gateway(self, **overrides):
+        options = {
+            "LLM_BASE_URL": f"http://127.0.0.1:{self.server.server_port}/v1",
+            "LLM_API_KEY": "test",
+            "LLM_MAX_CONCURRENCY": 4,
+            "LLM_MAX_PER_USER": 2,
+            "LLM_MAX_QUEUE": 200,
+            "LLM_QUEUE_TIMEOUT": 5,
+            "LLM_MAX_RETRIES": 2,
+            "LLM_RETRY_BASE_DELAY": 0.01,
+        }
+        options.update(overrides)
+        # 客户端在第一次请求时创建，设置要覆盖到测试结束
+        settings_override = self.settings(**options)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        gateway = LLMGateway()
+        self.gateways.append(gateway)
+        return gateway
+
+    @staticmethod
+    def messages(text):
+        return {"model": "stub", "messages": [{"role": "user", "content": text}]}
+
+    def test_complete(self):
+        gateway = self.gateway()
+        self.assertEqual(gateway.complete(1, **self.messages("hello")), "hello")
+        stats = gateway.stats()
+        self.assertEqual((stats["completed"], stats["in_flight"]), (1, 0))
+
+    async def test_acomplete(self):
+        gateway = self.gateway()
+        self.assertEqual(await gateway.acomplete(1, **self.messages("hello")), "hello")
+
+    async def test_per_user_limit(self):
+        gateway = self.gateway(LLM_MAX_PER_USER=1)
+        self.server.delay = 0.1
+        started = time.monotonic()
+        replies = await asyncio.gather(*(gateway.acomplete(1, **self.messages(str(i))) for i in range(3)))
+        self.assertEqual(replies, ["0", "1", "2"])
+        # 同一个用户一次只能有一个请求在进行
+        self.assertEqual(self.server.peak, 1)
+        self.assertGreaterEqual(time.monotonic() - started, 0.3)
+
+        self.server.peak = 0
+        await asyncio.gather(*(gateway.acomplete(user, **self.messages("x")) for user in (1, 2, 3)))
+        self.assertEqual(self.server.peak, 3)
+
+    async def test_global_limit(self):
+        gateway = self.gateway(LLM_MAX_CONCURRENCY=2, LLM_MAX_PER_USER=10)
+        await asyncio.gather(*(gateway.acomplete(user, **self.messages("x")) for user in range(6)))
+        self.assertEqual(self.server.peak, 2)
+        self.assertEqual(gateway.stats()["completed"], 6)
+
+    async def test_deadline_rejection(self):
+        gateway = self.gateway(LLM_MAX_CONCURRENCY=1)
+        self.server.delay = 0.5
+        running = asyncio.ensure_future(gateway.acomplete(1, **self.messages("slow")))
+        while gateway.stats()["in_flight"] == 0:
+            await asyncio.sleep(0.01)
+        # 名额被占满，等到截止时间仍未轮到
+        with self.assertRaises(LLMGatewayBusy):
+            await gateway.acomplete(2, queue_timeout=0.1, **self.messages("late"))
+        self.assertEqual(await running, "slow")
+        stats = gateway.stats()
+        self.assertEqual((stats["rejected"], stats["queued"]), (1, 0))
+        self.assertEqual(len(self.server.requests), 1)
+
+    async def test_queue_full_rejection(self):
+        gateway = self.gateway(LLM_MAX_CONCURRENCY=1, LLM_MAX_QUEUE=0)
+        self.server.delay = 0.3
+        running = asyncio.ensure_future(gateway.acomplete(1, **self.messages("slow")))
+        while gateway.stats()["in_flight"] == 0:
+            await asyncio.sleep(0.01)
+        with self.assertRaises(LLMGatewayBusy):
+            await gateway.acomplete(2, **self.messages("x"))
+        await running
+
+    def test_retry_on_server_error(self):
+        gateway = self.gateway()
+        self.server.failures = 1
+        self.assertEqual(gateway.complete(1, **self.messages("again")), "again")
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(gateway.stats()["retries"], 1)
+
+    def test_retries_exhausted(self):
+        gateway = self.gateway(LLM_MAX_RETRIES=2)
+        self.server.failures = 10
+        with self.assertRaises(openai.InternalServerError):
+            gateway.complete(1, **self.messages("x"))
+        # 第一次 + 2 次重试
+        self.assertEqual(len(self.server.requests), 3)
+        stats = gateway.stats()
+        self.assertEqual((stats["failed"], stats["in_flight"]), (1, 0))
+
+    def test_stream(self):
+        gateway = self.gateway()
+        self.assertEqual(list(gateway.stream(1, **self.messages("x"))), ["t0 ", "t1 ", "t2 "])
+
+    async def test_astream_and_cancel(self):
+        gateway = self.gateway()
+        self.assertEqual([text async for text in gateway.astream(1, **self.messages("x"))], ["t0 ", "t1 ", "t2 "])
+
+        # 调用方提前关闭生成器（客户端断开）：上游请求被取消，名额归还
+        self.server.chunks = 50
+        tokens = gateway.astream(1, **self.messages("x"))
+        self.assertEqual(await tokens.__anext__(), "t0 ")
+        await tokens.aclose()
+        for _ in range(100):
+            if gateway.stats()["cancelled"]:
+                break
+            await asyncio.sleep(0.01)
+        stats = gateway.stats()
+        self.assertEqual((stats["cancelled"], stats["in_flight"]), (1, 0))
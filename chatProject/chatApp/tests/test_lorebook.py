@@ -0,0 +1,108 @@
+"""
+世界书条目激活：1000 条目的激活结果与逐条子串匹配一致并输出耗时，以及 selective、正则、递归、token 预算等规则
+"""
+
+import random
+import time
+
+from django.test import SimpleTestCase
+
+from chatApp.api.fork import lorebook as lorebook_module
+from chatApp.api.fork.lorebook import AND_ALL, AND_ANY, NOT_ALL, NOT_ANY, Lorebook, get_lorebook
+
+ENTRIES = 1000
+ACTIVATIONS = 500
+
+
+def _entry(content, keys, **fields):
+    return {"content": content, "keys": keys, **fields}
+
+
+class LorebookScaleTests(SimpleTestCase):
+    def test_1000_entries_match_naive_scan(self):
+        rng = random.Random(19)
+        rows = [_entry(f"条目{i}", [f"关键词{i:04d}", f"Key{i:04d}"], insertion_order=i) for i in range(ENTRIES)]
+
+        started = time.perf_counter()
+        book = Lorebook({"entries": rows, "token_budget": 10 ** 6})
+        build_ms = (time.perf_counter() - started) * 1000
+
+        messages = []
+        for _ in range(ACTIVATIONS):
+            words = [rng.choice([f"关键词{rng.randrange(ENTRIES):04d}", f"KEY{rng.randrange(ENTRIES):04d}"])
+                     for _ in range(rng.randrange(4))]
+            messages.append(["今天天气不错，" + "，".join(words), "随便聊聊" * 50])
+
+        started = time.perf_counter()
+        results = [book.activate(recent) for recent in messages]
+        activate_ms = (time.perf_counter() - started) * 1000
+
+        started = time.perf_counter()
+        expected = []
+        for recent in messages:
+            text = "\n".join(recent).lower()
+            expected.append("\n".join(row["content"] for row in rows
+                                      if any(key.lower() in text for key in row["keys"])))
+        naive_ms = (time.perf_counter() - started) * 1000
+        print(f"\n[bench] 世界书 {ENTRIES} 条目：构建 {build_ms:.1f} ms，"
+              f"激活 {activate_ms / ACTIVATIONS:.3f} ms/次（逐条子串匹配 {naive_ms / ACTIVATIONS:.3f} ms/次）")
+
+        self.assertEqual(results, expected)
+        self.assertTrue(any(results))
+
+
+class LorebookRulesTests(SimpleTestCase):
+    def _activate(self, rows, messages, **book):
+        return Lorebook({"entries": rows, **book}).activate(messages).split("\n")
+
+    def test_constant_disabled_and_insertion_order(self):
+        rows = [
+            _entry("B", ["dragon"], insertion_order=2),
+            _entry("A", [], constant=True, insertion_order=1),
+            _entry("C", ["dragon"], enabled=False),
+        ]
+        self.assertEqual(self._activate(rows, ["a Dragon appears"]), ["A", "B"])
+        self.assertEqual(self._activate(rows, ["nothing"]), ["A"])
+
+    def test_selective_logic(self):
+        def row(logic):
+            return _entry(str(logic), ["castle"], selective=True, secondary_keys=["king", "queen"],
+                          extensions={"selectiveLogic": logic})
+
+        rows = [row(logic) for logic in (AND_ANY, NOT_ALL, NOT_ANY, AND_ALL)]
+        self.assertEqual(self._activate(rows, ["the castle"]), [str(NOT_ALL), str(NOT_ANY)])
+        self.assertEqual(self._activate(rows, ["the castle king"]), [str(AND_ANY), str(NOT_ALL)])
+        self.assertEqual(self._activate(rows, ["the castle king and queen"]), [str(AND_ANY), str(AND_ALL)])
+
+    def test_case_sensitive_and_regex_keys(self):
+        rows = [
+            _entry("sensitive", ["Apple"], case_sensitive=True),
+            _entry("regex", [r"/ba(na)+/i"]),
+        ]
+        self.assertEqual(self._activate(rows, ["apple BANANA"]), ["regex"])
+        self.assertEqual(self._activate(rows, ["Apple"]), ["sensitive"])
+
+    def test_recursive_scanning(self):
+        rows = [_entry("mentions sword", ["hero"]), _entry("sword lore", ["sword"])]
+        self.assertEqual(self._activate(rows, ["the hero"]), ["mentions sword"])
+        self.assertEqual(self._activate(rows, ["the hero"], recursive_scanning=True),
+                         ["mentions sword", "sword lore"])
+
+    def test_token_budget_drops_low_priority_first(self):
+        rows = [
+            _entry("低" * 10, ["x"], priority=1, insertion_order=1),
+            _entry("高" * 10, ["x"], priority=9, insertion_order=2),
+        ]
+        self.assertEqual(self._activate(rows, ["x"], token_budget=15), ["高" * 10])
+
+
+class GetLorebookTests(SimpleTestCase):
+    def setUp(self):
+        lorebook_module._cache.clear()
+        self.addCleanup(lorebook_module._cache.clear)
+
+    def test_recompiles_only_when_card_changes(self):
+        book = {"entries": [_entry("A", ["a"])]}
+        first = get_lorebook(1, "v1", book)
+        self.assertIs(get_lorebook(1, "v1", book), first)
+        self.assertIsNot(get_lorebook(1, "v2", book), first)
@@ -0,0 +1,153 @@
+"""
+内容审核队列：延迟重试、重试用完后的回调、角色卡审核状态
+check_nsfw_batch 用桩函数代替，不调用 Gemini；RedisStreamBackend 的用例需要 Redis，连不上时跳过
+"""
+
+import io
+import json
+import time
+import uuid
+from unittest import SkipTest, mock
+
+from django.core.management import call_command
+from django.test import SimpleTestCase, TestCase
+
+from chatApp.api.anchor import card as card_module
+from chatApp.api.common import moderation
+from chatApp.api.common.connections import get_redis
+from chatApp.models import CharacterCard
+
+ERROR = {"is_nsfw": True, "score": 1.0, "reason": "调用异常", "source": "llm", "error": True}
+SAFE = {"is_nsfw": False, "score": 0.0, "reason": "ok", "source": "llm"}
+
+
+class _WorkerTestMixin:
+    def setUp(self):
+        super().setUp()
+        self.handled = []
+        moderation.register_moderation_handler("test", lambda target, result: self.handled.append((target, result)))
+        self.addCleanup(moderation._handlers.pop, "test", None)
+        self.verdicts = []
+        patcher = mock.patch.object(moderation, "check_nsfw_batch", side_effect=self._check)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _check(self, texts):
+        return [dict(self.verdicts.pop(0)) for _ in texts]
+
+    def _drain(self, worker, timeout=2):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline and not self.handled:
+            worker.run_once()
+
+
+class LocalBackendRetryTests(_WorkerTestMixin, SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        self.backend = moderation.LocalBackend()
+        self.backend._started = True  # 不启动后台线程，由测试调用 run_once
+        self.worker = moderation.ModerationWorker(self.backend, "test", block=0.01)
+
+    def test_retry_is_delayed_and_backs_off(self):
+        self.assertEqual(moderation.retry_delay(1), moderation.MODERATION_RETRY_DELAY)
+        self.assertEqual(moderation.retry_delay(2), moderation.MODERATION_RETRY_DELAY * 2)
+
+        self.verdicts = [ERROR]
+        self.backend.submit({"kind": "test", "target": "1", "text": "t", "attempts": "1"})
+        self.worker.run_once()
+        # 失败的任务进入延迟队列，不会被马上再次读到
+        self.assertEqual(self.backend.stats()["delayed"], 1)
+        self.assertEqual(self.worker.run_once(), 0)
+        self.assertEqual(self.handled, [])
+
+    def test_transient_error_recovers_after_delay(self):
+        self.verdicts = [ERROR, SAFE]
+        with mock.patch.object(moderation, "MODERATION_RETRY_DELAY", 0.05):
+            self.backend.submit({"kind": "test", "target": "1", "text": "t", "attempts": "1"})
+            self.worker.run_once()
+            self._drain(self.worker)
+        self.assertEqual(self.handled, [("1", SAFE)])
+
+    def test_exhausted_retries_pass_the_error_to_the_handler(self):
+        self.verdicts = [ERROR] * moderation.MODERATION_MAX_ATTEMPTS
+        with mock.patch.object(moderation, "MODERATION_RETRY_DELAY", 0.01):
+            self.backend.submit({"kind": "test", "target": "1", "text": "t", "attempts": "1"})
+            self._drain(self.worker)
+        self.assertEqual(len(self.handled), 1)
+        self.assertTrue(self.handled[0][1]["error"])
+        self.assertEqual(self.verdicts, [])
+
+
+class RedisBackendRetryTests(_WorkerTestMixin, SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        try:
+            get_redis().ping()
+        except Exception as e:
+            raise SkipTest(f"Redis 不可用: {type(e).__name__}")
+        super().setUpClass()
+
+    def setUp(self):
+        super().setUp()
+        prefix = f"test:moderation:{uuid.uuid4().hex[:12]}"
+        self.backend = moderation.RedisStreamBackend(stream=f"{prefix}:jobs", group="test", delayed=f"{prefix}:delayed")
+        self.addCleanup(get_redis().delete, self.backend.stream, self.backend.delayed)
+        self.worker = moderation.ModerationWorker(self.backend, "test", block=0.01)
+
+    def test_delayed_job_is_promoted_once_when_due(self):
+        job = {"kind": "test", "target": "1", "text": "t", "attempts": "2"}
+        self.backend.submit(job, delay=0.05)
+        self.backend.submit(job, delay=0.05)  # 相同任务不会在延迟集合中合并
+        self.assertEqual(self.backend.stats()["delayed"], 2)
+        self.assertEqual(self.backend.read("test", 10, 0.01), [])
+        time.sleep(0.06)
+        messages = self.backend.read("test", 10, 0.01)
+        self.assertEqual([fields for _, fields in messages], [job, job])
+        self.assertEqual(self.backend.stats()["delayed"], 0)
+
+    def test_transient_error_recovers_after_delay(self):
+        self.verdicts = [ERROR, SAFE]
+        with mock.patch.object(moderation, "MODERATION_RETRY_DELAY", 0.05):
+            self.backend.submit({"kind": "test", "target": "1", "text": "t", "attempts": "1"})
+            self._drain(self.worker)
+        self.assertEqual(self.handled, [("1", SAFE)])
+        self.assertEqual(self.backend.stats()["length"], 0)
+
+
+class CardReviewTests(TestCase):
+    def _card(self, **data):
+        return CharacterCard.objects.create(
+            uid="1", username="u", character_name="c", image_name=uuid.uuid4().hex,
+            character_data=json.dumps({"data": data}), create_date="", review_status="pending",
+        )
+
+    def test_verdicts(self):
+        approved, rejected, undecided = self._card(), self._card(), self._card()
+        card_module.on_card_reviewed(approved.id, SAFE)
+        card_module.on_card_reviewed(rejected.id, {"is_nsfw": True, "reason": "nsfw"})
+        card_module.on_card_reviewed(undecided.id, {"is_nsfw": None, "reason": "无法解析"})
+        self.assertEqual(CharacterCard.objects.get(id=approved.id).review_status, "approved")
+        self.assertEqual(CharacterCard.objects.get(id=rejected.id).review_status, "rejected")
+        self.assertEqual(CharacterCard.objects.get(id=undecided.id).review_status, "rejected")
+
+    def test_model_error_keeps_card_pending(self):
+        card = self._card(name="n")
+        card_module.on_card_reviewed(card.id, ERROR)
+        card.refresh_from_db()
+        self.assertEqual(card.review_status, "pending")
+        self.assertIn("待重新审核", card.review_reason)
+
+    def test_card_without_review_text_is_approved_without_queueing(self):
+        card = self._card(name="", description="")
+        with mock.patch.object(card_module, "submit_moderation") as submit:
+            self.assertTrue(card_module.submit_card_review(card.id, card_module.card_review_text({"data": {}})))
+        submit.assert_not_called()
+        card.refresh_from_db()
+        self.assertEqual(card.review_status, "approved")
+
+    def test_resubmit_command_only_queues_pending_cards(self):
+        pending = self._card(name="n")
+        CharacterCard.objects.filter(id=self._card(name="m").id).update(review_status="approved")
+        with mock.patch.object(card_module, "submit_moderation") as submit:
+            call_command("resubmit_card_reviews", stdout=io.StringIO())
+        submit.assert_called_once_with("character_card", pending.id, "n")
@@ -0,0 +1,49 @@
+"""
+preset_save：内容与版本号同时写入，编译缓存与数据库里的预设一致
+"""
+
+import contextlib
+import hashlib
+import io
+
+from django.test import TestCase
+from rest_framework.test import APIRequestFactory
+
+from chatApp.api.fork import prompt_template
+from chatApp.api.preset import preset_save
+from chatApp.models import Preset
+
+
+class PresetSaveTests(TestCase):
+    body = {"uid": "1", "character_name": "c", "character_date": "d"}
+    room_id = hashlib.sha1("1_c_d".encode("utf-8")).hexdigest()[:16]
+
+    def _save(self, content):
+        oai_settings = {
+            "preset_settings_openai": "p", "temp_openai": 1.0, "top_p_openai": 0.9, "top_k_openai": 40,
+            "openai_max_context": 8000, "openai_max_tokens": 500, "google_model": "m", "n": 1,
+            "prompts": [{"identifier": "main", "name": "Main", "role": "system", "content": content},
+                        {"identifier": "chatHistory", "name": "Chat History", "marker": True}],
+            "prompt_order": [{"order": [{"identifier": "main", "enabled": True},
+                                        {"identifier": "chatHistory", "enabled": True}]}],
+        }
+        request = APIRequestFactory().post("/api/preset/preset_save/", {**self.body, "oai_settings": oai_settings},
+                                           format="json")
+        with contextlib.redirect_stdout(io.StringIO()):
+            return preset_save.preset_save(request)
+
+    def _compiled_text(self, version):
+        compiled = prompt_template.get_compiled_preset(self.room_id, version, lambda: self.fail("未预热编译缓存"))
+        contents, history_positions = compiled.render({})
+        self.assertEqual(history_positions, [1])
+        return contents[0]["parts"][0]["text"]
+
+    def test_each_save_bumps_version_with_its_content(self):
+        self.assertEqual(self._save("第一版").data["code"], 0)
+        self.assertEqual(self._save("第二版").data["code"], 0)
+
+        preset = Preset.objects.get(room_id=self.room_id)
+        self.assertEqual(preset.version, 2)
+        self.assertIn("第二版", preset.preset_json)
+        self.assertEqual(self._compiled_text(1), "第一版")
+        self.assertEqual(self._compiled_text(2), "第二版")
@@ -0,0 +1,131 @@
+"""
+预设模板预编译：渲染结果与原来的链式 str.replace + 逐条合并完全一致，并输出两者的拼接耗时
+"""
+
+import time
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from chatApp.api.fork import prompt_template
+from chatApp.api.fork.api_model.kemini import current_mes_model, first_mes_model
+from chatApp.api.fork.fork_chat import (CURRENT_MES_TEMPLATE, CURRENT_MES_TEMPLATE_SLOTS, FIRST_MES_TEMPLATE,
+                                        FIRST_MES_TEMPLATE_SLOTS)
+from chatApp.api.fork.prompt_template import CompiledPreset, PromptTemplate, expand_values, merge_contents
+
+RENDERS = 2000
+
+# 值里出现后面的占位符时，链式 replace 会继续替换
+VALUES = {
+    "character_description": "{{user}} 的青梅竹马，性格温柔。" * 20,
+    "entrie": "世界书：{{lastUserMessage}} 相关设定。" * 10,
+    "user": "小明",
+    "lastUserMessage": "今天去哪里玩？",
+}
+
+PRESET = [
+    {"identifier": f"block{i}", "role": ("system", "user", "assistant", "tool")[i % 4],
+     "content": f"第{i}段 {{{{user}}}} {{{{character_description}}}} {{{{entrie}}}} {{{{lastUserMessage}}}} {{{{unknown}}}}"}
+    for i in range(30)
+]
+PRESET.insert(15, {"identifier": "chatHistory", "role": "user", "content": ""})
+
+
+def _legacy_render(preset, values):
+    """原来 fork_chat 中的写法"""
+    contents, history_positions = [], []
+    for data in preset:
+        content = data.get("content", "")
+        content = content.replace('{{character_description}}', values["character_description"])\
+            .replace('{{entrie}}', values["entrie"]).replace('{{user}}', values["user"])\
+            .replace('{{lastUserMessage}}', values["lastUserMessage"])
+        if data.get("identifier", "") != "chatHistory":
+            contents.append({"role": data.get("role", "user"), "parts": [{"text": content}]})
+        else:
+            history_positions.append(len(contents))
+    return contents, history_positions
+
+
+def _legacy_merge(contents):
+    contents_final = []
+    for row in contents:
+        role = row.get("role")
+        if role in ('system', 'tool'):
+            role = "user"
+        elif role == "assistant":
+            role = "model"
+        if role:
+            if len(contents_final) > 0 and role == contents_final[-1].get("role"):
+                existing_content = contents_final[-1].get("parts")[0].get("text")
+                contents_final[-1]["parts"] = [{"text": existing_content + "\n\n" + row.get("parts")[0].get("text")}]
+            else:
+                contents_final.append({"role": role, "parts": [{"text": row.get("parts")[0].get("text")}]})
+    return contents_final
+
+
+class PromptTemplateTests(SimpleTestCase):
+    def test_compiled_preset_matches_chained_replace(self):
+        compiled = CompiledPreset(PRESET)
+        self.assertEqual(compiled.render(VALUES), _legacy_render(PRESET, VALUES))
+
+        started = time.perf_counter()
+        for _ in range(RENDERS):
+            _legacy_merge(_legacy_render(PRESET, VALUES)[0])
+        legacy_ms = (time.perf_counter() - started) * 1000
+        started = time.perf_counter()
+        for _ in range(RENDERS):
+            merge_contents(compiled.render(VALUES)[0])
+        compiled_ms = (time.perf_counter() - started) * 1000
+        print(f"\n[bench] 预设 {len(PRESET)} 段拼接: 预编译 {compiled_ms / RENDERS * 1000:.1f} µs/次，"
+              f"链式 replace {legacy_ms / RENDERS * 1000:.1f} µs/次")
+
+    def test_default_templates_match_chained_replace(self):
+        values = {**VALUES, "message": "{{user}} 说你好"}
+        self.assertEqual(
+            FIRST_MES_TEMPLATE.render(expand_values(FIRST_MES_TEMPLATE_SLOTS, values)),
+            first_mes_model.replace('{{character_description}}', values["character_description"])
+            .replace('{{entrie}}', values["entrie"]).replace('{{user}}', values["user"]),
+        )
+        self.assertEqual(
+            CURRENT_MES_TEMPLATE.render(expand_values(CURRENT_MES_TEMPLATE_SLOTS, values)),
+            current_mes_model.replace('{{user}}', values["user"]).replace('{{message}}', values["message"]),
+        )
+
+    def test_template_without_placeholders(self):
+        template = PromptTemplate("plain {{other}}", ("user",))
+        self.assertEqual(template.render(["x"]), "plain {{other}}")
+
+    def test_merge_contents_matches_legacy(self):
+        contents = [
+            {"role": "system", "parts": [{"text": "a"}]},
+            {"role": "user", "parts": [{"text": "b"}]},
+            {"role": None, "parts": [{"text": "skipped"}]},
+            {"role": "assistant", "parts": [{"text": "c"}]},
+            {"role": "model", "parts": [{"text": "d"}]},
+            {"role": "tool", "parts": [{"text": "e"}]},
+        ]
+        self.assertEqual(merge_contents(contents), _legacy_merge(contents))
+
+
+class CompiledPresetCacheTests(SimpleTestCase):
+    def setUp(self):
+        prompt_template._cache.clear()
+        self.addCleanup(prompt_template._cache.clear)
+
+    def test_cached_by_room_and_version(self):
+        loads = []
+
+        def load():
+            loads.append(1)
+            return PRESET
+
+        first = prompt_template.get_compiled_preset("room", 1, load)
+        self.assertIs(prompt_template.get_compiled_preset("room", 1, load), first)
+        self.assertIsNot(prompt_template.get_compiled_preset("room", 2, load), first)
+        self.assertEqual(len(loads), 2)
+
+    def test_least_recently_used_entries_are_evicted(self):
+        with mock.patch.object(prompt_template, "PRESET_TEMPLATE_CACHE_SIZE", 2):
+            for room_id in ("a", "b", "c"):
+                prompt_template.compile_preset(room_id, 1, PRESET)
+        self.assertEqual(list(prompt_template._cache), [("b", 1), ("c", 1)])
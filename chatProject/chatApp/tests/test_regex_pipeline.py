@@ -0,0 +1,137 @@
+"""
+正则脚本管道：预编译管道的结果与原来逐条 run_regex_script 的结果一致、管道缓存，并输出正则包格式化耗时
+"""
+
+import contextlib
+import io
+import random
+import time
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from chatApp.api.fork import fork_format
+from chatApp.api.fork.fork_format import MessageFormatter
+
+MESSAGES = 300
+
+# 常见的角色卡正则包：隐藏状态栏、改写格式、带分组/修剪/深度/编辑条件，以及无效、禁用的脚本
+REGEX_PACK = [
+    {"scriptName": "hide-status", "findRegex": r"/<status>[\s\S]*?<\/status>/g", "replaceString": "",
+     "placement": [2], "markdownOnly": True},
+    {"scriptName": "italic", "findRegex": r"/\*(.+?)\*/g", "replaceString": "<i>$1</i>", "placement": [1, 2],
+     "markdownOnly": True},
+    {"scriptName": "thought", "findRegex": r"/<think>([\s\S]*?)<\/think>/gi", "replaceString": "<details>$1</details>",
+     "trimStrings": ["嗯", "..."], "placement": [2], "markdownOnly": True, "runOnEdit": True},
+    {"scriptName": "match-macro", "findRegex": "/HP:(\\d+)/g", "replaceString": "[{{match}}|$1|$3]",
+     "placement": [2], "promptOnly": True},
+    {"scriptName": "optional-group", "findRegex": "/(a)?(b)/g", "replaceString": "<$1-$2>", "placement": [2],
+     "markdownOnly": True, "minDepth": 1},
+    {"scriptName": "shallow-only", "findRegex": "/旁白/g", "replaceString": "【旁白】", "placement": [2],
+     "markdownOnly": True, "maxDepth": 0},
+    {"scriptName": "general", "findRegex": "/foo/", "replaceString": "bar", "placement": [2]},
+    {"scriptName": "raw-substitute", "findRegex": "/(MP):(\\d+)/g", "replaceString": "$2$1", "placement": [2],
+     "markdownOnly": True, "substituteRegex": 1},
+    {"scriptName": "escaped-substitute", "findRegex": "/S\\.P\\./g", "replaceString": "SP", "placement": [2],
+     "promptOnly": True, "substituteRegex": 2},
+    {"scriptName": "disabled", "findRegex": "/.*/g", "replaceString": "", "placement": [2], "disabled": True,
+     "markdownOnly": True},
+    {"scriptName": "invalid", "findRegex": "/(unclosed/g", "replaceString": "", "placement": [2], "markdownOnly": True},
+    {"scriptName": "user-input", "findRegex": "/^/g", "replaceString": "> ", "placement": [1], "markdownOnly": True},
+]
+REGEX_PACK += [
+    {"scriptName": f"word-{i}", "findRegex": f"/词{i}/g", "replaceString": f"<span>词{i}</span>",
+     "placement": [2], "markdownOnly": True}
+    for i in range(30)
+]
+
+FRAGMENTS = ["*低声说*", "<status>HP:10 MP:3</status>", "<think>嗯...我在想</think>", "HP:42", "ab b", "旁白",
+             "foo foo", "S.P. 值", "普通的一句话。", "MP:7", "词3 词17 词29", "\n\n", "\"引号\""]
+
+
+def _legacy_get_regexed_string(formatter, raw_string, placement, is_markdown=False, is_prompt=False,
+                               is_edit=False, depth=None, character_regex_scripts=None):
+    """改为预编译管道之前的 get_regexed_string（去掉日志）"""
+    final_string = raw_string
+    for script in formatter.regex_scripts + (character_regex_scripts or []):
+        if script.get('disabled'):
+            continue
+        markdown_condition = (script.get('markdownOnly') and is_markdown)
+        prompt_condition = (script.get('promptOnly') and is_prompt)
+        general_condition = (not script.get('markdownOnly') and not script.get('promptOnly')
+                             and not is_markdown and not is_prompt)
+        if not (markdown_condition or prompt_condition or general_condition):
+            continue
+        if is_edit and not script.get('runOnEdit', False):
+            continue
+        if depth is not None:
+            if script.get('minDepth') is not None and depth < script['minDepth']:
+                continue
+            if script.get('maxDepth') is not None and depth > script['maxDepth']:
+                continue
+        if placement in script.get('placement', []):
+            final_string = formatter.run_regex_script(script, final_string, {'characterOverride': None})
+    return final_string
+
+
+class RegexPipelineTests(SimpleTestCase):
+    def setUp(self):
+        self.formatter = MessageFormatter()
+        rng = random.Random(21)
+        self.messages = ["".join(rng.choice(FRAGMENTS) for _ in range(rng.randrange(1, 12))) for _ in range(MESSAGES)]
+
+    def test_pipeline_matches_per_script_execution(self):
+        options = [
+            {"placement": placement, "is_markdown": is_markdown, "is_prompt": is_prompt, "is_edit": is_edit,
+             "depth": depth}
+            for placement in (1, 2)
+            for is_markdown, is_prompt in ((True, True), (True, False), (False, True), (False, False))
+            for is_edit in (False, True)
+            for depth in (None, 0, 3)
+        ]
+        with contextlib.redirect_stdout(io.StringIO()):
+            for kwargs in options:
+                for text in self.messages[:20]:
+                    self.assertEqual(
+                        self.formatter.get_regexed_string(text, character_regex_scripts=REGEX_PACK, **kwargs),
+                        _legacy_get_regexed_string(self.formatter, text, character_regex_scripts=REGEX_PACK, **kwargs),
+                        msg=f"{kwargs} {text!r}",
+                    )
+
+    def test_regex_pack_formatting_time(self):
+        kwargs = {"placement": 2, "is_markdown": True, "is_prompt": True, "depth": 0}
+        with contextlib.redirect_stdout(io.StringIO()):
+            started = time.perf_counter()
+            legacy = [_legacy_get_regexed_string(self.formatter, text, character_regex_scripts=REGEX_PACK, **kwargs)
+                      for text in self.messages]
+            legacy_ms = (time.perf_counter() - started) * 1000
+            started = time.perf_counter()
+            compiled = [self.formatter.get_regexed_string(text, character_regex_scripts=REGEX_PACK, **kwargs)
+                        for text in self.messages]
+            compiled_ms = (time.perf_counter() - started) * 1000
+        print(f"\n[bench] {len(REGEX_PACK)} 个脚本的正则包格式化 {MESSAGES} 条消息: 预编译管道 {compiled_ms:.1f} ms，"
+              f"逐条解析编译 {legacy_ms:.1f} ms")
+        self.assertEqual(compiled, legacy)
+
+    def test_pipeline_is_cached_per_script_content(self):
+        first = self.formatter.get_pipeline(2, True, True, REGEX_PACK)
+        self.assertIs(self.formatter.get_pipeline(2, True, True, [dict(script) for script in REGEX_PACK]), first)
+        self.assertIsNot(self.formatter.get_pipeline(2, True, False, REGEX_PACK), first)
+        changed = REGEX_PACK[:-1] + [{**REGEX_PACK[-1], "replaceString": "x"}]
+        self.assertIsNot(self.formatter.get_pipeline(2, True, True, changed), first)
+        # 无效、禁用的脚本不进入管道
+        names = {script.name for script in first}
+        self.assertNotIn("invalid", names)
+        self.assertNotIn("disabled", names)
+
+    def test_same_script_list_is_not_serialized_again(self):
+        first = self.formatter.get_pipeline(2, True, True, REGEX_PACK)
+        with mock.patch.object(fork_format.json, "dumps", side_effect=AssertionError("re-serialized")):
+            for _ in range(3):
+                self.assertIs(self.formatter.get_pipeline(2, True, True, REGEX_PACK), first)
+
+    def test_pipeline_cache_is_bounded(self):
+        with mock.patch.object(fork_format, "PIPELINE_CACHE_SIZE", 2):
+            for placement in (1, 2, 3):
+                self.formatter.get_pipeline(placement, True, True, REGEX_PACK)
+        self.assertEqual(len(self.formatter._pipelines), 2)
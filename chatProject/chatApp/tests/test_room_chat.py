@@ -0,0 +1,95 @@
+"""
+get_room_chat：不传 limit 时返回全部楼层（多于一批时流式输出），传 limit 时分页并返回 next_floor
+MongoDB 游标用内存列表代替
+"""
+
+import contextlib
+import io
+import json
+from unittest import mock
+
+from asgiref.sync import sync_to_async
+from django.http import StreamingHttpResponse
+from django.test import SimpleTestCase
+from rest_framework.test import APIRequestFactory
+
+from chatApp.api.client import chat
+
+
+class _ListCursor:
+    def __init__(self, docs):
+        self._docs = iter(docs)
+        self.closed = False
+
+    def batch_size(self, size):
+        return self
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._docs)
+
+    def close(self):
+        self.closed = True
+
+
+class GetRoomChatTests(SimpleTestCase):
+    def setUp(self):
+        self.docs = [
+            {"floor": floor, "data_type": "ai" if floor % 2 else "user", "mes_html": f"<p>{floor}</p>",
+             "send_date_iso": "2025-01-01T00:00:00Z", "data": {"name": "n", "is_user": not floor % 2, "mes": f"第{floor}楼"}}
+            for floor in range(1, 1201)
+        ]
+        self.cursors = []
+        patcher = mock.patch.object(chat, "find_messages", side_effect=self._find_messages)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.factory = APIRequestFactory()
+
+    def _find_messages(self, room_id, query=None, projection=None, sort=None, limit=0):
+        last_floor = query["floor"]["$gt"]
+        docs = [doc for doc in self.docs if doc["floor"] > last_floor]
+        cursor = _ListCursor(docs[:limit] if limit else docs)
+        self.cursors.append(cursor)
+        return cursor
+
+    def _get(self, **params):
+        return chat.get_room_chat(self.factory.get("/api/chat/get_room_chat", {"room_id": "r", **params}))
+
+    async def _read_stream(self, response):
+        return "".join([chunk.decode() if isinstance(chunk, bytes) else chunk
+                        async for chunk in response.streaming_content])
+
+    def test_small_backlog_without_limit_is_a_plain_response(self):
+        response = self._get(last_floor=1100)
+        self.assertNotIsInstance(response, StreamingHttpResponse)
+        self.assertEqual([r["floor"] for r in response.data["data"]], list(range(1101, 1201)))
+        self.assertIsNone(response.data["next_floor"])
+        self.assertTrue(self.cursors[0].closed)
+
+    async def test_full_history_without_limit_is_streamed(self):
+        response = await sync_to_async(self._get)()
+        self.assertIsInstance(response, StreamingHttpResponse)
+        body = json.loads(await self._read_stream(response))
+        self.assertEqual(body["code"], 0)
+        self.assertIsNone(body["next_floor"])
+        self.assertEqual([r["floor"] for r in body["data"]], list(range(1, 1201)))
+        self.assertEqual(body["data"][0], chat._format_chat_record(self.docs[0]))
+        self.assertTrue(self.cursors[0].closed)
+
+    def test_limit_pages_with_next_floor(self):
+        floors = []
+        last_floor = 0
+        while last_floor is not None:
+            response = self._get(last_floor=last_floor, limit=10000)
+            floors.extend(r["floor"] for r in response.data["data"])
+            last_floor = response.data["next_floor"]
+            self.assertLessEqual(len(response.data["data"]), chat.MAX_LIMIT)
+        self.assertEqual(floors, list(range(1, 1201)))
+
+    def test_mongo_error_before_streaming_returns_500(self):
+        with mock.patch.object(chat, "find_messages", side_effect=RuntimeError("down")), \
+                contextlib.redirect_stdout(io.StringIO()):
+            response = self._get()
+        self.assertEqual(response.status_code, 500)
@@ -0,0 +1,36 @@
+"""
+消息发送时间：写入时生成的 send_date_iso 是合法的 ISO 8601，send_ts 由它解析得到
+"""
+
+from datetime import datetime, timezone
+
+from django.test import SimpleTestCase
+
+from chatApp.api.common.common import normalize_send_date, parse_send_date, parse_send_date_iso
+from chatApp.api.common.messages import send_timestamp
+
+
+class SendDateTests(SimpleTestCase):
+    def test_normalized_date_round_trips(self):
+        iso = normalize_send_date("2025-09-12 22:30:00+08:00")
+        self.assertEqual(iso, "2025-09-12T14:30:00Z")
+        self.assertEqual(parse_send_date_iso(iso), datetime(2025, 9, 12, 14, 30, tzinfo=timezone.utc))
+
+    def test_legacy_and_invalid_values(self):
+        expected = datetime(2025, 9, 12, 14, 30, tzinfo=timezone.utc)
+        self.assertEqual(parse_send_date_iso("2025-09-12T14:30:00+00:00Z"), expected)
+        self.assertEqual(parse_send_date_iso("2025-09-12T14:30:00+00:00"), expected)
+        self.assertIsNone(parse_send_date_iso("September 12, 2025 10:30pm"))
+        self.assertIsNone(parse_send_date_iso(None))
+        self.assertIsNone(normalize_send_date("not a date"))
+
+    def test_send_timestamp_prefers_send_date_iso(self):
+        doc = {"send_date_iso": "2025-09-12T14:30:00Z", "data": {"send_date": "garbage"}}
+        self.assertEqual(send_timestamp(doc), datetime(2025, 9, 12, 14, 30, tzinfo=timezone.utc).timestamp())
+
+        # 旧数据没有 send_date_iso：按原始 send_date 解析，两条路径得到同一时刻
+        send_date = "September 12, 2025 10:30pm"
+        legacy = send_timestamp({"data": {"send_date": send_date}})
+        self.assertEqual(legacy, parse_send_date(send_date).timestamp())
+        self.assertEqual(send_timestamp({"send_date_iso": normalize_send_date(send_date), "data": {}}), legacy)
+        self.assertIsNone(send_timestamp({"data": {}}))
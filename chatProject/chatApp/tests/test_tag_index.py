@@ -0,0 +1,96 @@
+"""
+房间标签倒排索引：单标签/多标签搜索结果正确、分页前完成过滤，并输出搜索首页耗时
+"""
+
+import contextlib
+import io
+import time
+from urllib.parse import parse_qs, urlparse
+
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIRequestFactory
+
+from chatApp.api.client import lives
+from chatApp.models import CharacterCard, RoomImageBinding, RoomInfo, RoomTagIndex
+
+ROOMS = 2000
+
+# (tags, language, review_status, image_name)
+CARDS = [
+    ("萝莉,Fantasy", "cn", "approved", "a.png"),
+    ("Dark Fantasy,Romance", "en", "approved", "b.png"),
+    ("Romance", "cn", "approved", "c.png"),
+    ("Fantasy", "cn", "pending", "d.png"),  # 审核中，不收录
+    ("Fantasy", "cn", "approved", ""),  # 没有图片，不收录
+]
+
+
+class TagSearchTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        # bulk_create 不触发 post_save（信息流卡片刷新需要 MongoDB），索引由重建命令生成
+        cards = CharacterCard.objects.bulk_create([
+            CharacterCard(uid="1", username="u", character_name="c", image_name=image_name, image_path="p",
+                          character_data="{}", create_date="", review_status=status, tags=tags, language=language)
+            for tags, language, status, image_name in CARDS
+        ])
+        RoomInfo.objects.bulk_create([
+            RoomInfo(uid="1", room_id=f"room_{i}", room_name="n", character_name="c", title="t", coin_num=0,
+                     is_show=0, file_branch="main", last_ai_reply_timestamp=float(i))
+            for i in range(ROOMS)
+        ])
+        RoomImageBinding.objects.bulk_create([
+            RoomImageBinding(uid="1", room_id=f"room_{i}", image_id=cards[i % len(cards)].id) for i in range(ROOMS)
+        ])
+        call_command("rebuild_room_tag_index", batch_size=500, stdout=io.StringIO())
+
+    def _get(self, params):
+        # Redis 不可用时 cached_call 会打印降级日志
+        with contextlib.redirect_stdout(io.StringIO()):
+            return lives.get_all_lives(APIRequestFactory().get("/api/live/get_all_lives", params))
+
+    def _search(self, tags):
+        """按 next 链接翻完所有页，返回房间序号集合"""
+        found = []
+        params = {"tags": tags, "page_size": 100}
+        while True:
+            response = self._get(params)
+            data = response.data["data"]
+            found.extend(int(r["room_id"].split("_")[1]) for r in data["results"])
+            if not data["next"]:
+                break
+            params["cursor"] = parse_qs(urlparse(data["next"]).query)["cursor"][0]
+        self.assertEqual(len(found), len(set(found)))
+        return set(found)
+
+    def _expected(self, *card_indexes):
+        return {i for i in range(ROOMS) if i % len(CARDS) in card_indexes}
+
+    def test_index_skips_rooms_the_list_would_hide(self):
+        indexed = set(RoomTagIndex.objects.values_list("room_id", flat=True).distinct())
+        self.assertEqual(indexed, {f"room_{i}" for i in self._expected(0, 1, 2)})
+
+    def test_single_tag(self):
+        # 子串匹配：fantasy 同时命中 "Dark Fantasy"
+        self.assertEqual(self._search("fantasy"), self._expected(0, 1))
+        self.assertEqual(self._search("萝莉"), self._expected(0))
+        self.assertEqual(self._search("cn"), self._expected(0, 2))
+        self.assertEqual(self._search("nosuchtag"), set())
+
+    def test_multiple_tags_intersect(self):
+        self.assertEqual(self._search("fantasy,cn"), self._expected(0))
+        self.assertEqual(self._search("romance, EN"), self._expected(1))
+        self.assertEqual(self._search("萝莉,romance"), set())
+
+    def test_first_page_is_full_and_timed(self):
+        for tags in ("fantasy", "fantasy,romance,en"):
+            with CaptureQueriesContext(connection) as queries:
+                started = time.perf_counter()
+                response = self._get({"tags": tags})
+                elapsed = time.perf_counter() - started
+            print(f"\n[bench] 标签搜索 {tags!r}（{ROOMS} 个房间）首页: {elapsed * 1000:.1f} ms, {len(queries)} 条 SQL")
+            # 过滤在分页前完成，首页不会因为不匹配的房间变短
+            self.assertEqual(len(response.data["data"]["results"]), lives.IDCursorPagination.page_size)
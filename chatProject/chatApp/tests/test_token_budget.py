@@ -0,0 +1,109 @@
+"""
+按 token 预算取聊天历史：估算规则、从最新一条往前取到预算用完、旧消息的 token_count 回写
+MongoDB 集合用内存列表代替
+"""
+
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from chatApp.api.common import messages
+from chatApp.api.common.tokens import MESSAGE_OVERHEAD, TOKEN_ESTIMATOR_VERSION, estimate_tokens, message_tokens
+
+
+class _Cursor:
+    def __init__(self, docs):
+        self._docs = docs
+        self.closed = False
+
+    def sort(self, keys):
+        (field, direction), = keys
+        self._docs = sorted(self._docs, key=lambda doc: doc[field], reverse=direction < 0)
+        return self
+
+    def limit(self, n):
+        self._docs = self._docs[:n]
+        return self
+
+    def batch_size(self, size):
+        return self
+
+    def __iter__(self):
+        return iter(self._docs)
+
+    def close(self):
+        self.closed = True
+
+
+class _Collection:
+    def __init__(self, docs):
+        self.docs = docs
+        self.cursors = []
+        self.writes = []
+
+    def find(self, query, projection=None):
+        cursor = _Cursor(list(self.docs))
+        self.cursors.append(cursor)
+        return cursor
+
+    def bulk_write(self, requests, ordered=True):
+        self.writes.extend(requests)
+
+
+def _doc(floor, mes, cached=True):
+    doc = {"_id": floor, "floor": floor, "data": {"is_user": floor % 2 == 0, "mes": mes}}
+    if cached:
+        doc.update(token_count=message_tokens(mes), token_count_v=TOKEN_ESTIMATOR_VERSION)
+    return doc
+
+
+class EstimateTokensTests(SimpleTestCase):
+    def test_wide_and_narrow_characters(self):
+        self.assertEqual(estimate_tokens("你好世界"), 4)
+        self.assertEqual(estimate_tokens("abcdefgh"), 2)
+        self.assertEqual(estimate_tokens("abcde"), 2)
+        self.assertEqual(estimate_tokens("你好 abcd"), 4)
+        self.assertEqual(estimate_tokens(""), 0)
+        self.assertEqual(estimate_tokens(None), 0)
+        self.assertEqual(message_tokens("你好"), 2 + MESSAGE_OVERHEAD)
+
+
+class HistoryWithinBudgetTests(SimpleTestCase):
+    def _history(self, docs, budget, max_messages=200):
+        self.collection = _Collection(docs)
+        with mock.patch.object(messages, "_scope", return_value=(self.collection, {})):
+            return messages.history_within_budget("room", budget, max_messages)
+
+    def test_takes_newest_messages_until_budget_is_spent(self):
+        docs = [_doc(floor, "字" * 96) for floor in range(1, 301)]  # 每条 100 token
+        records, used = self._history(docs, budget=1050)
+        self.assertEqual([doc["floor"] for doc in records], list(range(291, 301)))
+        self.assertEqual(used, 1000)
+        self.assertTrue(self.collection.cursors[0].closed)
+        self.assertEqual(self.collection.writes, [])
+
+    def test_newest_message_is_kept_even_over_budget(self):
+        records, used = self._history([_doc(1, "短"), _doc(2, "长" * 1000)], budget=10)
+        self.assertEqual([doc["floor"] for doc in records], [2])
+        self.assertEqual(used, 1000 + MESSAGE_OVERHEAD)
+
+    def test_max_messages_caps_the_scan(self):
+        records, _ = self._history([_doc(floor, "a") for floor in range(1, 301)], budget=10 ** 6, max_messages=200)
+        self.assertEqual(len(records), 200)
+        self.assertEqual(records[0]["floor"], 101)
+
+    def test_cached_counts_are_trusted_and_legacy_counts_backfilled(self):
+        cached = _doc(2, "x")
+        cached["token_count"] = 500  # 与估算值不同：说明直接使用了缓存
+        legacy = _doc(1, "你好", cached=False)
+        stale = _doc(3, "y")
+        stale["token_count_v"] = TOKEN_ESTIMATOR_VERSION - 1
+
+        records, used = self._history([legacy, cached, stale], budget=10 ** 6)
+        self.assertEqual([doc["floor"] for doc in records], [1, 2, 3])
+        self.assertEqual(used, message_tokens("你好") + 500 + message_tokens("y"))
+        backfilled = {write._filter["_id"]: write._doc["$set"] for write in self.collection.writes}
+        self.assertEqual(backfilled, {
+            1: {"token_count": message_tokens("你好"), "token_count_v": TOKEN_ESTIMATOR_VERSION},
+            3: {"token_count": message_tokens("y"), "token_count_v": TOKEN_ESTIMATOR_VERSION},
+        })
@@ -18,17 +18,19 @@ import os
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'chatProject.settings')  # ⚠️ 必须最先设置
 
 from channels.routing import ProtocolTypeRouter, URLRouter
-from channels.auth import AuthMiddlewareStack
 from django.core.asgi import get_asgi_application
 from chatApp.routing import websocket_urlpatterns
 
 # Django HTTP ASGI 应用
 django_asgi_app = get_asgi_application()
 
+# 依赖 Django 模型，必须在 get_asgi_application() 之后导入
+from chatApp.middleware.jwt_auth import JwtAuthMiddleware
+
 # Channels 路由
 application = ProtocolTypeRouter({
     "http": django_asgi_app,
-    "websocket": AuthMiddlewareStack(
+    "websocket": JwtAuthMiddleware(
         URLRouter(websocket_urlpatterns)
     ),
 })
@@ -128,6 +128,14 @@ DATABASES = {
 REDIS_HOST = 'localhost'
 REDIS_PORT = 6379
 
+# Redis 连接池（每个进程、每个库一个连接池）
+REDIS_POOL_KWARGS = {
+    'max_connections': int(os.getenv('REDIS_MAX_CONNECTIONS', 100)),
+    'socket_timeout': 5,
+    'socket_connect_timeout': 3,
+    'health_check_interval': 30,
+}
+
 # django-redis 配置
 CACHES = {
     'default': {
@@ -135,6 +143,7 @@ CACHES = {
         'LOCATION': f'redis://{REDIS_HOST}:{REDIS_PORT}/0',  # Redis 连接字符串
         'OPTIONS': {
             'CLIENT_CLASS': 'django_redis.client.DefaultClient',
+            'CONNECTION_POOL_KWARGS': REDIS_POOL_KWARGS,
         },
     },
     # session 缓存配置
@@ -143,6 +152,7 @@ CACHES = {
         'LOCATION': f'redis://{REDIS_HOST}:{REDIS_PORT}/1',  # 使用相同的 Redis 实例
         'OPTIONS': {
             'CLIENT_CLASS': 'django_redis.client.DefaultClient',
+            'CONNECTION_POOL_KWARGS': REDIS_POOL_KWARGS,
         },
     },
     'subscribe': {
@@ -150,6 +160,7 @@ CACHES = {
         'LOCATION': f'redis://{REDIS_HOST}:{REDIS_PORT}/2',  # 使用相同的 Redis 实例
         'OPTIONS': {
             'CLIENT_CLASS': 'django_redis.client.DefaultClient',
+            'CONNECTION_POOL_KWARGS': REDIS_POOL_KWARGS,
         },
     },
     'chat-limit': {
@@ -157,6 +168,7 @@ CACHES = {
         'LOCATION': f'redis://{REDIS_HOST}:{REDIS_PORT}/3',  # 使用相同的 Redis 实例
         'OPTIONS': {
             'CLIENT_CLASS': 'django_redis.client.DefaultClient',
+            'CONNECTION_POOL_KWARGS': REDIS_POOL_KWARGS,
         },
     },
     'chat-online': {
@@ -164,6 +176,7 @@ CACHES = {
               'LOCATION': f'redis://{REDIS_HOST}:{REDIS_PORT}/4',  # 用4号DB专门存在线人数
               'OPTIONS': {
                   'CLIENT_CLASS': 'django_redis.client.DefaultClient',
+                  'CONNECTION_POOL_KWARGS': REDIS_POOL_KWARGS,
               },
           }
 
@@ -173,6 +186,43 @@ CACHES = {
 MONGO_URI = os.getenv("MONGO_URI")
 MONGO_DB_NAME = "chat_db"
 
+# 聊天记录存储模式：per_room 每个房间一个集合 / consolidated 统一存放在 messages 集合
+# 切换前先执行 python manage.py migrate_chat_messages
+CHAT_STORAGE_MODE = os.getenv("CHAT_STORAGE_MODE", "per_room")
+
+# MongoDB 连接池（chatApp/api/common/connections.py 每个进程一个 MongoClient）
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", 100))
+MONGO_MIN_POOL_SIZE = 0
+MONGO_MAX_IDLE_TIME_MS = 60000
+MONGO_CONNECT_TIMEOUT_MS = 5000
+MONGO_SOCKET_TIMEOUT_MS = 30000
+MONGO_SERVER_SELECTION_TIMEOUT_MS = 5000
+MONGO_WAIT_QUEUE_TIMEOUT_MS = 5000
+
+# 大模型网关（chatApp/api/common/llm_gateway.py）
+LLM_BASE_URL = os.getenv("LLM_BASE_URL", "https://api.evopower.net/v1")
+LLM_API_KEY = os.getenv("LLM_API_KEY", "sk-qaeqm7Tsdm3sWuxvWknKnbCEKHjPzxgnRhNAsxxBF8EUD7O9")
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", 32))  # 每个进程同时进行的请求数
+LLM_MAX_PER_USER = 2        # 单个用户同时进行的请求数
+LLM_MAX_QUEUE = 200         # 最多排队请求数
+LLM_QUEUE_TIMEOUT = 30      # 排队最长等待秒数
+LLM_CONNECT_TIMEOUT = 10
+LLM_REQUEST_TIMEOUT = 600   # 单次请求超时（max_tokens 很大时生成较慢）
+LLM_MAX_RETRIES = 2
+
+# NSFW 检测（chatApp/api/common/check_nsfw.py）
+NSFW_BLOCK_KEYWORDS = []    # 命中直接判定 NSFW
+NSFW_REVIEW_KEYWORDS = []   # 命中后交给 Gemini 判断；配置了词表时两类都未命中的文本直接放行
+NSFW_CACHE_TTL = 30 * 24 * 3600  # Gemini 判定结果缓存时间（秒）
+NSFW_LLM_CONCURRENCY = 4    # 每个进程同时进行的 Gemini 调用数
+
+# 内容审核队列（chatApp/api/common/moderation.py）
+# redis：Redis Streams，由 python manage.py moderation_worker 消费 / local：进程内后台线程（开发、测试）
+MODERATION_BACKEND = 'redis'
+MODERATION_MAX_ATTEMPTS = 3  # 模型调用异常、回调出错时的最多尝试次数
+MODERATION_CLAIM_IDLE = 300  # 未确认任务超过该秒数由其他 worker 认领
+MODERATION_RETRY_DELAY = 30  # 第一次重试的延迟秒数，之后每次翻倍（模型短时不可用时不会很快用完重试次数）
+
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
 
@@ -245,6 +295,20 @@ CHANNEL_LAYERS = {
     },
 }
 
+# 接口限流后端：redis（所有机器共享配额）/ local（本机所有 worker 共享配额，共享内存文件，固定内存）
+# Redis 不可用时也降级为 local
+RATE_LIMIT_BACKEND = 'redis'
+RATE_LIMIT_LOCAL_MAX_KEYS = 100000  # local 后端最多记录的 IP+接口 数量（文件大小 = 数量 * 32 字节）
+RATE_LIMIT_LOCAL_PATH = None  # local 后端的共享内存文件，默认 /dev/shm/ratelimit-<项目目录哈希>
+
+# IP 黑名单（chatApp.middleware.ip_blacklist）
+IP_BLACKLIST_REFRESH_INTERVAL = 300  # 兜底全量重新加载间隔（秒）
+IP_BLACKLIST_NETWORKS = []           # 额外封禁的网段，例如 ['10.0.0.0/8', '2001:db8::/32']
+
+# WebSocket JWT 认证用户快照缓存（chatApp.middleware.jwt_auth）
+WS_AUTH_USER_CACHE_SIZE = 10000  # 最多缓存的用户数
+WS_AUTH_USER_CACHE_TTL = 300     # 快照有效期（秒）；用户变更通过 Redis 广播失效，此值只是兜底
+
 # Google OAuth2 配置
 SOCIAL_AUTH_GOOGLE_OAUTH2_KEY = os.getenv("SOCIAL_AUTH_GOOGLE_OAUTH2_KEY")
 SOCIAL_AUTH_GOOGLE_OAUTH2_SECRET = os.getenv("SOCIAL_AUTH_GOOGLE_OAUTH2_SECRET")
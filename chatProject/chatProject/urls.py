@@ -24,6 +24,8 @@ from chatApp.api.payment import payment
 from chatApp.api.fork import fork
 from chatApp.api.fork import fork_chat
 from chatApp.api.preset import preset_save
+from chatApp.api.common import connections, llm_gateway, check_nsfw, moderation
+from chatApp.middleware import jwt_auth
 # 导入静态文件模块，为了显示上传图片
 from django.conf.urls.static import static
 from django.views.generic.base import RedirectView
@@ -93,9 +95,16 @@ urlpatterns = [
 
     #fork
     path('api/fork/fork_confirm/', fork.fork_confirm),#确认fork
+    path('api/fork/fork_status/', fork.fork_status),#fork 复制进度
+    path('api/ops/connection_stats/', connections.connection_stats_view),#连接池使用情况（管理员）
+    path('api/ops/llm_stats/', llm_gateway.llm_stats_view),#大模型网关排队和耗时（管理员）
+    path('api/ops/nsfw_stats/', check_nsfw.nsfw_stats_view),#NSFW 检测各阶段命中情况（管理员）
+    path('api/ops/moderation_stats/', moderation.moderation_stats_view),#内容审核队列积压情况（管理员）
+    path('api/ops/ws_auth_stats/', jwt_auth.ws_auth_stats_view),#WebSocket 认证用户缓存命中情况（管理员）
     path('api/fork/forked_list/', fork.forked_list),#我fork的
     path('api/fork/anchor_forked_by/', fork.anchor_forked_by),#被fork过
     path('api/fork/fork_chat/', fork_chat.fork_chat),#fork后续聊天
+    path('api/fork/fork_chat_stream/', fork_chat.fork_chat_stream),#fork后续聊天（流式 SSE）
 
     #feed
     path('api/feed/get_feed_rooms/', feedhome.get_feed_rooms),#信息流页面